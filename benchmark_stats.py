@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+قياس أداء نظام الإحصائيات - Stats Performance Benchmark
+
+يقيس تكلفة الأحداث في AdvancedBotStats الحقيقي (وليس نسخة مبسطة)
+ويفشل (رمز خروج 1) إذا تجاوز القياس الحد المسموح.
+
+التشغيل: python benchmark_stats.py
+أحجام الحمل الاصطناعي: BENCH_SCALES=10000,100000 (الافتراضي)
+حمل المليون مستخدم اختياري لأنه يستغرق دقائق ويحتاج ذاكرة كبيرة:
+    BENCH_SCALES=10000,100000,1000000 python benchmark_stats.py
+"""
+
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+# bot.py يتطلب التوكن عند الاستيراد - لا حاجة لتوكن حقيقي هنا
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'benchmark')
+
+import bot
+
+# نتائج القياسات: (الاسم، نجح؟، التفاصيل)
+benchmark_results = []
+
+# أحجام الحمل الاصطناعي (عدد المستخدمين) وعدد سنوات السجل اليومي
+BENCH_SCALES = [int(value) for value in os.getenv('BENCH_SCALES', '10000,100000').split(',') if value]
+BENCH_YEARS = int(os.getenv('BENCH_YEARS', '3'))
+
+# حدود الحمل الاصطناعي - تجاوز أي منها يُفشل التشغيل
+SCALE_BUDGETS = {
+    'event_us': 60,             # add_usage + add_download (لكل حدث، شاملاً معالجة الطابور)
+    'rank_us': 50,              # get_user_rank
+    'render_ms': 25,            # بناء نص get_stats_text من لقطة جديدة
+    'load_us_per_user': 60,     # زمن التحميل مقسوماً على عدد المستخدمين
+    'bytes_per_user': 400,      # حجم الملف بعد الحفظ
+    'scale_ratio': 3.0,         # نمو زمن الحدث/الترتيب/العرض بين أصغر وأكبر حجم
+}
+
+
+def make_stats(tmpdir, name='bench_stats.json'):
+    """إنشاء كائن إحصائيات معزول في مجلد مؤقت بدون حفظ أثناء القياس"""
+    path = os.path.join(tmpdir, name)
+    return bot.AdvancedBotStats(
+        stats_file=path,
+        flush_interval=3600,
+        flush_threshold=10 ** 9,
+        backend=bot.JsonStatsBackend(path),
+    )
+
+
+def seed_daily_stats(stats, days):
+    """إضافة سجل أيام سابقة بدون المرور بمسار الأحداث"""
+    today = date.today()
+    for offset in range(1, days + 1):
+        stats.data['daily_stats'][(today - timedelta(days=offset)).isoformat()] = {
+            'downloads': 3,
+            'searches': 2,
+            'new_users': 1,
+            'active_users': 2,
+            'failed': 0,
+            'active_user_ids': {offset, offset + 1},
+        }
+
+
+def time_per_event(func, repeat, finish=None):
+    """متوسط زمن الاستدعاء الواحد بالميكروثانية (finish: انتظار معالجة الطابور ضمن القياس)"""
+    started = time.perf_counter()
+    for i in range(repeat):
+        func(i)
+    if finish:
+        finish()
+    return (time.perf_counter() - started) / repeat * 1_000_000
+
+
+def bench_daily_entry_scaling(max_ratio=3.0):
+    """تكلفة add_download/add_search/add_failed_download يجب ألا تنمو مع عدد الأيام المسجلة"""
+    print("\n⏱️ القياس: تكلفة الحدث مقابل حجم daily_stats")
+    print("-" * 50)
+    
+    timings = {}
+    for days in (10, 1_000, 10_000):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stats = make_stats(tmpdir)
+            seed_daily_stats(stats, days)
+            
+            def event(i):
+                stats.add_download('video', None, 'youtube')
+                stats.add_search(None, None)
+                stats.add_failed_download()
+            
+            time_per_event(event, 200, stats.drain)  # إحماء
+            timings[days] = time_per_event(event, 2_000, stats.drain) / 3
+            stats.shutdown()
+        print(f"   - {days:>6} يوم: {timings[days]:.1f} µs لكل حدث")
+    
+    ratio = timings[10_000] / timings[10]
+    passed = ratio <= max_ratio
+    print(f"   - النسبة (10000 يوم / 10 أيام): {ratio:.2f} (الحد {max_ratio})")
+    benchmark_results.append(("تكلفة الحدث مع نمو daily_stats", passed, f"{ratio:.2f}x"))
+
+
+def make_user_records(count):
+    """سجلات مستخدمين كما تُقرأ من ملف JSON (نصوص مكررة وأوقات ISO)"""
+    now = time.time()
+    users = {}
+    for i in range(count):
+        seen = now - (i % 365) * 86400
+        users[str(100_000_000 + i)] = {
+            'name': f"User {i % 5000}",
+            'username': 'بدون معرف' if i % 3 else f"user_{i}",
+            'first_seen': bot.datetime.fromtimestamp(seen - 86400 * 30).isoformat(),
+            'join_date': bot.datetime.fromtimestamp(seen - 86400 * 30).date().isoformat(),
+            'last_seen': bot.datetime.fromtimestamp(seen).isoformat(),
+            'usage_count': i % 97,
+            'download_count': i % 41,
+            'search_count': i % 13,
+            'failed_count': i % 3,
+            'is_active': bool(i % 2),
+        }
+    return json.dumps(users)
+
+
+def bench_user_memory(count=100_000, max_ratio=0.6):
+    """ذاكرة جدول المستخدمين المضغوط مقابل قواميس JSON لكل 100 ألف مستخدم"""
+    print(f"\n⏱️ القياس: ذاكرة {count:,} مستخدم")
+    print("-" * 50)
+    
+    payload = make_user_records(count)
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    users = json.loads(payload)
+    dict_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    table = bot.UserTable(users)
+    del users
+    gc.collect()
+    table_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    
+    per_100k = 100_000 / count / (1024 * 1024)
+    print(f"   - قواميس: {dict_bytes * per_100k:.1f} MB لكل 100k مستخدم")
+    print(f"   - UserTable: {table_bytes * per_100k:.1f} MB لكل 100k مستخدم")
+    
+    ratio = table_bytes / dict_bytes
+    passed = ratio <= max_ratio and len(table) == count
+    print(f"   - النسبة: {ratio:.2f} (الحد {max_ratio})")
+    benchmark_results.append(("ذاكرة جدول المستخدمين", passed, f"{ratio:.2f}x"))
+
+
+def bench_snapshot_codec(count=100_000, max_size_ratio=0.3):
+    """اللقطة الثنائية مقابل JSON المنسق: الحجم وزمن الحفظ وزمن التحميل"""
+    print(f"\n⏱️ القياس: صيغة اللقطة ({count:,} مستخدم)")
+    print("-" * 50)
+    
+    data, _, _ = make_synthetic_data(count, 1, random.Random(99))
+    changes = bot.StatsChanges(full=True)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend in (bot.JsonStatsBackend(os.path.join(tmpdir, 'stats.json')),
+                        bot.BinaryStatsBackend(os.path.join(tmpdir, 'stats.bin'), 'gzip')):
+            started = time.perf_counter()
+            size = backend.commit(backend.prepare(data, changes))
+            saved = time.perf_counter() - started
+            started = time.perf_counter()
+            loaded = backend.load()
+            if isinstance(loaded['users'], dict):
+                # JSON يحتاج تحويل السجلات إلى UserTable عند التحميل
+                loaded['users'] = bot.UserTable(loaded['users'])
+            load = time.perf_counter() - started
+            results[backend.name] = (size, saved, load, len(loaded['users']))
+            print(f"   - {backend.name}: {size / (1024 * 1024):.1f} MB، حفظ {saved:.2f} s، تحميل {load:.2f} s")
+    
+    json_size, json_save, json_load, _ = results['json']
+    binary_size, binary_save, binary_load, binary_users = results['binary']
+    ratio = binary_size / json_size
+    passed = ratio <= max_size_ratio and binary_load < json_load and binary_users == count
+    print(f"   - نسبة الحجم: {ratio:.2f} (الحد {max_size_ratio})")
+    benchmark_results.append((
+        "صيغة اللقطة الثنائية", passed,
+        f"{ratio:.2f}x حجم، تحميل {json_load / binary_load:.1f}x أسرع، حفظ {json_save / binary_save:.1f}x أسرع"
+    ))
+
+
+def zipf_cumulative(count, exponent=1.1):
+    """أوزان تراكمية لتوزيع Zipf: المستخدم رقم r نشاطه يتناسب مع 1/r^s"""
+    cumulative = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** exponent
+        cumulative.append(total)
+    return cumulative
+
+
+def make_synthetic_data(users, years, rng):
+    """بيانات إحصائيات واقعية: نشاط Zipf للمستخدمين، وسجل يومي لعدة سنوات، ومصطلحات بحث"""
+    cumulative = zipf_cumulative(users)
+    scale = 50_000 / cumulative[0]  # أنشط مستخدم ~50 ألف استخدام
+    now = time.time()
+    
+    table = bot.UserTable()
+    previous = 0.0
+    for rank in range(users):
+        weight = cumulative[rank] - previous
+        previous = cumulative[rank]
+        usage = max(1, int(weight * scale))
+        seen = now - rng.randrange(365 * years) * 86400
+        first_seen = bot.datetime.fromtimestamp(seen - 86400 * rng.randrange(1, 365))
+        table[str(100_000_000 + rank)] = {
+            'name': f"User {rank % 5000}",
+            'username': 'بدون معرف' if rank % 3 else f"user_{rank}",
+            'first_seen': first_seen.isoformat(),
+            'join_date': first_seen.date().isoformat(),
+            'last_seen': bot.datetime.fromtimestamp(seen).isoformat(),
+            'usage_count': usage,
+            'download_count': usage // 2,
+            'search_count': usage // 5,
+            'failed_count': usage // 20,
+            'is_active': True,
+        }
+    
+    ids = list(range(100_000_000, 100_000_000 + users))
+    daily_active = min(users // 10, 2_000)
+    today = date.today()
+    daily_stats = {}
+    for offset in range(1, 365 * years + 1):
+        active = set(rng.choices(ids, cum_weights=cumulative, k=daily_active))
+        daily_stats[(today - timedelta(days=offset)).isoformat()] = {
+            'downloads': daily_active * 2,
+            'searches': daily_active // 2,
+            'new_users': users // (365 * years) + 1,
+            'active_users': len(active),
+            'failed': daily_active // 10,
+            'active_user_ids': active,
+        }
+    
+    total_usage = sum(record['usage_count'] for record in table.values())
+    return {
+        'total_users': users,
+        'users': table,
+        'total_downloads': total_usage // 2,
+        'successful_downloads': total_usage // 2 - total_usage // 20,
+        'failed_downloads': total_usage // 20,
+        'downloads_by_type': {'image': 0, 'video': total_usage // 4, 'audio': total_usage // 4, 'search': 0, 'story': 0},
+        'total_searches': total_usage // 5,
+        'search_terms': {f"song {i}": max(1, 10_000 // (i + 1)) for i in range(bot.STATS_SEARCH_TERMS_CAPACITY)},
+        'start_date': bot.datetime.fromtimestamp(now - 365 * years * 86400).isoformat(),
+        'daily_stats': daily_stats,
+        'daily_stats_version': 2,
+        'platforms': {'youtube': total_usage // 4, 'instagram': 0, 'tiktok': 0, 'twitter': 0, 'facebook': 0, 'other': 0},
+    }, ids, cumulative
+
+
+def bench_synthetic_scale(users, rng):
+    """حمل اصطناعي واحد: حجم الملف، زمن التحميل، زمن الأحداث، الترتيب، وبناء النص"""
+    print(f"\n⏱️ القياس: حمل اصطناعي {users:,} مستخدم و{BENCH_YEARS} سنوات")
+    print("-" * 50)
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'synthetic_stats.json')
+        data, ids, cumulative = make_synthetic_data(users, BENCH_YEARS, rng)
+        backend = bot.JsonStatsBackend(path)
+        backend.commit(backend.prepare(data, bot.StatsChanges(full=True)))
+        del data
+        gc.collect()
+        
+        stats = bot.AdvancedBotStats(
+            stats_file=path, flush_interval=3600, flush_threshold=10 ** 9,
+            backend=bot.JsonStatsBackend(path), render_min_interval=0,
+        )
+        load_us = stats.load_seconds / users * 1_000_000
+        
+        # الحفظ الأول بعد التحميل يطبق الاحتفاظ (الأيام القديمة تصبح تجميعات أسبوعية/شهرية)
+        stats.save_stats()
+        stats.flush()
+        file_bytes = os.path.getsize(path)
+        
+        sample = [str(user_id) for user_id in rng.choices(ids, cum_weights=cumulative, k=5_000)]
+        
+        def event(i):
+            user_id = sample[i % len(sample)]
+            stats.add_usage(user_id)
+            stats.add_download('video', user_id, 'youtube')
+        
+        time_per_event(event, 500, stats.drain)  # إحماء
+        event_us = time_per_event(event, 5_000, stats.drain) / 2
+        rank_us = time_per_event(lambda i: stats.get_user_rank(sample[i % len(sample)]), 5_000)
+        
+        snapshot = stats.get_snapshot()
+        render_ms = time_per_event(lambda i: stats._render_stats_text(snapshot), 50) / 1000
+        stats.shutdown()
+    
+    print(f"   - حجم الملف: {file_bytes / (1024 * 1024):.1f} MB ({file_bytes / users:.0f} بايت/مستخدم)")
+    print(f"   - زمن التحميل: {stats.load_seconds:.2f} s ({load_us:.1f} µs/مستخدم)")
+    print(f"   - add_usage/add_download: {event_us:.1f} µs لكل حدث")
+    print(f"   - get_user_rank: {rank_us:.1f} µs")
+    print(f"   - get_stats_text (بناء): {render_ms:.2f} ms")
+    
+    return {
+        'event_us': event_us, 'rank_us': rank_us, 'render_ms': render_ms,
+        'load_us_per_user': load_us, 'bytes_per_user': file_bytes / users,
+    }
+
+
+def bench_synthetic_load():
+    """الحمل الاصطناعي على كل الأحجام مع مقارنة الحدود ونمو الزمن مع الحجم"""
+    rng = random.Random(1234)
+    measurements = {users: bench_synthetic_scale(users, rng) for users in BENCH_SCALES}
+    
+    for users, measured in measurements.items():
+        over = [
+            f"{name}={value:.1f}>{SCALE_BUDGETS[name]}"
+            for name, value in measured.items() if value > SCALE_BUDGETS[name]
+        ]
+        details = ", ".join(over) if over else (
+            f"{measured['event_us']:.1f} µs/حدث، {measured['rank_us']:.1f} µs/ترتيب، "
+            f"{measured['render_ms']:.2f} ms/نص، {measured['load_us_per_user']:.1f} µs/مستخدم تحميل"
+        )
+        benchmark_results.append((f"حمل اصطناعي {users:,} مستخدم", not over, details))
+    
+    if len(measurements) > 1:
+        smallest, largest = measurements[min(measurements)], measurements[max(measurements)]
+        ratios = {
+            name: largest[name] / smallest[name]
+            for name in ('event_us', 'rank_us', 'render_ms') if smallest[name]
+        }
+        passed = all(ratio <= SCALE_BUDGETS['scale_ratio'] for ratio in ratios.values())
+        details = ", ".join(f"{name} {ratio:.2f}x" for name, ratio in ratios.items())
+        benchmark_results.append(("ثبات الزمن مع نمو عدد المستخدمين", passed, details))
+
+
+def print_summary():
+    """طباعة ملخص النتائج"""
+    print("\n" + "=" * 50)
+    print("📊 ملخص القياسات")
+    print("=" * 50)
+    
+    for name, passed, details in benchmark_results:
+        print(f"{'✅' if passed else '❌'} {name}: {details}")
+    
+    failed = [name for name, passed, _ in benchmark_results if not passed]
+    if failed:
+        print(f"\n⚠️ هناك {len(failed)} قياس تجاوز الحد المسموح")
+    else:
+        print("\n🎉 جميع القياسات ضمن الحدود!")
+    return not failed
+
+
+def main():
+    """الدالة الرئيسية"""
+    print("=" * 50)
+    print("🧪 قياس أداء نظام الإحصائيات")
+    print("=" * 50)
+    
+    bench_daily_entry_scaling()
+    bench_user_memory()
+    bench_snapshot_codec()
+    bench_synthetic_load()
+    
+    return 0 if print_summary() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,8 +2,8 @@ import os
 import logging
 import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
-from telegram.error import TelegramError
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, TypeHandler
+from telegram.error import TelegramError, BadRequest
 import yt_dlp
 import asyncio
 from dotenv import load_dotenv
@@ -11,11 +11,38 @@ import re
 import subprocess
 import glob
 import json
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import shutil
 import instaloader
 from functools import wraps
 import time
+import threading
+import atexit
+import sqlite3
+import base64
+import gzip
+import hashlib
+import struct
+import sys
+import zlib
+import math
+import queue
+import bisect
+import heapq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+from types import MappingProxyType
+
+try:
+    import zstandard  # اختياري - ضغط أسرع وأصغر للقطات الإحصائيات الثنائية
+except ImportError:
+    zstandard = None
+
+# بداية تشغيل العملية - لقياس الزمن حتى أول تحديث
+PROCESS_STARTED_AT = time.monotonic()
 
 # تحميل المتغيرات من ملف .env
 load_dotenv()
@@ -62,6 +89,83 @@ os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 # ملف الإحصائيات
 STATS_FILE = "bot_stats.json"
 
+# مخزن الإحصائيات: json (ملف واحد) أو sqlite (قاعدة WAL مع تحديثات على مستوى الصفوف)
+# أو journal (سجل أحداث إلحاقي + لقطة دورية) أو binary (لقطة ثنائية مضغوطة)
+STATS_BACKEND = os.getenv("STATS_BACKEND", "json")
+STATS_DB_FILE = os.getenv("STATS_DB_FILE", "bot_stats.db")
+STATS_BINARY_FILE = os.getenv("STATS_BINARY_FILE", "bot_stats.bin")
+STATS_BINARY_COMPRESSION = os.getenv("STATS_BINARY_COMPRESSION", "gzip")  # none أو gzip أو zstd (يتطلب حزمة zstandard)
+STATS_JOURNAL_COMPACT_EVENTS = int(os.getenv("STATS_JOURNAL_COMPACT_EVENTS", "5000"))  # ضغط السجل كل N حدث
+STATS_JOURNAL_COMPACT_SECONDS = float(os.getenv("STATS_JOURNAL_COMPACT_SECONDS", "600"))  # أو كل N ثانية
+STATS_SEARCH_TERMS_CAPACITY = int(os.getenv("STATS_SEARCH_TERMS_CAPACITY", "1000"))  # الحد الأقصى لمصطلحات البحث المتتبعة
+STATS_HLL_PRECISION = int(os.getenv("STATS_HLL_PRECISION", "0"))  # تقدير المستخدمين الفريدين بـ HyperLogLog (0 = معطل، 12 ≈ خطأ 1.6% و4KB لكل يوم)
+
+# الاحتفاظ المتدرج بالإحصائيات اليومية: أيام خام ثم تجميعات أسبوعية ثم شهرية
+STATS_DAILY_RETENTION_DAYS = int(os.getenv("STATS_DAILY_RETENTION_DAYS", "90"))  # الأيام المحفوظة بدقة يومية (0 = بدون تجميع)
+STATS_WEEKLY_RETENTION_WEEKS = int(os.getenv("STATS_WEEKLY_RETENTION_WEEKS", "104"))  # الأسابيع المحفوظة قبل التجميع الشهري
+
+# تشغيل عدة عمليات: كل عملية تكتب جزءاً خاصاً بها (shard) ويُدمج العرض عند القراءة
+STATS_SHARD_ID = os.getenv("STATS_SHARD_ID", "")  # فارغ = عملية واحدة تكتب المخزن الرئيسي مباشرة
+STATS_SHARD_MERGE_INTERVAL = float(os.getenv("STATS_SHARD_MERGE_INTERVAL", "30"))  # ثوانٍ بين إعادة بناء العرض المدمج
+
+# التحميل الكسول: الملخص أولاً ثم باقي الإحصائيات في خيط خلفي دون تأخير بدء البوت
+STATS_LAZY_LOAD = os.getenv("STATS_LAZY_LOAD", "1") == "1"
+
+# الحفظ المؤجل للإحصائيات (Write-behind)
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "5"))  # ثوانٍ بين عمليات الحفظ (0 = حفظ فوري مع كل تغيير)
+STATS_FLUSH_THRESHOLD = int(os.getenv("STATS_FLUSH_THRESHOLD", "200"))  # عدد التغييرات المعلقة الذي يفرض الحفظ مبكراً
+STATS_SNAPSHOT_INTERVAL = float(os.getenv("STATS_SNAPSHOT_INTERVAL", "1"))  # أقل فاصل (ثوانٍ) بين تحديثات لقطة القراءة
+STATS_RENDER_MIN_INTERVAL = float(os.getenv("STATS_RENDER_MIN_INTERVAL", "2"))  # أقل فاصل (ثوانٍ) لإعادة بناء نص لوحة إحصائيات
+
+# نقطة /metrics بصيغة Prometheus (محلية فقط افتراضياً، 0 = معطلة)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# مجمعات خيوط منفصلة لكل نوع عمل حتى لا تحجب تحميلات الفيديو الكبيرة عمليات البحث السريعة
+POOL_SEARCH_WORKERS = int(os.getenv("POOL_SEARCH_WORKERS", "4"))  # البحث والمعلومات (search_youtube, get_info)
+POOL_AUDIO_WORKERS = int(os.getenv("POOL_AUDIO_WORKERS", "3"))  # تحميل الصوت
+POOL_VIDEO_WORKERS = int(os.getenv("POOL_VIDEO_WORKERS", "2"))  # تحميل الفيديو
+POOL_STORIES_WORKERS = int(os.getenv("POOL_STORIES_WORKERS", "2"))  # قصص Instagram
+POOL_IMAGE_WORKERS = int(os.getenv("POOL_IMAGE_WORKERS", "4"))  # تحميل الصور
+
+# جدولة التحميلات: طابور مركزي بأولويات وعدالة بين المستخدمين (دوري round-robin)
+SCHEDULER_MAX_CONCURRENT = int(os.getenv("SCHEDULER_MAX_CONCURRENT", "6"))  # أقصى عدد طلبات تحميل تعمل معاً
+SCHEDULER_MAX_PER_USER = int(os.getenv("SCHEDULER_MAX_PER_USER", "2"))  # أقصى عدد طلبات تعمل معاً للمستخدم الواحد
+SCHEDULER_STATUS_INTERVAL = float(os.getenv("SCHEDULER_STATUS_INTERVAL", "3"))  # أقل فاصل (ثوانٍ) بين تحديثات رسائل ترتيب الانتظار وحفظ الطابور
+SCHEDULER_QUEUE_FILE = os.getenv("SCHEDULER_QUEUE_FILE", "download_queue.json")  # حفظ الطابور لإبلاغ المستخدمين بعد إعادة التشغيل (فارغ = معطل)
+SCHEDULER_STATUS_EDITS = int(os.getenv("SCHEDULER_STATUS_EDITS", "20"))  # أقصى عدد رسائل انتظار تُعدل في التحديث الواحد (تجنباً لحدود Telegram)
+
+# ذاكرة file_id: إعادة إرسال ملف سبق رفعه إلى Telegram دون تحميل أو رفع جديد
+FILE_ID_CACHE_FILE = os.getenv("FILE_ID_CACHE_FILE", "file_id_cache.json")  # فارغ = معطلة
+FILE_ID_CACHE_TTL_DAYS = float(os.getenv("FILE_ID_CACHE_TTL_DAYS", "30"))  # عمر المدخل قبل انتهاء صلاحيته
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv("FILE_ID_CACHE_MAX_ENTRIES", "10000"))  # الأقل استخداماً يُحذف أولاً عند تجاوزه
+
+# ذاكرة الوسائط على القرص: الاحتفاظ بالملفات المحملة لإعادة استخدامها بدل تحميلها من جديد
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "")  # مجلد الذاكرة (فارغ = معطلة)
+MEDIA_CACHE_MAX_MB = int(os.getenv("MEDIA_CACHE_MAX_MB", "2048"))  # الحد الأقصى لحجمها، الأقدم استخداماً يُحذف أولاً
+
+# ذاكرة معلومات الروابط (get_info): ملخص صغير في الذاكرة وعلى القرص بعمر لكل منصة
+METADATA_CACHE_FILE = os.getenv("METADATA_CACHE_FILE", "metadata_cache.json")  # فارغ = في الذاكرة فقط
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", "3600"))  # العمر الافتراضي (ثوانٍ)
+
+def parse_platform_ttls(value):
+    """تحويل "youtube:21600,tiktok:1800" إلى قاموس أعمار؛ العنصر غير الصالح يُتجاهل مع تحذير"""
+    ttls = {}
+    for item in value.split(','):
+        name, _, ttl = item.partition(':')
+        if not item.strip():
+            continue
+        try:
+            ttls[name.strip()] = float(ttl)
+        except ValueError:
+            logger.warning(f"⚠️ عمر غير صالح في METADATA_CACHE_TTLS - سيُتجاهل: {item.strip()}")
+    return ttls
+
+METADATA_CACHE_TTLS = parse_platform_ttls(  # أعمار خاصة لكل منصة بصيغة youtube:21600,tiktok:1800
+    os.getenv("METADATA_CACHE_TTLS", "youtube:21600,tiktok:1800,instagram:1800,twitter:900"))
+METADATA_CACHE_MAX_ENTRIES = int(os.getenv("METADATA_CACHE_MAX_ENTRIES", "5000"))
+CACHE_SAVE_INTERVAL = float(os.getenv("CACHE_SAVE_INTERVAL", "2"))  # مهلة (ثوانٍ) تجميع تغييرات ملفات الذاكرات في كتابة واحدة
+
 # معرف المطور (ضع معرفك هنا)
 DEVELOPER_ID = int(os.getenv("DEVELOPER_ID", "0"))  # ضع معرفك في .env
 USERNAME_FOR_DEVELOPER = os.getenv("USERNAME_FOR_DEVELOPER", "")  # معرف مستخدم التلجرام للمطور
@@ -196,36 +300,3066 @@ def find_ffmpeg():
     except:
         pass
     
-    logger.warning("⚠️ لم يتم العثور على ffmpeg")
-    return None
-
-# البحث عن ffmpeg
-FFMPEG_PATH = find_ffmpeg()
+    logger.warning("⚠️ لم يتم العثور على ffmpeg")
+    return None
+
+# البحث عن ffmpeg
+FFMPEG_PATH = find_ffmpeg()
+
+# ============================================
+# 📈 مقاييس Prometheus (Metrics)
+# ============================================
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class MetricCounter:
+    """عداد متزايد مع تسميات - التحديث O(1) تحت قفل صغير خاص بالمقياس"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, labels, value) for labels, value in values]
+    
+    def sample_label_names(self, sample_name):
+        return self.label_names
+
+class MetricGauge(MetricCounter):
+    """قيمة قابلة للزيادة والنقصان (مثل عدد المهام قيد التنفيذ)"""
+    
+    kind = 'gauge'
+    
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+    
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+class MetricHistogram:
+    """مدرج تكراري بدلاء ثابتة (بالثواني)"""
+    
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # عدد لكل دلو + دلو +Inf، ثم المجموع
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+    
+    def time(self, *labels):
+        """مدير سياق يقيس زمن الكتلة (يعمل أيضاً حول await)"""
+        return _MetricTimer(self, labels)
+    
+    def counts(self):
+        """عدد الملاحظات لكل مجموعة تسميات"""
+        with self._lock:
+            return {labels: sum(counts) for labels, (counts, _) in self._series.items()}
+    
+    def quantile(self, q, *labels):
+        """تقدير نسبة مئوية بالاستيفاء الخطي داخل الدلو (مثل histogram_quantile في Prometheus)"""
+        with self._lock:
+            series = self._series.get(labels)
+            counts = list(series[0]) if series else None
+        if not counts:
+            return None
+        rank = q * sum(counts)
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                if index == len(self.buckets):
+                    # ما بعد آخر حد معروف: أفضل تقدير هو الحد نفسه
+                    return float(self.buckets[-1])
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return float(self.buckets[-1])
+    
+    def samples(self):
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        result = []
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                result.append((f"{self.name}_bucket", labels + (le,), cumulative))
+            result.append((f"{self.name}_sum", labels, total))
+            result.append((f"{self.name}_count", labels, cumulative))
+        return result
+    
+    def sample_label_names(self, sample_name):
+        return self.label_names + ('le',) if sample_name.endswith('_bucket') else self.label_names
+
+class _MetricTimer:
+    __slots__ = ('histogram', 'labels', 'started')
+    
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+class MetricsRegistry:
+    """سجل المقاييس: مقاييس مباشرة + دوال تجميع تُستدعى فقط عند القراءة (scrape)"""
+    
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, help_text, labels=()):
+        return self.register(MetricCounter(name, help_text, labels))
+    
+    def gauge(self, name, help_text, labels=()):
+        return self.register(MetricGauge(name, help_text, labels))
+    
+    def histogram(self, name, help_text, labels=(), buckets=MetricHistogram.DEFAULT_BUCKETS):
+        return self.register(MetricHistogram(name, help_text, labels, buckets))
+    
+    def add_collector(self, collector):
+        """collector() تعيد قائمة (الاسم، النوع، الوصف، أسماء التسميات، [(قيم التسميات، القيمة)])"""
+        self._collectors.append(collector)
+    
+    def render(self):
+        """نص المقاييس بصيغة Prometheus text 0.0.4"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample_name, labels, value in metric.samples():
+                names = metric.sample_label_names(sample_name)
+                lines.append(f"{sample_name}{_format_labels(names, labels)} {value}")
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.error(f"❌ خطأ في جمع المقاييس: {e}")
+                continue
+            for name, kind, help_text, label_names, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(label_names, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+METRIC_TASKS_QUEUED = METRICS.gauge(
+    'bot_executor_queued_tasks', 'Blocking tasks waiting for an executor thread', ('pool', 'task'))
+METRIC_TASKS_RUNNING = METRICS.gauge(
+    'bot_executor_running_tasks', 'Blocking tasks currently running in the executor', ('pool', 'task'))
+METRIC_TASK_WAIT_SECONDS = METRICS.histogram(
+    'bot_executor_wait_seconds', 'Time blocking tasks spent queued before running', ('pool', 'task'))
+METRIC_TASK_SECONDS = METRICS.histogram(
+    'bot_executor_task_seconds', 'Duration of blocking tasks (downloads, searches, metadata)', ('pool', 'task'))
+METRIC_UPLOAD_SECONDS = METRICS.histogram(
+    'bot_upload_seconds', 'Duration of Telegram uploads', ('kind',))
+METRIC_UPDATES = METRICS.counter('bot_updates_total', 'Telegram updates received')
+
+# مراحل طلب التحميل بالترتيب المعتاد
+DOWNLOAD_PHASES = ('metadata', 'download', 'postprocess', 'upload')
+METRIC_PHASE_SECONDS = METRICS.histogram(
+    'bot_download_phase_seconds', 'Download request phase durations per platform', ('platform', 'phase'))
+
+class DownloadPhaseTimer:
+    """تقسيم زمن طلب تحميل واحد إلى مراحل (بيانات وصفية، تحميل، معالجة ffmpeg، رفع)
+    
+    المراحل داخل yt-dlp تُكتشف عبر progress_hooks و postprocessor_hooks، ويُستخدم
+    المؤقت من خيط واحد في كل لحظة (خيط المنفذ ثم حلقة الأحداث) لذا لا يحتاج قفلاً.
+    """
+    
+    def __init__(self, platform):
+        self.platform = platform or 'other'
+        self.durations = {}
+        self.started = self._since = time.perf_counter()
+        self._phase = 'metadata'
+    
+    def restart(self):
+        """بدء القياس من الآن (بعد انتظار الدور في طابور التحميل)"""
+        self.durations = {}
+        self.started = self._since = time.perf_counter()
+        self._phase = 'metadata'
+    
+    def enter(self, phase):
+        """إنهاء المرحلة الحالية وبدء مرحلة جديدة (None للتوقف المؤقت)"""
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.durations[self._phase] = self.durations.get(self._phase, 0.0) + now - self._since
+        self._phase = phase
+        self._since = now
+    
+    def pause(self):
+        self.enter(None)
+    
+    def share(self, other, since):
+        """احتساب انتظار تحميل مشترك منذ since: يُوزع على المراحل بنسب مراحل مؤقت التحميل other"""
+        now = time.perf_counter()
+        self.pause()
+        durations = dict(other.durations)  # قد يكون التحميل ما زال يعمل في خيط المنفذ
+        total = sum(durations.values())
+        if total > 0:
+            waited = now - since
+            for phase, seconds in durations.items():
+                self.durations[phase] = self.durations.get(phase, 0.0) + waited * seconds / total
+    
+    def progress_hook(self, status):
+        if status.get('status') == 'downloading' and self._phase != 'download':
+            self.enter('download')
+    
+    def postprocessor_hook(self, status):
+        if status.get('status') == 'started' and self._phase != 'postprocess':
+            self.enter('postprocess')
+    
+    def attach(self, opts):
+        """إضافة خطافات المؤقت إلى نسخة من إعدادات yt-dlp"""
+        opts = dict(opts)
+        opts['progress_hooks'] = list(opts.get('progress_hooks', ())) + [self.progress_hook]
+        opts['postprocessor_hooks'] = list(opts.get('postprocessor_hooks', ())) + [self.postprocessor_hook]
+        return opts
+    
+    def finish(self):
+        """تسجيل المراحل في المدرجات وإرجاع الزمن الكلي للطلب
+        
+        تُسجل المراحل مرة واحدة: معالج الخطأ قد يستدعيها بعد نجاح الرفع فلا تتكرر.
+        """
+        self.pause()
+        durations, self.durations = self.durations, {}
+        for phase, seconds in durations.items():
+            METRIC_PHASE_SECONDS.observe(seconds, self.platform, phase)
+        return time.perf_counter() - self.started
+
+def download_phase_percentiles(quantiles=(0.5, 0.95, 0.99)):
+    """النسب المئوية لكل (منصة، مرحلة) مقدّرة من دلاء المدرج: {(platform, phase): (count, [p...])}"""
+    return {
+        labels: (count, [METRIC_PHASE_SECONDS.quantile(q, *labels) for q in quantiles])
+        for labels, count in METRIC_PHASE_SECONDS.counts().items()
+    }
+
+def get_download_latency_text():
+    """نص لوحة أزمنة مراحل التحميل (p50/p95/p99 لكل منصة منذ بدء التشغيل) وحالة مجمعات التنفيذ وذاكرة الوسائط"""
+    percentiles = download_phase_percentiles()
+    phase_names = {
+        'metadata': 'البيانات الوصفية', 'download': 'التحميل',
+        'postprocess': 'معالجة ffmpeg', 'upload': 'الرفع إلى Telegram',
+    }
+    lines = ["⏱️ أزمنة مراحل التحميل (ث) - p50 / p95 / p99", ""]
+    if not percentiles:
+        lines += ["لا توجد قياسات لأزمنة التحميل بعد", ""]
+    for platform in sorted({platform for platform, _ in percentiles}):
+        lines.append(f"📍 {platform.upper()}")
+        for phase in DOWNLOAD_PHASES:
+            entry = percentiles.get((platform, phase))
+            if entry is None:
+                continue
+            count, (p50, p95, p99) = entry
+            lines.append(f"  • {phase_names[phase]}: {p50:.2f} / {p95:.2f} / {p99:.2f}  ({count:,} طلب)")
+        lines.append("")
+    
+    lines.append("⚙️ مجمعات التنفيذ (قيد التنفيذ/الحجم، في الانتظار)")
+    for name, (size, running, queued) in get_pool_status().items():
+        lines.append(f"  • {name}: {running}/{size}، {queued} في الانتظار")
+    lines.append("")
+    lines.append(
+        f"⏳ طابور التحميل: {DOWNLOAD_SCHEDULER.running_count()}/{DOWNLOAD_SCHEDULER.max_concurrent} قيد التنفيذ، "
+        f"{DOWNLOAD_SCHEDULER.queued_count()} في الانتظار"
+    )
+    if MEDIA_CACHE.enabled:
+        cache = MEDIA_CACHE.stats()
+        lines.append("")
+        lines.append(
+            f"💾 ذاكرة الوسائط: {cache['entries']:,} ملف، "
+            f"{cache['bytes'] / (1024*1024):.1f}/{cache['max_bytes'] / (1024*1024):.0f} MB"
+        )
+        lines.append(f"  • إصابات: {cache['hits']:,}، إخفاقات: {cache['misses']:,}، إخلاءات: {cache['evictions']:,}")
+    return "\n".join(lines).rstrip()
+
+# مجمع لكل نوع عمل (الخيوط تُنشأ عند الحاجة فقط)
+EXECUTOR_POOL_SIZES = {
+    'search': max(1, POOL_SEARCH_WORKERS),
+    'audio': max(1, POOL_AUDIO_WORKERS),
+    'video': max(1, POOL_VIDEO_WORKERS),
+    'stories': max(1, POOL_STORIES_WORKERS),
+    'image': max(1, POOL_IMAGE_WORKERS),
+}
+EXECUTOR_POOLS = {
+    name: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"pool-{name}")
+    for name, size in EXECUTOR_POOL_SIZES.items()
+}
+
+def get_pool_status():
+    """حالة كل مجمع: (الحجم، قيد التنفيذ، في الانتظار) - لقياس التشبع"""
+    running = {}
+    queued = {}
+    for _, (pool, _), value in METRIC_TASKS_RUNNING.samples():
+        running[pool] = running.get(pool, 0) + value
+    for _, (pool, _), value in METRIC_TASKS_QUEUED.samples():
+        queued[pool] = queued.get(pool, 0) + value
+    return {
+        name: (size, running.get(name, 0), queued.get(name, 0))
+        for name, size in EXECUTOR_POOL_SIZES.items()
+    }
+
+def collect_pool_metrics():
+    """حجم كل مجمع ونسبة تشبعه (قيد التنفيذ / الحجم) عند القراءة"""
+    status = get_pool_status()
+    return [
+        ('bot_executor_pool_size', 'gauge', 'Worker threads per executor pool', ('pool',),
+         [((name,), size) for name, (size, _, _) in status.items()]),
+        ('bot_executor_pool_saturation', 'gauge', 'Running tasks divided by pool size', ('pool',),
+         [((name,), running / size) for name, (size, running, _) in status.items()]),
+    ]
+
+METRICS.add_collector(collect_pool_metrics)
+
+async def run_blocking(func, *args, pool=None, **kwargs):
+    """تشغيل دالة حاجبة في مجمع نوع العمل (أو المنفذ الافتراضي) مع قياس زمن الانتظار والتنفيذ وعدد المهام المعلقة"""
+    task = getattr(func, '__name__', 'task')
+    executor = EXECUTOR_POOLS[pool] if pool else None
+    pool = pool or 'default'
+    METRIC_TASKS_QUEUED.inc(pool, task)
+    queued_at = time.perf_counter()
+    # من يحصل على القفل أولاً (بدء التنفيذ أو الإلغاء قبل البدء) يُنقص عداد الانتظار مرة واحدة فقط
+    dequeued = threading.Lock()
+    
+    def call():
+        if dequeued.acquire(blocking=False):
+            METRIC_TASKS_QUEUED.dec(pool, task)
+        started = time.perf_counter()
+        METRIC_TASK_WAIT_SECONDS.observe(started - queued_at, pool, task)
+        METRIC_TASKS_RUNNING.inc(pool, task)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            METRIC_TASKS_RUNNING.dec(pool, task)
+            METRIC_TASK_SECONDS.observe(time.perf_counter() - started, pool, task)
+    
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, call)
+    finally:
+        if dequeued.acquire(blocking=False):
+            METRIC_TASKS_QUEUED.dec(pool, task)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """خادم /metrics بسيط من المكتبة القياسية"""
+    
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """تشغيل نقطة /metrics في خيط خلفي"""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"✅ المقاييس متاحة على http://{host}:{server.server_port}/metrics")
+    return server
+
+# ============================================
+# ⏳ جدولة طلبات التحميل (Download Scheduler)
+# ============================================
+
+# الأولوية الأصغر تُخدم أولاً: الصور والمعلومات سريعة والفيديو أثقلها
+JOB_PRIORITIES = {
+    'image': 0,
+    'info': 0,
+    'audio': 1,
+    'story': 1,
+    'video': 2,
+}
+
+class DownloadJob:
+    """طلب تحميل واحد (النوع، الرابط، المستخدم، المحادثة) ورسالة الحالة الخاصة به"""
+    
+    __slots__ = ('job_type', 'url', 'user_id', 'chat_id', 'message', 'status_text', 'priority',
+                 'seq', 'enqueued_at', 'future', 'position', 'status_task')
+    
+    def __init__(self, job_type, url, user_id, chat_id, message=None):
+        self.job_type = job_type
+        self.url = url
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message = message
+        self.status_text = getattr(message, 'text', None)  # يُعاد إلى الرسالة عند بدء التنفيذ
+        self.priority = JOB_PRIORITIES.get(job_type, 1)
+        self.seq = 0
+        self.enqueued_at = time.time()
+        self.future = None
+        self.position = None
+        self.status_task = None
+    
+    def to_dict(self):
+        return {
+            'type': self.job_type,
+            'url': self.url,
+            'user_id': self.user_id,
+            'chat_id': self.chat_id,
+            'message_id': getattr(self.message, 'message_id', None),
+            'enqueued_at': self.enqueued_at,
+        }
+
+class DownloadScheduler:
+    """طابور مركزي لطلبات التحميل يعمل داخل حلقة الأحداث (لا يحتاج قفلاً)
+    
+    الطلب التالي هو الأعلى أولوية، وعند التساوي صاحب أقل طلبات عاملة ثم بالدور بين
+    المستخدمين، فمن يرسل عشرين رابطاً ينتظر دوره بعد كل طلب بدل أن يحجز كل العمال. يُطبق حد عام
+    وحد لكل مستخدم، ويُحفظ الطابور في ملف JSON لإبلاغ أصحابه بعد إعادة التشغيل.
+    الحفظ وتحديث رسائل الترتيب يجمعان كل التغييرات في تحديث واحد كل status_interval.
+    """
+    
+    def __init__(self, max_concurrent=SCHEDULER_MAX_CONCURRENT, max_per_user=SCHEDULER_MAX_PER_USER,
+                 queue_file=SCHEDULER_QUEUE_FILE, status_interval=SCHEDULER_STATUS_INTERVAL,
+                 max_edits=SCHEDULER_STATUS_EDITS):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_per_user = max(1, max_per_user)
+        self.queue_file = queue_file
+        self.status_interval = status_interval
+        self.max_edits = max(1, max_edits)
+        self._pending = {}  # user_id -> طلبات منتظرة مرتبة بالأولوية ثم بالوصول
+        self._turns = {}  # ترتيب الدور بين المستخدمين (أول مفتاح = صاحب الدور التالي)
+        self._running = {}  # user_id -> طلبات قيد التنفيذ
+        self._queued_total = 0
+        self._running_total = 0
+        self._orphans = 0  # تحميلات مشتركة غادرها كل منتظريها وما زالت تعمل في المجمع
+        self._seq = 0
+        self._refresh_handle = None
+        self._refreshed_at = 0.0
+        self._save_task = None
+        self._save_seq = 0
+        self._written_seq = 0
+        self._write_lock = threading.Lock()
+    
+    def queued_count(self):
+        return self._queued_total
+    
+    def running_count(self):
+        return self._running_total
+    
+    def orphaned_count(self):
+        return self._orphans
+    
+    def hold_orphan(self):
+        """إبقاء مكان محجوزاً لتحميل يعمل بلا طالب (انتهت مهلة كل منتظريه) حتى لا يتجاوز الحد العام"""
+        self._orphans += 1
+    
+    def release_orphan(self):
+        self._orphans -= 1
+        self._dispatch()
+        self._changed()
+    
+    def _pick(self, pending, turns, loads, capped=True):
+        """الطلب التالي: أعلى أولوية، ثم صاحب أقل طلبات عاملة، ثم صاحب الدور الأقدم"""
+        best = None
+        best_key = None
+        for user_id in turns:
+            jobs = pending.get(user_id)
+            if not jobs:
+                continue
+            load = loads.get(user_id, 0)
+            if capped and load >= self.max_per_user:
+                continue
+            key = (jobs[0].priority, load)
+            if best is None or key < best_key:
+                best, best_key = jobs[0], key
+        return best
+    
+    @staticmethod
+    def _take(pending, turns, job):
+        """إخراج الطلب من رأس طابور صاحبه ونقل المستخدم إلى آخر الدور"""
+        jobs = pending[job.user_id]
+        jobs.pop(0)
+        del turns[job.user_id]
+        if jobs:
+            turns[job.user_id] = True
+        else:
+            del pending[job.user_id]
+    
+    def _dispatch(self):
+        while self._running_total + self._orphans < self.max_concurrent:
+            loads = {user_id: len(jobs) for user_id, jobs in self._running.items()}
+            job = self._pick(self._pending, self._turns, loads)
+            if job is None:
+                break
+            self._take(self._pending, self._turns, job)
+            self._queued_total -= 1
+            self._running.setdefault(job.user_id, []).append(job)
+            self._running_total += 1
+            if not job.future.done():
+                job.future.set_result(None)
+    
+    def queue_order(self):
+        """الطلبات المنتظرة بترتيب التنفيذ المتوقع (تقدير يفترض تفرغ الأماكن تباعاً)
+        
+        نفس قاعدة _pick دون حد المستخدم، بكومة تحوي رأس طابور كل مستخدم بمفتاح
+        (الأولوية، الطلبات العاملة، الدور) فالكلفة O(الطلبات × log المستخدمين).
+        """
+        heap = []
+        for turn, user_id in enumerate(self._turns):
+            jobs = self._pending[user_id]
+            heap.append((jobs[0].priority, len(self._running.get(user_id, ())), turn, user_id, 0))
+        heapq.heapify(heap)
+        turn = len(heap)
+        order = []
+        while heap:
+            _, load, _, user_id, index = heapq.heappop(heap)
+            jobs = self._pending[user_id]
+            order.append(jobs[index])
+            index += 1
+            if index < len(jobs):
+                # المستخدم ينتقل إلى آخر الدور بعد كل طلب
+                heapq.heappush(heap, (jobs[index].priority, load + 1, turn, user_id, index))
+                turn += 1
+        return order
+    
+    async def acquire(self, job):
+        """إضافة الطلب إلى الطابور وانتظار دوره (يعود فوراً إن وُجد مكان شاغر)"""
+        job.future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        job.seq = self._seq
+        jobs = self._pending.setdefault(job.user_id, [])
+        index = len(jobs)
+        while index and jobs[index - 1].priority > job.priority:
+            index -= 1
+        jobs.insert(index, job)
+        self._turns.setdefault(job.user_id, True)
+        self._queued_total += 1
+        self._dispatch()
+        self._changed()
+        if job.future.done():
+            return
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if job.future.cancelled():
+                self._discard(job)
+            else:
+                self.release(job)
+            raise
+        await self._restore_status(job)
+    
+    def release(self, job):
+        """تحرير مكان الطلب عند انتهائه (يُستدعى من finally)"""
+        jobs = self._running.get(job.user_id)
+        if not jobs or job not in jobs:
+            return
+        jobs.remove(job)
+        if not jobs:
+            del self._running[job.user_id]
+        self._running_total -= 1
+        self._dispatch()
+        self._changed()
+    
+    def _discard(self, job):
+        jobs = self._pending.get(job.user_id)
+        if not jobs or job not in jobs:
+            return
+        jobs.remove(job)
+        self._queued_total -= 1
+        if not jobs:
+            del self._pending[job.user_id]
+            self._turns.pop(job.user_id, None)
+        self._changed()
+    
+    def _changed(self):
+        """جدولة تحديث واحد للملف ورسائل الترتيب (لا أكثر من مرة كل status_interval)"""
+        if self._refresh_handle is not None:
+            return
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, self._refreshed_at + self.status_interval - loop.time())
+        self._refresh_handle = loop.call_later(delay, self._refresh)
+    
+    def _refresh(self):
+        self._refresh_handle = None
+        self._refreshed_at = asyncio.get_running_loop().time()
+        order = self.queue_order()
+        self._save(order)
+        if self._report_positions(order):
+            self._changed()
+    
+    def _report_positions(self, order):
+        """تعديل رسائل من تغير ترتيبهم فقط، بحد max_edits للتحديث الواحد (الأقرب للتنفيذ أولاً)
+        
+        يعيد True إن بقيت رسائل لم تُحدث بعد لتُكمل في التحديث التالي.
+        """
+        edits = 0
+        deferred = False
+        for position, job in enumerate(order, 1):
+            if job.message is None or position == job.position:
+                continue
+            if edits >= self.max_edits or (job.status_task is not None and not job.status_task.done()):
+                deferred = True
+                continue
+            edits += 1
+            job.position = position
+            job.status_task = asyncio.get_running_loop().create_task(self._show_position(job, position))
+        return deferred
+    
+    async def _show_position(self, job, position):
+        try:
+            await job.message.edit_text(f"⏳ طلبك في قائمة الانتظار\n📍 ترتيبك: {position}")
+        except TelegramError as e:
+            logger.debug(f"تعذر تحديث ترتيب الانتظار: {e}")
+    
+    async def _restore_status(self, job):
+        """إعادة نص رسالة الحالة الأصلي بعد انتهاء الانتظار"""
+        if job.position is None or not job.status_text:
+            return
+        if job.status_task is not None:
+            await asyncio.gather(job.status_task, return_exceptions=True)
+        try:
+            await job.message.edit_text(job.status_text)
+        except TelegramError as e:
+            logger.debug(f"تعذر تحديث رسالة الحالة: {e}")
+    
+    def _save(self, order):
+        """حفظ الطلبات العاملة والمنتظرة في المنفذ الافتراضي (خارج حلقة الأحداث)"""
+        if not self.queue_file:
+            return
+        jobs = [job.to_dict() for running in self._running.values() for job in running]
+        jobs += [job.to_dict() for job in order]
+        self._save_seq += 1
+        self._save_task = asyncio.get_running_loop().create_task(
+            run_blocking(self._write_queue, jobs, self._save_seq))
+    
+    def _write_queue(self, jobs, seq):
+        """كتابة ذرية عبر ملف مؤقت (نسخة أقدم من آخر ما كُتب تُهمل)"""
+        with self._write_lock:
+            if seq < self._written_seq:
+                return
+            self._written_seq = seq
+            tmp_file = f"{self.queue_file}.tmp"
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(jobs, f, ensure_ascii=False)
+                os.replace(tmp_file, self.queue_file)
+            except OSError as e:
+                logger.warning(f"⚠️ تعذر حفظ طابور التحميل: {e}")
+    
+    def load_interrupted(self):
+        """الطلبات التي قطعتها إعادة التشغيل (تُقرأ مرة واحدة ثم يُفرغ الملف)"""
+        if not self.queue_file or not os.path.exists(self.queue_file):
+            return []
+        try:
+            with open(self.queue_file, 'r', encoding='utf-8') as f:
+                jobs = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ تعذر قراءة طابور التحميل المحفوظ: {e}")
+            jobs = []
+        self._save_seq += 1
+        self._write_queue([], self._save_seq)
+        return [job for job in jobs if isinstance(job, dict) and job.get('chat_id')]
+
+DOWNLOAD_SCHEDULER = DownloadScheduler()
+
+async def notify_interrupted_downloads(application):
+    """إبلاغ أصحاب الطلبات التي قطعتها إعادة التشغيل لإعادة إرسال روابطهم"""
+    jobs = DOWNLOAD_SCHEDULER.load_interrupted()
+    if not jobs:
+        return
+    logger.info(f"⚠️ {len(jobs)} طلب تحميل انقطع بإعادة التشغيل - جاري إبلاغ أصحابها")
+    for job in jobs:
+        text = f"⚠️ أُعيد تشغيل البوت قبل إكمال طلبك\nيرجى إرسال الرابط مرة أخرى:\n{job.get('url', '')}"
+        try:
+            if job.get('message_id'):
+                await application.bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'])
+            else:
+                await application.bot.send_message(job['chat_id'], text)
+        except TelegramError as e:
+            logger.debug(f"تعذر إبلاغ {job['chat_id']} بالطلب المنقطع: {e}")
+
+def collect_scheduler_metrics():
+    """حالة طابور التحميل عند القراءة"""
+    return [
+        ('bot_scheduler_queued_jobs', 'gauge', 'Download jobs waiting for a scheduler slot', (),
+         [((), DOWNLOAD_SCHEDULER.queued_count())]),
+        ('bot_scheduler_running_jobs', 'gauge', 'Download jobs holding a scheduler slot', (),
+         [((), DOWNLOAD_SCHEDULER.running_count())]),
+        ('bot_scheduler_orphaned_jobs', 'gauge', 'Shared downloads still running after all requesters left', (),
+         [((), DOWNLOAD_SCHEDULER.orphaned_count())]),
+    ]
+
+METRICS.add_collector(collect_scheduler_metrics)
+
+# ============================================
+# 🔁 دمج التحميلات المتطابقة (Single-flight)
+# ============================================
+
+# معاملات تتبع ومشاركة لا تغير المحتوى، تُحذف عند توحيد الروابط
+TRACKING_QUERY_PARAMS = {
+    'si', 'feature', 'pp', 'ab_channel', 'igshid', 'igsh', 'fbclid', 'gclid',
+    'is_from_webapp', 'sender_device', 'share_app_id', 'ref', 'ref_src',
+}
+
+def canonical_url(url):
+    """توحيد الرابط ليصلح مفتاحاً: إزالة www/m ومعاملات التتبع والجزء بعد #
+    وتحويل youtu.be و shorts إلى watch?v= وتحويل x.com إلى twitter.com"""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    for prefix in ('www.', 'm.', 'mobile.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    path = parts.path.rstrip('/') or '/'
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in TRACKING_QUERY_PARAMS and not key.startswith('utm_')
+    ]
+    if host == 'youtu.be' or (host == 'youtube.com' and path.startswith('/shorts/')):
+        video_id = path.rsplit('/', 1)[-1]
+        host, path = 'youtube.com', '/watch'
+        query = [('v', video_id)] + [(key, value) for key, value in query if key != 'v']
+    elif host == 'x.com':
+        host = 'twitter.com'
+    return urlunsplit(('https', host, path, urlencode(sorted(query)), ''))
+
+def media_key(kind, url):
+    """مفتاح المحتوى: النوع والجودة المستخدمة والرابط الموحد"""
+    return f"{kind}|{downloader.quality_key(kind)}|{canonical_url(url)}"
+
+METRIC_COALESCED_DOWNLOADS = METRICS.counter(
+    'bot_coalesced_downloads_total', 'Download requests served by an identical in-flight download', ('kind',))
+
+class _DownloadFlight:
+    """تحميل واحد جارٍ ومن ينتظر نتيجته"""
+    
+    __slots__ = ('task', 'timer', 'waiters', 'handed_over', 'orphaned')
+    
+    def __init__(self, timer):
+        self.task = None
+        self.timer = timer  # مؤقت التحميل نفسه، يتقاسمه المنتظرون عند انتهائه
+        self.waiters = 0
+        self.handed_over = False  # الملف الأصلي سُلم لآخر المنتظرين
+        self.orphaned = False  # يشغل مكاناً في الطابور بعد مغادرة كل المنتظرين
+
+class DownloadCoalescer:
+    """تحميل واحد لكل (رابط موحد، نوع، جودة) مهما تعدد الطالبون في نفس اللحظة
+    
+    أول طلب يبدأ التحميل في مهمة مستقلة، والطلبات المتطابقة المتزامنة تنتظر نفس
+    المهمة، لذا لا تلغي مهلة أحدهم التحميل على الباقين. كل طالب يحصل على مسار
+    خاص به (رابط صلب، أو نسخة إن تعذر) فيحذفه بعد الإرسال دون أن يمس ملفات غيره،
+    وآخر المنتظرين يأخذ الملف الأصلي نفسه. إن غادر كل المنتظرين قبل انتهاء
+    التحميل يبقى محسوباً في الحد العام للطابور حتى ينتهي فعلاً.
+    """
+    
+    def __init__(self, scheduler=DOWNLOAD_SCHEDULER):
+        self.scheduler = scheduler
+        self._flights = {}
+        self._claims = 0
+    
+    def in_flight(self):
+        return len(self._flights)
+    
+    async def fetch(self, kind, func, url, pool=None, timer=None, **kwargs):
+        """تشغيل func(url, **kwargs) في المجمع pool أو الانضمام لتحميل مطابق جارٍ، ويعيد (مسار خاص، العنوان)
+        
+        التحميل يعمل بمؤقت خاص به، ويُحتسب لمؤقت كل طالب زمن انتظاره موزعاً على مراحله.
+        """
+        key = media_key(kind, url)
+        flight = self._flights.get(key)
+        if flight is None and MEDIA_CACHE.enabled and kind in MEDIA_CACHE_KINDS:
+            cached = await run_blocking(MEDIA_CACHE.checkout, key)
+            if cached is not None:
+                logger.info(f"💾 من ذاكرة الوسائط ({kind}): {url[:50]}")
+                return cached
+            flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _DownloadFlight(DownloadPhaseTimer(None) if timer else None)
+            if timer:
+                kwargs['timer'] = flight.timer
+            flight.task = asyncio.get_running_loop().create_task(self._download(kind, key, func, url, pool, kwargs))
+            flight.task.add_done_callback(lambda _, key=key, flight=flight: self._landed(key, flight))
+        else:
+            METRIC_COALESCED_DOWNLOADS.inc(kind)
+            logger.info(f"🔁 طلب مطابق لتحميل جارٍ ({kind}): {url[:50]}")
+            if flight.orphaned:
+                # الطالب الجديد يحمل مكاناً في الطابور فيحرر المكان المحجوز للتحميل
+                flight.orphaned = False
+                self.scheduler.release_orphan()
+        flight.waiters += 1
+        joined = time.perf_counter()
+        try:
+            filename, title = await asyncio.shield(flight.task)
+        except BaseException:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.orphaned = True
+                self.scheduler.hold_orphan()
+            self._cleanup(flight)
+            raise
+        finally:
+            if timer and flight.timer:
+                timer.share(flight.timer, joined)
+        flight.waiters -= 1
+        if flight.waiters == 0:
+            flight.handed_over = True
+            return filename, title
+        return self._claim(filename), title
+    
+    async def _download(self, kind, key, func, url, pool, kwargs):
+        try:
+            filename, title = await run_blocking(func, url, pool=pool, **kwargs)
+        finally:
+            if kwargs.get('timer'):
+                kwargs['timer'].pause()
+        if MEDIA_CACHE.enabled and kind in MEDIA_CACHE_KINDS:
+            try:
+                await run_blocking(MEDIA_CACHE.publish, key, filename, title)
+            except OSError as e:
+                logger.warning(f"⚠️ تعذر حفظ الملف في ذاكرة الوسائط: {e}")
+        return filename, title
+    
+    def _claim(self, filename):
+        """مسار خاص بالطالب يشير لنفس المحتوى"""
+        self._claims += 1
+        base, ext = os.path.splitext(filename)
+        path = f"{base}.{self._claims}{ext}"
+        try:
+            os.link(filename, path)
+        except OSError:
+            shutil.copyfile(filename, path)
+        return path
+    
+    def _landed(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if flight.orphaned:
+            flight.orphaned = False
+            self.scheduler.release_orphan()
+        self._cleanup(flight)
+    
+    def _cleanup(self, flight):
+        """حذف الملف الأصلي إن انتهى التحميل ولم يبق من ينتظره (مثلاً انتهت مهلة الجميع)"""
+        if flight.waiters or flight.handed_over or not flight.task.done():
+            return
+        if flight.task.cancelled() or flight.task.exception() is not None:
+            return
+        filename = flight.task.result()[0]
+        if filename and os.path.exists(filename):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+DOWNLOADS_IN_FLIGHT = DownloadCoalescer()
+
+class DeferredSave:
+    """تجميع طلبات الحفظ المتتالية في كتابة واحدة بعد مهلة قصيرة
+    
+    request() لا يكتب شيئاً: يشغل مؤقتاً (threading.Timer) إن لم يكن هناك واحد
+    ينتظر، فتُكتب كل التغييرات التي وصلت خلال المهلة مرة واحدة على خيط المؤقت
+    بعيداً عن حلقة الأحداث. flush() يكتب فوراً ما ينتظر (ويُستدعى عند الخروج).
+    """
+    
+    def __init__(self, save, interval=CACHE_SAVE_INTERVAL):
+        self._save = save
+        self.interval = interval
+        self._timer = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        atexit.register(self.flush)
+    
+    def request(self):
+        with self._lock:
+            self._dirty = True
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(max(0.0, self.interval), self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                timer, self._timer = self._timer, None
+                dirty, self._dirty = self._dirty, False
+            if timer is not None and timer is not threading.current_thread():
+                timer.cancel()
+            if dirty:
+                self._save()
+
+# ============================================
+# 💾 ذاكرة الوسائط على القرص (Media Cache)
+# ============================================
+
+# الأنواع التي يُحتفظ بملفاتها (محتوى القصص يتغير مع الوقت)
+MEDIA_CACHE_KINDS = ('video', 'audio', 'image')
+
+class MediaCache:
+    """مجلد ملفات محملة بحد أقصى للحجم وإخلاء الأقدم استخداماً (LRU)
+    
+    الملف يُنشر ذرياً (رابط صلب أو نسخة باسم مؤقت ثم إعادة تسمية)، والفهرس
+    (مفتاح -> اسم الملف والعنوان والحجم) يُحفظ في index.json فيبقى بعد إعادة
+    التشغيل. كل طالب يأخذ رابطاً صلباً خاصاً به في مجلد التحميلات فيحذفه بعد
+    الإرسال دون أن يمس الملف المخزن. يُستدعى من خيوط المنفذ لذا العمليات تحت قفل،
+    والفهرس يُكتب مؤجلاً خارج القفل عبر DeferredSave.
+    """
+    
+    # أسماء الملفات التي تنشئها الذاكرة: sha1 للمفتاح مع الامتداد، أو اسم النشر المؤقت
+    FILE_NAME = re.compile(r'^(?:[0-9a-f]{40}(?:\.[^.]+)?|\..+\.tmp)$')
+    
+    def __init__(self, directory=MEDIA_CACHE_DIR, max_bytes=MEDIA_CACHE_MAX_MB * 1024 * 1024,
+                 save_interval=CACHE_SAVE_INTERVAL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'index.json') if directory else ''
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._checkouts = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._saver = DeferredSave(self._save_index, save_interval) if directory else None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+    
+    @property
+    def enabled(self):
+        return bool(self.directory)
+    
+    def _load(self):
+        entries = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"⚠️ تعذر قراءة فهرس ذاكرة الوسائط: {e}")
+        if not isinstance(entries, dict):
+            logger.warning(f"⚠️ فهرس ذاكرة الوسائط بصيغة غير متوقعة ({type(entries).__name__}) - سيُتجاهل")
+            entries = {}
+        valid = [(key, entry) for key, entry in entries.items() if isinstance(entry, dict)]
+        for key, entry in sorted(valid, key=lambda item: item[1].get('used', 0)):
+            path = os.path.join(self.directory, entry.get('file', ''))
+            if entry.get('file') and os.path.isfile(path):
+                entry['size'] = os.path.getsize(path)
+                self._entries[key] = entry
+                self._bytes += entry['size']
+        # حذف ملفات الذاكرة المؤقتة أو غير المفهرسة فقط (عملية نشر انقطعت مثلاً)،
+        # أما ما وضعه غيرها في المجلد فيبقى كما هو
+        known = {entry['file'] for entry in self._entries.values()}
+        for name in os.listdir(self.directory):
+            if name not in known and self.FILE_NAME.match(name):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        self._evict()
+        logger.info(f"💾 ذاكرة الوسائط: {len(self._entries)} ملف ({self._bytes / (1024*1024):.1f} MB)")
+    
+    def _save_index(self):
+        with self._lock:
+            entries = {key: dict(entry) for key, entry in self._entries.items()}
+        tmp_file = f"{self.index_path}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_file, self.index_path)
+        except OSError as e:
+            logger.warning(f"⚠️ تعذر حفظ فهرس ذاكرة الوسائط: {e}")
+    
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry['size']
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+    
+    def checkout(self, key, folder=DOWNLOAD_FOLDER):
+        """نسخة خاصة من الملف المخزن في مجلد التحميلات: (المسار، العنوان) أو None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._checkouts += 1
+            base, ext = os.path.splitext(entry['name'])
+            path = os.path.join(folder, f"{base}.cache{self._checkouts}{ext}")
+            source = os.path.join(self.directory, entry['file'])
+            try:
+                try:
+                    os.link(source, path)
+                except OSError:
+                    shutil.copyfile(source, path)
+            except OSError as e:
+                logger.warning(f"⚠️ ملف مفقود من ذاكرة الوسائط: {e}")
+                del self._entries[key]
+                self._bytes -= entry['size']
+                self.misses += 1
+                self._saver.request()
+                return None
+            self.hits += 1
+            entry['used'] = time.time()
+            self._entries.move_to_end(key)
+        self._saver.request()
+        return path, entry['title']
+    
+    def publish(self, key, filename, title):
+        """إضافة ملف محمل إلى الذاكرة (اسم مؤقت ثم إعادة تسمية ذرية)"""
+        size = os.path.getsize(filename)
+        if size > self.max_bytes:
+            return
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + os.path.splitext(filename)[1]
+        path = os.path.join(self.directory, name)
+        tmp_file = os.path.join(self.directory, f".{name}.tmp")
+        try:
+            os.link(filename, tmp_file)
+        except OSError:
+            shutil.copyfile(filename, tmp_file)
+        with self._lock:
+            os.replace(tmp_file, path)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous['size']
+            self._entries[key] = {
+                'file': name, 'name': os.path.basename(filename), 'title': title,
+                'size': size, 'used': time.time(),
+            }
+            self._bytes += size
+            self._evict()
+        self._saver.request()
+    
+    def flush(self):
+        """كتابة الفهرس المؤجل فوراً"""
+        if self._saver is not None:
+            self._saver.flush()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            }
+
+MEDIA_CACHE = MediaCache()
+
+def collect_media_cache_metrics():
+    """إحصائيات ذاكرة الوسائط عند القراءة"""
+    if not MEDIA_CACHE.enabled:
+        return []
+    cache = MEDIA_CACHE.stats()
+    return [
+        ('bot_media_cache_bytes', 'gauge', 'Bytes stored in the media cache', (), [((), cache['bytes'])]),
+        ('bot_media_cache_entries', 'gauge', 'Files stored in the media cache', (), [((), cache['entries'])]),
+        ('bot_media_cache_events_total', 'counter', 'Media cache hits, misses and evictions', ('event',),
+         [(('hit',), cache['hits']), (('miss',), cache['misses']), (('eviction',), cache['evictions'])]),
+    ]
+
+METRICS.add_collector(collect_media_cache_metrics)
+
+# ============================================
+# 🗂️ ذاكرة معلومات الروابط (Metadata Cache)
+# ============================================
+
+METRIC_METADATA_CACHE = METRICS.counter(
+    'bot_metadata_cache_requests_total', 'Metadata cache lookups by result', ('result',))
+
+def summarize_info(info):
+    """الحقول التي نعرضها أو نحتاجها قبل التحميل فقط من نتيجة extract_info (بدون قوائم الصيغ الكاملة)"""
+    formats = info.get('formats') or []
+    heights = [f['height'] for f in formats if f.get('height')]
+    # ما تختاره صيغة الفيديو best[ext=mp4]: آخر صيغة mp4 تجمع الصورة والصوت (القائمة مرتبة تصاعدياً)
+    progressive = [
+        f for f in formats
+        if f.get('ext') == 'mp4' and f.get('vcodec') not in (None, 'none') and f.get('acodec') not in (None, 'none')
+    ]
+    best_mp4 = progressive[-1] if progressive else {}
+    summary = {
+        'title': info.get('title') or info.get('webpage_title'),
+        'uploader': info.get('uploader') or info.get('channel') or info.get('creator'),
+        'duration': info.get('duration'),
+        'view_count': info.get('view_count'),
+        'like_count': info.get('like_count'),
+        'extractor': (info.get('extractor_key') or info.get('extractor') or '').lower(),
+        'formats': {
+            'count': len(formats),
+            'max_height': max(heights) if heights else None,
+            'mp4_filesize': best_mp4.get('filesize') or best_mp4.get('filesize_approx'),
+        },
+    }
+    return {key: value for key, value in summary.items() if value is not None}
+
+class MetadataCache:
+    """ملخصات get_info بمفتاح الرابط الموحد، في الذاكرة وعلى القرص
+    
+    عمر كل مدخل حسب المنصة (METADATA_CACHE_TTLS) والأقدم استخداماً يُحذف عند
+    تجاوز الحد. تُكتب من خيوط المنفذ وتُقرأ من حلقة الأحداث لذا العمليات تحت قفل،
+    أما الملف فيُكتب مؤجلاً خارج القفل عبر DeferredSave.
+    """
+    
+    def __init__(self, path=METADATA_CACHE_FILE, ttls=None, default_ttl=METADATA_CACHE_TTL,
+                 max_entries=METADATA_CACHE_MAX_ENTRIES, save_interval=CACHE_SAVE_INTERVAL):
+        self.path = path
+        self.ttls = METADATA_CACHE_TTLS if ttls is None else ttls
+        self.default_ttl = default_ttl
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._saver = DeferredSave(self._save, save_interval) if path else None
+        self._load()
+    
+    def ttl_for(self, extractor):
+        for name, ttl in self.ttls.items():
+            if extractor.startswith(name):
+                return ttl
+        return self.default_ttl
+    
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ تعذر قراءة ذاكرة المعلومات: {e}")
+            return
+        if not isinstance(entries, dict):
+            logger.warning(f"⚠️ ملف ذاكرة المعلومات بصيغة غير متوقعة ({type(entries).__name__}) - سيُتجاهل")
+            return
+        now = time.time()
+        for key, entry in entries.items():
+            if isinstance(entry, dict) and 'info' in entry and entry.get('expires', 0) > now:
+                self._entries[key] = entry
+    
+    def _save(self):
+        with self._lock:
+            entries = dict(self._entries)
+        tmp_file = f"{self.path}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            logger.warning(f"⚠️ تعذر حفظ ذاكرة المعلومات: {e}")
+    
+    def get(self, url, record=True):
+        """الملخص المخزن أو None؛ record=False لفحوص ما قبل التحميل (دون عدها في المقاييس)"""
+        key = canonical_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires'] <= time.time():
+                del self._entries[key]
+                entry = None
+            if record:
+                METRIC_METADATA_CACHE.inc('hit' if entry is not None else 'miss')
+                if entry is not None:
+                    self._entries.move_to_end(key)
+            return entry['info'] if entry is not None else None
+    
+    def put(self, url, summary):
+        key = canonical_url(url)
+        with self._lock:
+            self._entries[key] = {
+                'info': summary,
+                'expires': time.time() + self.ttl_for(summary.get('extractor', '')),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self._saver is not None:
+            self._saver.request()
+    
+    def flush(self):
+        """كتابة التغييرات المؤجلة فوراً"""
+        if self._saver is not None:
+            self._saver.flush()
+
+METADATA_CACHE = MetadataCache()
+
+# ============================================
+# 📎 ذاكرة file_id للملفات المرسلة (Telegram File Cache)
+# ============================================
+
+METRIC_FILE_ID_CACHE = METRICS.counter(
+    'bot_file_id_cache_requests_total', 'Telegram file_id cache lookups by result', ('result',))
+
+class TelegramFileCache:
+    """فهرس دائم: (رابط موحد، نوع، جودة) -> file_id آخر رفع ناجح
+    
+    المدخلات مرتبة من الأقدم استخداماً للأحدث (LRU) ولكل منها عمر أقصى، ويُحذف
+    المدخل إن رفض Telegram المعرف. تُستخدم من حلقة الأحداث والملف يُكتب مؤجلاً
+    على خيط DeferredSave لذا العمليات تحت قفل.
+    """
+    
+    def __init__(self, path=FILE_ID_CACHE_FILE, ttl_days=FILE_ID_CACHE_TTL_DAYS,
+                 max_entries=FILE_ID_CACHE_MAX_ENTRIES, save_interval=CACHE_SAVE_INTERVAL):
+        self.path = path
+        self.ttl = ttl_days * 86400
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._saver = DeferredSave(self._save, save_interval) if path else None
+        self._load()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ تعذر قراءة ذاكرة file_id: {e}")
+            return
+        if not isinstance(entries, dict):
+            logger.warning(f"⚠️ ملف ذاكرة file_id بصيغة غير متوقعة ({type(entries).__name__}) - سيُتجاهل")
+            return
+        valid = [
+            (key, entry) for key, entry in entries.items()
+            if isinstance(entry, dict) and entry.get('file_id') and entry.get('media') in CACHED_MEDIA_SENDERS
+        ]
+        for key, entry in sorted(valid, key=lambda item: item[1].get('used', 0)):
+            self._entries[key] = entry
+    
+    def _save(self):
+        with self._lock:
+            entries = {key: dict(entry) for key, entry in self._entries.items()}
+        tmp_file = f"{self.path}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            logger.warning(f"⚠️ تعذر حفظ ذاكرة file_id: {e}")
+    
+    def flush(self):
+        """كتابة التغييرات المؤجلة فوراً"""
+        if self._saver is not None:
+            self._saver.flush()
+    
+    def get(self, kind, url):
+        if not self.path:
+            return None
+        key = media_key(kind, url)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry['at'] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                entry['used'] = now
+                self._entries.move_to_end(key)
+                entry = dict(entry)
+        if entry is None:
+            METRIC_FILE_ID_CACHE.inc('miss')
+            return None
+        METRIC_FILE_ID_CACHE.inc('hit')
+        self._saver.request()
+        return entry
+    
+    def remember(self, kind, url, sent, title):
+        """تسجيل file_id من رسالة Telegram المرسلة (فيديو، صوت، صورة أو مستند)"""
+        if not self.path or sent is None:
+            return
+        if getattr(sent, 'video', None):
+            media, file_id = 'video', sent.video.file_id
+        elif getattr(sent, 'audio', None):
+            media, file_id = 'audio', sent.audio.file_id
+        elif getattr(sent, 'photo', None):
+            media, file_id = 'photo', sent.photo[-1].file_id
+        elif getattr(sent, 'document', None):
+            media, file_id = 'document', sent.document.file_id
+        else:
+            return
+        now = time.time()
+        key = media_key(kind, url)
+        with self._lock:
+            self._entries[key] = {'file_id': file_id, 'media': media, 'title': title, 'at': now, 'used': now}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self._saver.request()
+    
+    def invalidate(self, kind, url):
+        with self._lock:
+            removed = self._entries.pop(media_key(kind, url), None)
+        if removed is not None:
+            METRIC_FILE_ID_CACHE.inc('stale')
+            self._saver.request()
+
+# نوع Telegram للملف المرسل -> (دالة الرد، اسم وسيط الملف)
+CACHED_MEDIA_SENDERS = {
+    'video': ('reply_video', 'video'),
+    'audio': ('reply_audio', 'audio'),
+    'photo': ('reply_photo', 'photo'),
+    'document': ('reply_document', 'document'),
+}
+
+# النوع الذي يرفعه كل معالج عادةً؛ الخيارات الخاصة (مثل performer للصوت) تُمرر له فقط
+CACHED_MEDIA_FOR_KIND = {'video': 'video', 'audio': 'audio', 'image': 'photo'}
+
+# أجزاء رسائل BadRequest التي تعني أن المعرف نفسه مرفوض (غيرها لا يبطل المدخل)
+FILE_ID_ERRORS = ('file identifier', 'file_id', 'file reference', 'type of file mismatch', 'wrong remote file')
+
+TELEGRAM_FILE_CACHE = TelegramFileCache()
+
+async def send_cached_file(kind, url, message, caption, **options):
+    """إعادة إرسال ملف مخزن بدالة الرد التي تناسب نوعه المحفوظ (entry['media'])
+    
+    caption دالة تأخذ العنوان المخزن، وoptions خاصة بالنوع الذي يرفعه المعالج
+    عادةً فتُهمل إن كان المدخل مستنداً مثلاً. يعيد المدخل عند النجاح أو None
+    ليكمل المعالج التحميل.
+    """
+    entry = TELEGRAM_FILE_CACHE.get(kind, url)
+    if entry is None:
+        return None
+    method, argument = CACHED_MEDIA_SENDERS[entry['media']]
+    kwargs = {argument: entry['file_id'], 'caption': caption(entry['title'])}
+    if entry['media'] == 'audio':
+        kwargs['title'] = entry['title']
+    if entry['media'] == CACHED_MEDIA_FOR_KIND.get(kind):
+        kwargs.update(options)
+    try:
+        await getattr(message, method)(**kwargs)
+    except BadRequest as e:
+        if any(part in str(e).lower() for part in FILE_ID_ERRORS):
+            logger.info(f"♻️ file_id مرفوض ({kind}) - سيُعاد التحميل: {e}")
+            TELEGRAM_FILE_CACHE.invalidate(kind, url)
+        else:
+            logger.warning(f"⚠️ فشل إرسال file_id المخزن ({kind}): {e}")
+        return None
+    except TelegramError as e:
+        logger.warning(f"⚠️ فشل إرسال file_id المخزن ({kind}): {e}")
+        return None
+    logger.info(f"📎 إرسال من ذاكرة file_id ({kind}): {url[:50]}")
+    return entry
+
+# ============================================
+# 📊 نظام الإحصائيات المتقدم (Advanced Stats System)
+# ============================================
+
+ID_SET_PREFIX = "dv1:"
+
+def encode_id_set(ids):
+    """ترميز مجموعة معرفات رقمية كنص مضغوط: فروق متتالية مرتبة بترميز varint ثم base64"""
+    out = bytearray()
+    previous = 0
+    for value in sorted(ids):
+        delta = value - previous
+        previous = value
+        while delta >= 0x80:
+            out.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return ID_SET_PREFIX + base64.b64encode(bytes(out)).decode('ascii')
+
+def decode_id_set(value):
+    """فك ترميز مجموعة المعرفات (يدعم أيضاً القوائم القديمة في ملف JSON)"""
+    if isinstance(value, (set, frozenset)):
+        return set(value)
+    if isinstance(value, list):
+        ids = set()
+        for item in value:
+            try:
+                ids.add(int(item))
+            except (TypeError, ValueError):
+                continue
+        return ids
+    if not isinstance(value, str) or not value.startswith(ID_SET_PREFIX):
+        return set()
+    
+    ids = set()
+    current = 0
+    delta = 0
+    shift = 0
+    for byte in base64.b64decode(value[len(ID_SET_PREFIX):]):
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        current += delta
+        ids.add(current)
+        delta = 0
+        shift = 0
+    return ids
+
+def stats_json_default(value):
+    """تحويل البنى الداخلية (مثل مجموعات المعرفات) عند كتابة JSON"""
+    if isinstance(value, (set, frozenset)):
+        return encode_id_set(value)
+    if isinstance(value, UserTable):
+        # قواميس عادية مباشرة فلا يُستدعى هذا الخطاف مرة لكل سجل
+        return {user_id: record.to_dict() for user_id, record in value.items()}
+    if isinstance(value, UserRecord):
+        return value.to_dict()
+    if isinstance(value, HyperLogLog):
+        return value.encode()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+ROLLUP_FIELDS = ('downloads', 'searches', 'new_users', 'failed')
+
+def week_key(day):
+    """مفتاح الأسبوع بصيغة ISO مثل 2025-W07"""
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+def week_bounds(key):
+    """أول وآخر يوم في أسبوع ISO"""
+    year, week = key.split('-W')
+    start = date.fromisocalendar(int(year), int(week), 1)
+    return start, start + timedelta(days=6)
+
+def month_bounds(key):
+    """أول وآخر يوم في شهر بصيغة YYYY-MM"""
+    year, month = (int(part) for part in key.split('-'))
+    start = date(year, month, 1)
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    return start, next_month - timedelta(days=1)
+
+def merge_active_sketch(target, sketch, days):
+    """إضافة ملخص المستخدمين الفريدين لعدد من الأيام إلى تجميع (sketch_days < days يعني تجميعاً ناقصاً)"""
+    merged = merge_sketches([target.get('active_sketch'), sketch])
+    if merged is not None:
+        target['active_sketch'] = merged.encode()
+        target['sketch_days'] = target.get('sketch_days', 0) + days
+    return target
+
+def merge_rollup(target, entry):
+    """إضافة مدخل يومي أو أسبوعي إلى تجميع أكبر"""
+    for field in ROLLUP_FIELDS:
+        target[field] = target.get(field, 0) + entry.get(field, 0)
+    if 'active_user_days' in entry:
+        active_days = entry['active_user_days']
+        peak = entry.get('peak_active_users', 0)
+        days = entry.get('days', 0)
+    else:
+        active_days = peak = entry.get('active_users', 0)
+        days = 1
+    target['active_user_days'] = target.get('active_user_days', 0) + active_days
+    target['peak_active_users'] = max(target.get('peak_active_users', 0), peak)
+    target['days'] = target.get('days', 0) + days
+    return target
+
+def prorate_rollup(entry, fraction):
+    """جزء من تجميع بنسبة من أيامه بافتراض توزيع منتظم عليها (أعداد عشرية)
+    
+    ذروة المستخدمين النشطين لا تتجزأ فتبقى ذروة التجميع كله (حد أعلى للجزء).
+    """
+    part = merge_rollup({}, entry)
+    for field in ROLLUP_FIELDS + ('active_user_days', 'days'):
+        part[field] *= fraction
+    return part
+
+def split_week_by_month(week_start, entry):
+    """أجزاء تجميع أسبوع حسب عدد أيامه في كل شهر: [(الشهر، الجزء، أيام الملخص)]
+    
+    الأعداد تبقى صحيحة ومجموع الأجزاء يساوي الأصل (الجزء الأول مقرّب والباقي للثاني).
+    """
+    months = {}
+    for offset in range(7):
+        month = (week_start + timedelta(days=offset)).strftime('%Y-%m')
+        months[month] = months.get(month, 0) + 1
+    whole = merge_rollup({}, entry)
+    sketch_days = entry.get('sketch_days', 0)
+    if len(months) == 1:
+        return [(next(iter(months)), whole, sketch_days)]
+    (first_month, first_days), (second_month, _) = months.items()
+    first = prorate_rollup(entry, first_days / 7)
+    second = dict(whole)
+    for field in ROLLUP_FIELDS + ('active_user_days', 'days'):
+        first[field] = round(first[field])
+        second[field] = whole[field] - first[field]
+    first_sketch_days = round(sketch_days * first_days / 7)
+    return [(first_month, first, first_sketch_days), (second_month, second, sketch_days - first_sketch_days)]
+
+class StatsChanges:
+    """المفاتيح التي تغيرت منذ آخر حفظ - تسمح للمخازن بكتابة الصفوف المعدلة فقط"""
+    
+    __slots__ = ('full', 'users', 'days', 'terms', 'active')
+    
+    def __init__(self, full=False):
+        self.full = full
+        self.users = set()
+        self.days = set()
+        self.terms = set()
+        self.active = set()
+    
+    def merge(self, other):
+        self.full = self.full or other.full
+        self.users |= other.users
+        self.days |= other.days
+        self.terms |= other.terms
+        self.active |= other.active
+
+class JsonStatsBackend:
+    """تخزين الإحصائيات في ملف JSON واحد (يُعاد كتابته بالكامل عند كل حفظ)"""
+    
+    name = 'json'
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def prepare(self, data, changes):
+        return json.dumps(data, ensure_ascii=False, indent=2, default=stats_json_default).encode('utf-8')
+    
+    def record(self, event):
+        pass
+    
+    def pending_events(self):
+        return []
+    
+    def commit(self, payload):
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_file, self.path)
+        return len(payload)
+    
+    def close(self):
+        pass
+
+class SQLiteStatsBackend:
+    """تخزين الإحصائيات في SQLite (وضع WAL) - كل تغيير يصبح UPSERT صغيراً"""
+    
+    name = 'sqlite'
+    
+    SECTION_KEYS = ('users', 'daily_stats', 'search_terms', 'platforms')
+    USER_FIELDS = (
+        'name', 'username', 'first_seen', 'join_date', 'last_seen',
+        'usage_count', 'download_count', 'search_count', 'failed_count', 'is_active'
+    )
+    DAY_FIELDS = ('downloads', 'searches', 'new_users', 'active_users', 'failed')
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            name TEXT,
+            username TEXT,
+            first_seen TEXT,
+            join_date TEXT,
+            last_seen TEXT,
+            usage_count INTEGER NOT NULL DEFAULT 0,
+            download_count INTEGER NOT NULL DEFAULT 0,
+            search_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            is_active INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_usage ON users(usage_count DESC);
+        CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen);
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            downloads INTEGER NOT NULL DEFAULT 0,
+            searches INTEGER NOT NULL DEFAULT 0,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            day TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS search_terms (
+            term TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_terms_count ON search_terms(count DESC);
+        CREATE TABLE IF NOT EXISTS platforms (
+            platform TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        );
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+    
+    def load(self):
+        return self.read_tables(self._conn)
+    
+    @classmethod
+    def read_tables(cls, conn):
+        """بناء بيانات الإحصائيات من جداول اتصال مفتوح"""
+        meta = conn.execute("SELECT key, value FROM meta").fetchall()
+        if not meta:
+            return None
+        
+        data = {key: json.loads(value) for key, value in meta}
+        
+        users = {}
+        columns = ', '.join(cls.USER_FIELDS)
+        for row in conn.execute(f"SELECT user_id, {columns} FROM users"):
+            record = dict(zip(cls.USER_FIELDS, row[1:]))
+            record['is_active'] = bool(record['is_active'])
+            users[row[0]] = record
+        data['users'] = users
+        
+        daily_stats = {}
+        columns = ', '.join(cls.DAY_FIELDS)
+        for row in conn.execute(f"SELECT day, {columns} FROM daily_stats"):
+            entry = dict(zip(cls.DAY_FIELDS, row[1:]))
+            entry['active_user_ids'] = set()
+            daily_stats[row[0]] = entry
+        for day, user_id in conn.execute("SELECT day, user_id FROM daily_active_users"):
+            if day in daily_stats:
+                daily_stats[day]['active_user_ids'].add(int(user_id))
+        data['daily_stats'] = daily_stats
+        
+        data['search_terms'] = dict(conn.execute("SELECT term, count FROM search_terms"))
+        data['platforms'] = dict(conn.execute("SELECT platform, count FROM platforms"))
+        return data
+    
+    @classmethod
+    def read_only(cls, path):
+        """قراءة قاعدة عملية أخرى دون إنشاء الجداول أو تغيير وضع السجل (None إن لم تُنشأ بعد)"""
+        if not os.path.exists(path):
+            return None
+        conn = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True)
+        try:
+            return cls.read_tables(conn)
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                return None
+            raise
+        finally:
+            conn.close()
+    
+    def record(self, event):
+        pass
+    
+    def pending_events(self):
+        return []
+    
+    def prepare(self, data, changes):
+        """التقاط الصفوف المعدلة (من خيط الإحصائيات أو تحت قفلها)"""
+        users = data.get('users', {})
+        daily_stats = data.get('daily_stats', {})
+        search_terms = data.get('search_terms', {})
+        
+        if changes.full:
+            user_ids = users.keys()
+            days = daily_stats.keys()
+            terms = search_terms.keys()
+            active = [
+                (day, str(user_id))
+                for day, entry in daily_stats.items()
+                for user_id in entry.get('active_user_ids', [])
+            ]
+        else:
+            user_ids, days, terms, active = changes.users, changes.days, changes.terms, changes.active
+        
+        return {
+            'full': changes.full,
+            'meta': [
+                (key, json.dumps(value, ensure_ascii=False))
+                for key, value in data.items() if key not in self.SECTION_KEYS
+            ],
+            'users': [
+                (user_id, *[users[user_id].get(field) for field in self.USER_FIELDS])
+                for user_id in user_ids if user_id in users
+            ],
+            'days': [
+                (day, *[daily_stats[day].get(field, 0) for field in self.DAY_FIELDS])
+                for day in days if day in daily_stats
+            ],
+            'deleted_days': [(day,) for day in days if day not in daily_stats],
+            'active': [pair for pair in active if pair[0] in daily_stats],
+            'terms': [(term, search_terms[term]) for term in terms if term in search_terms],
+            'deleted_terms': [(term,) for term in terms if term not in search_terms],
+            'platforms': list(data.get('platforms', {}).items()),
+        }
+    
+    def commit(self, payload):
+        conn = self._conn
+        user_columns = ', '.join(self.USER_FIELDS)
+        user_updates = ', '.join(f"{field}=excluded.{field}" for field in self.USER_FIELDS)
+        day_columns = ', '.join(self.DAY_FIELDS)
+        day_updates = ', '.join(f"{field}=excluded.{field}" for field in self.DAY_FIELDS)
+        
+        conn.execute("BEGIN")
+        try:
+            if payload['full']:
+                for table in ('meta', 'users', 'daily_stats', 'daily_active_users', 'search_terms', 'platforms'):
+                    conn.execute(f"DELETE FROM {table}")
+            conn.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                payload['meta']
+            )
+            conn.executemany(
+                f"INSERT INTO users (user_id, {user_columns}) VALUES (?{', ?' * len(self.USER_FIELDS)}) "
+                f"ON CONFLICT(user_id) DO UPDATE SET {user_updates}",
+                payload['users']
+            )
+            conn.executemany(
+                f"INSERT INTO daily_stats (day, {day_columns}) VALUES (?{', ?' * len(self.DAY_FIELDS)}) "
+                f"ON CONFLICT(day) DO UPDATE SET {day_updates}",
+                payload['days']
+            )
+            # الأيام التي دخلت في التجميعات الأسبوعية تُحذف من الجداول اليومية
+            conn.executemany("DELETE FROM daily_stats WHERE day = ?", payload['deleted_days'])
+            conn.executemany("DELETE FROM daily_active_users WHERE day = ?", payload['deleted_days'])
+            conn.executemany(
+                "INSERT OR IGNORE INTO daily_active_users (day, user_id) VALUES (?, ?)",
+                payload['active']
+            )
+            conn.executemany(
+                "INSERT INTO search_terms (term, count) VALUES (?, ?) "
+                "ON CONFLICT(term) DO UPDATE SET count=excluded.count",
+                payload['terms']
+            )
+            conn.executemany("DELETE FROM search_terms WHERE term = ?", payload['deleted_terms'])
+            conn.executemany(
+                "INSERT INTO platforms (platform, count) VALUES (?, ?) "
+                "ON CONFLICT(platform) DO UPDATE SET count=excluded.count",
+                payload['platforms']
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        
+        # حجم تقريبي للبيانات المكتوبة (قيم الصفوف فقط)
+        return sum(
+            len(str(value))
+            for key in ('meta', 'users', 'days', 'active', 'terms', 'platforms')
+            for row in payload[key]
+            for value in row
+        )
+    
+    def close(self):
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+
+class StatsRecoveryError(RuntimeError):
+    """لقطة الإحصائيات تالفة ولا توجد لقطة سابقة سليمة يُعاد عليها سجل الأحداث"""
+
+class JournalStatsBackend:
+    """سجل أحداث إلحاقي (سطر مضغوط لكل حدث) مع لقطة JSON دورية تُضغط فيها الأحداث
+    
+    عند كل لقطة جديدة تبقى السابقة (.prev) مع أحداث السجل التي دخلت بينهما (.journal.prev)،
+    فإن تلفت اللقطة الحالية تُستعاد الإحصائيات من السابقة بإعادة كل ما بعدها من أحداث.
+    """
+    
+    name = 'journal'
+    
+    def __init__(self, snapshot_path, journal_path=None,
+                 compact_events=STATS_JOURNAL_COMPACT_EVENTS, compact_seconds=STATS_JOURNAL_COMPACT_SECONDS):
+        self.path = snapshot_path
+        self.journal_path = journal_path or f"{snapshot_path}.journal"
+        self.rotated_path = f"{self.journal_path}.1"
+        self.previous_path = f"{snapshot_path}.prev"
+        self.previous_journal_path = f"{self.journal_path}.prev"
+        self.compact_events = compact_events
+        self.compact_seconds = compact_seconds
+        self._seq = 0
+        self._events_since_compact = 0
+        self._unflushed_bytes = 0
+        self._last_compact = time.monotonic()
+        self._tail = []
+        self._journal = None
+        self._recovered = False
+    
+    def load(self):
+        data, self._tail, self._seq, source = self._read_store(self.path, self.journal_path)
+        if source != self.path and os.path.exists(self.path):
+            # اللقطة الحالية تالفة وحُملت السابقة: إزاحتها حتى لا تحل محل السابقة عند اللقطة التالية
+            backup = f"{self.path}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            os.replace(self.path, backup)
+            logger.error(f"⚠️ تم حفظ نسخة من لقطة الإحصائيات التالفة في: {backup}")
+        # بعد الاستعادة تبقى السابقة هي السابقة عند اللقطة التالية فتحتاج أحداث .journal.prev معها
+        self._recovered = source is not None and source != self.path
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._events_since_compact = len(self._tail)
+        return data
+    
+    @staticmethod
+    def _read_snapshot(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError(f"لقطة بصيغة غير متوقعة ({type(data).__name__})")
+        return data
+    
+    @classmethod
+    def read_store(cls, path, journal_path=None):
+        """قراءة اللقطة والأحداث التي لم تدخل فيها بعد دون فتح السجل للكتابة: (البيانات، الأحداث، آخر رقم)
+        
+        إن تلفت اللقطة (أو انقطعت عملية استبدالها) تُقرأ السابقة ومعها كل الأحداث بعدها؛
+        وإن لم توجد سابقة سليمة يُرفع StatsRecoveryError بدل البدء بإحصائيات فارغة.
+        """
+        return cls._read_store(path, journal_path)[:3]
+    
+    @classmethod
+    def _read_store(cls, path, journal_path=None):
+        journal_path = journal_path or f"{path}.journal"
+        data = None
+        source = None
+        snapshot_seq = 0
+        candidates = [candidate for candidate in (path, f"{path}.prev") if os.path.exists(candidate)]
+        for candidate in candidates:
+            try:
+                data = cls._read_snapshot(candidate)
+            except (OSError, ValueError) as e:
+                logger.error(f"❌ لقطة الإحصائيات تالفة: {candidate} ({e})")
+                continue
+            if candidate != path:
+                logger.warning(f"⚠️ استعادة الإحصائيات من اللقطة السابقة {candidate} مع أحداث السجل بعدها")
+            source = candidate
+            snapshot_seq = data.pop('journal_seq', 0)
+            break
+        else:
+            if candidates:
+                raise StatsRecoveryError(f"لقطة الإحصائيات {path} تالفة ولا توجد لقطة سابقة سليمة - لن يبدأ البوت بإحصائيات فارغة")
+        
+        # إعادة قراءة الأحداث التي لم تدخل في اللقطة بعد (الأقدم أولاً)
+        seq = snapshot_seq
+        tail = []
+        for journal in (f"{journal_path}.prev", f"{journal_path}.1", journal_path):
+            if not os.path.exists(journal):
+                continue
+            with open(journal, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # سطر مبتور بسبب توقف مفاجئ أثناء الكتابة
+                        logger.warning(f"⚠️ تم تجاهل سطر تالف في سجل الأحداث: {journal}")
+                        continue
+                    if event.get('s', 0) <= seq:
+                        # داخل اللقطة أو مكرر في ملف سابق (الأرقام تتزايد عبر الملفات بالترتيب)
+                        continue
+                    tail.append(event)
+                    seq = max(seq, event['s'])
+        return data, tail, seq, source
+    
+    def pending_events(self):
+        tail, self._tail = self._tail, []
+        return tail
+    
+    def record(self, event):
+        self._seq += 1
+        line = json.dumps({**event, 's': self._seq}, ensure_ascii=False, separators=(',', ':')) + '\n'
+        self._journal.write(line)
+        self._unflushed_bytes += len(line)
+        self._events_since_compact += 1
+    
+    def prepare(self, data, changes):
+        """تفريغ السجل، وعند الحاجة التقاط لقطة جديدة وتدوير ملف السجل"""
+        self._journal.flush()
+        payload = {'journal_bytes': self._unflushed_bytes, 'snapshot': None}
+        self._unflushed_bytes = 0
+        
+        due = changes.full or self._events_since_compact >= self.compact_events or (
+            self._events_since_compact and time.monotonic() - self._last_compact >= self.compact_seconds
+        )
+        if not due:
+            return payload
+        
+        snapshot = dict(data)
+        snapshot['journal_seq'] = self._seq
+        payload['snapshot'] = json.dumps(
+            snapshot, ensure_ascii=False, separators=(',', ':'), default=stats_json_default
+        ).encode('utf-8')
+        
+        # الأحداث الجديدة تذهب لملف سجل جديد حتى تكتمل كتابة اللقطة
+        self._journal.close()
+        if self._recovered:
+            self._fold_previous_journal()
+            self._recovered = False
+        if os.path.exists(self.rotated_path):
+            # لقطة سابقة فشلت: نُلحق بدل الاستبدال حتى لا تضيع أحداثها
+            with open(self.journal_path, 'r', encoding='utf-8') as src, \
+                    open(self.rotated_path, 'a', encoding='utf-8') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.journal_path)
+        elif os.path.exists(self.journal_path):
+            os.replace(self.journal_path, self.rotated_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._events_since_compact = 0
+        self._last_compact = time.monotonic()
+        return payload
+    
+    def _fold_previous_journal(self):
+        """ضم أحداث .journal.prev إلى بداية السجل المدوَّر قبل أول لقطة بعد الاستعادة
+        
+        اللقطة السابقة لا تُستبدل في تلك المرة (الحالية أُزيحت كتالفة)، فيصبح السجل المدوَّر
+        سجلها الجديد ويجب أن يبدأ من بعدها لا من اللقطة التالفة. الأحداث المكررة بين الملفين
+        (توقف قبل اكتمال اللقطة) تُتجاهل عند القراءة برقمها التسلسلي.
+        """
+        if not os.path.exists(self.previous_journal_path):
+            return
+        folded = f"{self.rotated_path}.tmp"
+        with open(folded, 'wb') as dst:
+            for source in (self.previous_journal_path, self.rotated_path):
+                if not os.path.exists(source):
+                    continue
+                with open(source, 'rb') as src:
+                    shutil.copyfileobj(src, dst)
+                # سطر مبتور في آخر الملف لا يُدمج مع أول حدث في الملف التالي
+                if dst.tell() and not self._ends_with_newline(source):
+                    dst.write(b'\n')
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(folded, self.rotated_path)
+    
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if not f.tell():
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+    
+    def commit(self, payload):
+        os.fsync(self._journal.fileno())
+        if payload['snapshot'] is None:
+            return payload['journal_bytes']
+        
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(payload['snapshot'])
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(self.path):
+            os.replace(self.path, self.previous_path)
+        os.replace(tmp_file, self.path)
+        if os.path.exists(self.rotated_path):
+            # أحداث ما بين اللقطتين تبقى حتى اللقطة التالية لاستعادة السابقة عند الحاجة
+            os.replace(self.rotated_path, self.previous_journal_path)
+        return payload['journal_bytes'] + len(payload['snapshot'])
+    
+    def close(self):
+        if self._journal and not self._journal.closed:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal.close()
+
+# اللقطة الثنائية: ترويسة ثابتة ثم جسم (مضغوط اختيارياً) من أقسام مسبوقة بطولها
+#   [JSON مضغوط لكل المفاتيح عدا users] [جدول النصوص] [سجلات مستخدمين بطول ثابت] [JSON للسجلات غير النمطية]
+STATS_SNAPSHOT_MAGIC = b'BSTS'
+STATS_SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sBBH')  # التوقيع، الإصدار، الضغط، محجوز
+SNAPSHOT_LENGTH = struct.Struct('<I')
+# المعرف، الاسم، المعرف النصي، first_seen، join_date، last_seen، الاستخدام، التحميل، البحث، الفشل، نشط
+SNAPSHOT_USER = struct.Struct('<qIIdIdIIIIB')  # الإصدار 2: الأوقات ثوانٍ عشرية
+SNAPSHOT_USER_V1 = struct.Struct('<qIIqIqIIIIB')  # الإصدار 1: الأوقات ثوانٍ صحيحة
+SNAPSHOT_COMPRESSION = {'none': 0, 'gzip': 1, 'zstd': 2}
+UINT32_MAX = 0xFFFFFFFF
+
+def _pack_user_record(user_id, record, string_index):
+    """سجل المستخدم بطول ثابت - None إذا لم يكن نمطياً (معرف غير رقمي، وقت غير صالح، حقول إضافية...)"""
+    if not isinstance(user_id, str) or not user_id.lstrip('-').isdigit() or str(int(user_id)) != user_id:
+        return None
+    if record.extra or not isinstance(record.name, str) or not isinstance(record.username, str):
+        return None
+    if not isinstance(record.first_seen, float) or not isinstance(record.last_seen, float):
+        return None
+    if not isinstance(record.join_date, int):
+        return None
+    counts = (record.usage_count, record.download_count, record.search_count, record.failed_count)
+    if not all(type(value) is int and 0 <= value <= UINT32_MAX for value in counts):
+        return None
+    if not isinstance(record.is_active, bool) or not 0 <= record.join_date <= UINT32_MAX:
+        return None
+    return SNAPSHOT_USER.pack(
+        int(user_id), string_index(record.name), string_index(record.username),
+        record.first_seen, record.join_date, record.last_seen, *counts, record.is_active
+    )
+
+def encode_stats_snapshot(data, compression=STATS_BINARY_COMPRESSION):
+    """ترميز بيانات الإحصائيات كلقطة ثنائية مضغوطة"""
+    compression = compression.lower()
+    if compression == 'zstd' and zstandard is None:
+        logger.warning("⚠️ حزمة zstandard غير مثبتة - سيتم استخدام gzip")
+        compression = 'gzip'
+    if compression not in SNAPSHOT_COMPRESSION:
+        raise ValueError(f"ضغط غير معروف للقطة الإحصائيات: {compression}")
+    
+    strings = []
+    string_ids = {}
+    
+    def string_index(value):
+        index = string_ids.get(value)
+        if index is None:
+            index = string_ids[value] = len(strings)
+            strings.append(value)
+        return index
+    
+    records = bytearray()
+    record_count = 0
+    irregular = {}
+    for user_id, record in data.get('users', {}).items():
+        if not isinstance(record, UserRecord):
+            record = UserRecord(record)
+        packed = _pack_user_record(user_id, record, string_index)
+        if packed is None:
+            irregular[user_id] = record.to_dict()
+        else:
+            records += packed
+            record_count += 1
+    
+    meta = json.dumps(
+        {key: value for key, value in data.items() if key != 'users'},
+        ensure_ascii=False, separators=(',', ':'), default=stats_json_default
+    ).encode('utf-8')
+    extra = json.dumps(irregular, ensure_ascii=False, separators=(',', ':'), default=stats_json_default).encode('utf-8')
+    
+    body = bytearray(SNAPSHOT_LENGTH.pack(len(meta)))
+    body += meta
+    body += SNAPSHOT_LENGTH.pack(len(strings))
+    for value in strings:
+        encoded = value.encode('utf-8')
+        body += SNAPSHOT_LENGTH.pack(len(encoded))
+        body += encoded
+    body += SNAPSHOT_LENGTH.pack(record_count)
+    body += records
+    body += SNAPSHOT_LENGTH.pack(len(extra))
+    body += extra
+    
+    if compression == 'gzip':
+        body = gzip.compress(body, compresslevel=6, mtime=0)
+    elif compression == 'zstd':
+        body = zstandard.ZstdCompressor(level=3).compress(bytes(body))
+    header = SNAPSHOT_HEADER.pack(STATS_SNAPSHOT_MAGIC, STATS_SNAPSHOT_VERSION, SNAPSHOT_COMPRESSION[compression], 0)
+    return header + bytes(body)
+
+def is_stats_snapshot(payload):
+    return payload[:len(STATS_SNAPSHOT_MAGIC)] == STATS_SNAPSHOT_MAGIC
+
+def decode_stats_snapshot(payload):
+    """فك ترميز لقطة ثنائية إلى بيانات الإحصائيات (users كـ UserTable)"""
+    if len(payload) < SNAPSHOT_HEADER.size or not is_stats_snapshot(payload):
+        raise ValueError("ليست لقطة إحصائيات ثنائية")
+    _, version, compression, _ = SNAPSHOT_HEADER.unpack_from(payload)
+    if version > STATS_SNAPSHOT_VERSION:
+        raise ValueError(f"إصدار لقطة غير مدعوم: {version}")
+    body = memoryview(payload)[SNAPSHOT_HEADER.size:]
+    if compression == SNAPSHOT_COMPRESSION['gzip']:
+        body = memoryview(gzip.decompress(body))
+    elif compression == SNAPSHOT_COMPRESSION['zstd']:
+        if zstandard is None:
+            raise ValueError("اللقطة مضغوطة بـ zstd وحزمة zstandard غير مثبتة")
+        body = memoryview(zstandard.ZstdDecompressor().decompress(body, max_output_size=1 << 34))
+    elif compression != SNAPSHOT_COMPRESSION['none']:
+        raise ValueError(f"ضغط غير معروف في اللقطة: {compression}")
+    
+    offset = 0
+    
+    def read_length():
+        nonlocal offset
+        value = SNAPSHOT_LENGTH.unpack_from(body, offset)[0]
+        offset += SNAPSHOT_LENGTH.size
+        return value
+    
+    def read_bytes(size):
+        nonlocal offset
+        chunk = body[offset:offset + size]
+        offset += size
+        return bytes(chunk)
+    
+    data = json.loads(read_bytes(read_length()))
+    strings = [sys.intern(read_bytes(read_length()).decode('utf-8')) for _ in range(read_length())]
+    
+    users = UserTable()
+    record_count = read_length()
+    user_struct = SNAPSHOT_USER if version >= 2 else SNAPSHOT_USER_V1
+    for fields in user_struct.iter_unpack(body[offset:offset + record_count * user_struct.size]):
+        record = UserRecord.__new__(UserRecord)
+        (user_id, name, username, record.first_seen, record.join_date, record.last_seen,
+         record.usage_count, record.download_count, record.search_count, record.failed_count, active) = fields
+        record.first_seen = float(record.first_seen)
+        record.last_seen = float(record.last_seen)
+        record.name = strings[name]
+        record.username = strings[username]
+        record.is_active = bool(active)
+        record.extra = None
+        users[user_id] = record
+    offset += record_count * user_struct.size
+    for user_id, values in json.loads(read_bytes(read_length())).items():
+        users[user_id] = UserRecord(values)
+    
+    data['users'] = users
+    return data
+
+def read_stats_file(path):
+    """قراءة ملف إحصائيات بأي صيغة (JSON أو لقطة ثنائية) حسب التوقيع"""
+    with open(path, 'rb') as f:
+        payload = f.read()
+    if is_stats_snapshot(payload):
+        return decode_stats_snapshot(payload)
+    return json.loads(payload.decode('utf-8'))
+
+def convert_stats_file(source, destination, compression=STATS_BINARY_COMPRESSION):
+    """تحويل ملف الإحصائيات بين JSON واللقطة الثنائية (الصيغة الهدف حسب الامتداد: .json أو غيره)
+    
+    مثال: python -c "import bot; bot.convert_stats_file('bot_stats.json', 'bot_stats.bin')"
+    """
+    data = read_stats_file(source)
+    if destination.endswith('.json'):
+        backend = JsonStatsBackend(destination)
+    else:
+        backend = BinaryStatsBackend(destination, compression)
+    size = backend.commit(backend.prepare(data, StatsChanges(full=True)))
+    logger.info(f"✅ تم تحويل {source} ({os.path.getsize(source):,} بايت) إلى {destination} ({size:,} بايت)")
+    return size
+
+class BinaryStatsBackend(JsonStatsBackend):
+    """لقطة ثنائية مضغوطة بترويسة ذات إصدار (تُعاد كتابتها بالكامل عند كل حفظ مثل JSON)"""
+    
+    name = 'binary'
+    
+    def __init__(self, path, compression=STATS_BINARY_COMPRESSION):
+        super().__init__(path)
+        self.compression = compression
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        return read_stats_file(self.path)
+    
+    def prepare(self, data, changes):
+        return encode_stats_snapshot(data, self.compression)
+
+class MemoryStatsBackend:
+    """مخزن في الذاكرة فقط - يُستخدم للعرض المدمج من عدة أجزاء (لا يكتب شيئاً)"""
+    
+    name = 'memory'
+    path = None
+    
+    def __init__(self, data=None, events=()):
+        self._data = data
+        self._events = list(events)
+    
+    def load(self):
+        return self._data
+    
+    def record(self, event):
+        pass
+    
+    def pending_events(self):
+        events, self._events = self._events, []
+        return events
+    
+    def prepare(self, data, changes):
+        return None
+    
+    def commit(self, payload):
+        return 0
+    
+    def close(self):
+        pass
+
+def read_stats_store(kind, path):
+    """قراءة مخزن عملية أخرى دون أي كتابة (لا إنشاء جداول ولا فتح سجل للإلحاق): (البيانات، أحداث السجل)"""
+    if kind == 'sqlite':
+        return SQLiteStatsBackend.read_only(path), []
+    if kind == 'journal':
+        data, tail, _ = JournalStatsBackend.read_store(path)
+        return data, tail
+    if not os.path.exists(path):
+        return None, []
+    return read_stats_file(path), []
+
+def shard_path(path, shard_id):
+    """مسار الجزء الخاص بعملية: bot_stats.json -> bot_stats.shard-<id>.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard_id}{ext}"
+
+def find_stats_shards(base_path):
+    """مسارات أجزاء العمليات لمخزن معين (الجزء قد يكون لقطة أو سجل أحداث فقط)"""
+    root, ext = os.path.splitext(base_path)
+    pattern = f"{glob.escape(root)}.shard-*{ext}"
+    paths = set(glob.glob(pattern))
+    paths.update(path[:-len('.journal')] for path in glob.glob(f"{pattern}.journal"))
+    return sorted(paths)
+
+def stats_store_exists(path):
+    return os.path.exists(path) or os.path.exists(f"{path}.journal")
+
+def create_stats_backend(kind=None, stats_file=None, shard_id=None):
+    """إنشاء مخزن الإحصائيات حسب STATS_BACKEND (مع مسار الجزء الخاص عند تحديد shard_id)"""
+    kind = (kind or STATS_BACKEND).lower()
+    if kind == 'sqlite':
+        return SQLiteStatsBackend(shard_path(STATS_DB_FILE, shard_id) if shard_id else STATS_DB_FILE)
+    if kind == 'binary':
+        return BinaryStatsBackend(shard_path(STATS_BINARY_FILE, shard_id) if shard_id else STATS_BINARY_FILE)
+    stats_file = stats_file or STATS_FILE
+    if shard_id:
+        stats_file = shard_path(stats_file, shard_id)
+    if kind == 'journal':
+        return JournalStatsBackend(stats_file)
+    if kind != 'json':
+        logger.warning(f"⚠️ مخزن إحصائيات غير معروف: {kind} - سيتم استخدام JSON")
+    return JsonStatsBackend(stats_file)
+
+def migrate_stats_json_to_sqlite(json_file=None, db_file=None):
+    """ترحيل لمرة واحدة من bot_stats.json إلى قاعدة SQLite"""
+    backend = SQLiteStatsBackend(db_file or STATS_DB_FILE)
+    if backend.load() is not None:
+        backend.close()
+        logger.info("ℹ️ قاعدة الإحصائيات تحتوي بيانات بالفعل - تم تخطي الترحيل")
+        return False
+    migrated = AdvancedBotStats(stats_file=json_file, flush_interval=0, backend=backend)
+    migrated.shutdown()
+    return True
+
+class SearchTermSketch:
+    """ملخص Space-Saving محدود الحجم لأكثر عمليات البحث تكراراً (ذاكرة ثابتة وقراءة O(K))"""
+    
+    MAX_TERM_LENGTH = 100
+    
+    def __init__(self, capacity=STATS_SEARCH_TERMS_CAPACITY, top_size=10):
+        self.capacity = max(1, capacity)
+        self.top_size = top_size
+        self.counts = {}
+        self._errors = {}
+        self._buckets = {}
+        self._min = 0
+        self._top = []
+    
+    @classmethod
+    def normalize(cls, term):
+        """توحيد نص البحث: أحرف صغيرة ومسافات مفردة وطول محدود"""
+        if not term:
+            return None
+        normalized = ' '.join(str(term).casefold().split())[:cls.MAX_TERM_LENGTH]
+        return normalized or None
+    
+    @classmethod
+    def from_counts(cls, counts, capacity=STATS_SEARCH_TERMS_CAPACITY):
+        """بناء الملخص من قاموس العدادات المحفوظ - يُرجع (الملخص، المصطلحات المحذوفة)
+        
+        المفاتيح المحفوظة قبل توحيد النصوص تُوحد أولاً وتُجمع عداداتها ("Hello  World" و
+        "hello world" مصطلح واحد)، والمفتاح القديم يُعد محذوفاً.
+        """
+        sketch = cls(capacity)
+        merged = {}
+        for term, count in (counts or {}).items():
+            key = cls.normalize(term)
+            if key is not None and isinstance(count, int) and count > 0:
+                merged[key] = merged.get(key, 0) + count
+        ranked = sorted(merged.items(), key=lambda item: item[1], reverse=True)
+        kept = ranked[:sketch.capacity]
+        for term, count in kept:
+            sketch.counts[term] = count
+            sketch._errors[term] = 0
+            sketch._buckets.setdefault(count, {})[term] = None
+        sketch._min = kept[-1][1] if kept else 0
+        sketch._top = [term for term, _ in kept[:sketch.top_size]]
+        dropped = [term for term in (counts or {}) if term not in sketch.counts]
+        return sketch, dropped
+    
+    def add(self, term):
+        """تسجيل مصطلح - يُرجع المصطلح المُزاح من الملخص إن وجد"""
+        evicted = None
+        if term in self.counts:
+            self._move(term, self.counts[term] + 1)
+        elif len(self.counts) < self.capacity:
+            self.counts[term] = 1
+            self._errors[term] = 0
+            self._buckets.setdefault(1, {})[term] = None
+            self._min = 1
+            self._promote(term)
+        else:
+            # إزاحة أقل المصطلحات تكراراً وتوريث عداده (خطأ التقدير = عداده)
+            floor = self._min
+            bucket = self._buckets[floor]
+            evicted = next(iter(bucket))
+            del bucket[evicted]
+            if not bucket:
+                del self._buckets[floor]
+                self._min = floor + 1
+            del self.counts[evicted]
+            del self._errors[evicted]
+            if evicted in self._top:
+                self._top.remove(evicted)
+                self._refill_top()
+            self.counts[term] = floor + 1
+            self._errors[term] = floor
+            self._buckets.setdefault(floor + 1, {})[term] = None
+            self._promote(term)
+        return evicted
+    
+    def _move(self, term, count):
+        previous = self.counts[term]
+        bucket = self._buckets[previous]
+        del bucket[term]
+        if not bucket:
+            del self._buckets[previous]
+            if previous == self._min:
+                self._min = count
+        self.counts[term] = count
+        self._buckets.setdefault(count, {})[term] = None
+        self._promote(term)
+    
+    def _promote(self, term):
+        """تحديث قائمة الأعلى تكراراً بعد زيادة عداد المصطلح - O(K)"""
+        top = self._top
+        count = self.counts[term]
+        if term in top:
+            position = top.index(term)
+        elif len(top) < self.top_size:
+            top.append(term)
+            position = len(top) - 1
+        elif count > self.counts[top[-1]]:
+            top[-1] = term
+            position = len(top) - 1
+        else:
+            return
+        while position > 0 and self.counts[top[position - 1]] < count:
+            top[position - 1], top[position] = top[position], top[position - 1]
+            position -= 1
+    
+    def _refill_top(self):
+        self._top = sorted(self.counts, key=self.counts.get, reverse=True)[:self.top_size]
+    
+    def top(self, limit):
+        """أكثر المصطلحات تكراراً كقائمة (المصطلح، العدد)"""
+        return [(term, self.counts[term]) for term in self._top[:limit]]
+
+HLL_PREFIX = "hll1:"
+HLL_INVERSE_POWERS = [2.0 ** -rank for rank in range(66)]
+MASK64 = (1 << 64) - 1
+
+def mix64(value):
+    """خلط splitmix64 - تجزئة ثابتة بين العمليات (بعكس hash للنصوص)"""
+    z = (value + 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+class HyperLogLog:
+    """ملخص HyperLogLog لعدد المعرفات الفريدة: ذاكرة ثابتة (2^p بايت) وقابل للدمج بين الأيام والعمليات"""
+    
+    __slots__ = ('precision', 'registers')
+    
+    def __init__(self, precision=12, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError(f"دقة HyperLogLog غير صالحة: {precision}")
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+    
+    def add(self, value):
+        hashed = mix64(value)
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+    
+    def merge(self, other):
+        """دمج ملخص آخر بنفس الدقة (أكبر قيمة لكل سجل)"""
+        if other.precision != self.precision:
+            raise ValueError(f"لا يمكن دمج HyperLogLog بدقتين مختلفتين ({self.precision} و {other.precision})")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+    
+    def copy(self):
+        return HyperLogLog(self.precision, self.registers)
+    
+    def count(self):
+        m = len(self.registers)
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(map(HLL_INVERSE_POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # تصحيح المدى الصغير (عد خطي)
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+    
+    def encode(self):
+        return f"{HLL_PREFIX}{self.precision}:" + base64.b64encode(zlib.compress(bytes(self.registers))).decode('ascii')
+    
+    @classmethod
+    def decode(cls, value):
+        if isinstance(value, HyperLogLog):
+            return value.copy()
+        if not isinstance(value, str) or not value.startswith(HLL_PREFIX):
+            raise ValueError("ليس ملخص HyperLogLog")
+        precision, payload = value[len(HLL_PREFIX):].split(':', 1)
+        sketch = cls(int(precision), zlib.decompress(base64.b64decode(payload)))
+        if len(sketch.registers) != 1 << sketch.precision:
+            raise ValueError("ملخص HyperLogLog تالف")
+        return sketch
+
+def merge_sketches(sketches):
+    """دمج ملخصات (كائنات أو نصوص مرمّزة) - None إذا لم يوجد أي ملخص صالح"""
+    merged = None
+    for value in sketches:
+        if value is None:
+            continue
+        try:
+            sketch = HyperLogLog.decode(value)
+            merged = sketch if merged is None else merged.merge(sketch)
+        except (ValueError, zlib.error) as e:
+            logger.warning(f"⚠️ تم تجاهل ملخص مستخدمين فريدين غير صالح: {e}")
+    return merged
+
+class UsageRankIndex:
+    """فهرس ترتيب المستخدمين حسب usage_count: شجرة Fenwick على قيم العداد مع دلو مستخدمين لكل قيمة"""
+    
+    def __init__(self):
+        self._size = 64
+        self._tree = [0] * (self._size + 1)
+        self._buckets = {}
+        self._counts = {}
+        self._max = 0
+    
+    def __len__(self):
+        return len(self._counts)
+    
+    def _grow(self, index):
+        size = self._size
+        while size < index:
+            size *= 2
+        self._size = size
+        self._tree = [0] * (size + 1)
+        for count, bucket in self._buckets.items():
+            self._update(count + 1, len(bucket))
+    
+    def _update(self, index, delta):
+        tree = self._tree
+        size = self._size
+        while index <= size:
+            tree[index] += delta
+            index += index & -index
+    
+    def _count_at_most(self, count):
+        """عدد المستخدمين الذين عدادهم <= count"""
+        index = min(count + 1, self._size)
+        total = 0
+        tree = self._tree
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+    
+    def _count_for_position(self, position):
+        """أصغر قيمة عداد يصل عندها عدد المستخدمين التراكمي إلى position"""
+        index = 0
+        step = self._size
+        tree = self._tree
+        while step:
+            nxt = index + step
+            if nxt <= self._size and tree[nxt] < position:
+                index = nxt
+                position -= tree[nxt]
+            step >>= 1
+        return index
+    
+    def set(self, user_id, count):
+        previous = self._counts.get(user_id)
+        if previous == count:
+            return
+        if previous is not None:
+            self._remove_from_bucket(user_id, previous)
+        if count + 1 > self._size:
+            self._grow(count + 1)
+        self._counts[user_id] = count
+        self._buckets.setdefault(count, {})[user_id] = None
+        self._update(count + 1, 1)
+        if count > self._max:
+            self._max = count
+        elif previous == self._max and not self._buckets.get(previous):
+            self._max = self._count_for_position(len(self._counts))
+    
+    def _remove_from_bucket(self, user_id, count):
+        bucket = self._buckets[count]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[count]
+        self._update(count + 1, -1)
+    
+    def rank(self, user_id):
+        """الترتيب = 1 + عدد من لديهم استخدامات أكثر (المتساوون يتشاركون الترتيب) - O(log n)"""
+        count = self._counts.get(user_id)
+        if count is None:
+            return None
+        return len(self._counts) - self._count_at_most(count) + 1
+    
+    def top(self, limit):
+        """أعلى المستخدمين استخداماً - O(K log n) بالقفز بين الدلاء غير الفارغة"""
+        result = []
+        if not self._counts:
+            return result
+        count = self._max
+        while len(result) < limit:
+            for user_id in self._buckets.get(count, ()):
+                result.append(user_id)
+                if len(result) == limit:
+                    return result
+            below = self._count_at_most(count - 1) if count > 0 else 0
+            if not below:
+                break
+            count = self._count_for_position(below)
+        return result
+    
+    def freeze(self):
+        return UsageRankSnapshot(self)
+
+class UsageRankSnapshot:
+    """نسخة ثابتة من شجرة UsageRankIndex تُنشر مع لقطة القراءة: ترتيب أي عدد استخدامات بلا قفل
+    
+    حجم النسخة بحجم أكبر عداد لا بعدد المستخدمين.
+    """
+    
+    __slots__ = ('_tree', '_size', 'users')
+    
+    def __init__(self, index):
+        self._tree = tuple(index._tree)
+        self._size = index._size
+        self.users = len(index)
+    
+    _count_at_most = UsageRankIndex._count_at_most
+    
+    def rank(self, count):
+        return self.users - self._count_at_most(count) + 1
+
+class UserRecord(MutableMapping):
+    """سجل مستخدم مضغوط (__slots__) يتصرف كقاموس: الأوقات تُخزن كثوانٍ عشرية (float) فتبقى أجزاء الثانية
+    كما في النص الأصلي، والأسماء مُدمجة (interned)"""
+    
+    __slots__ = (
+        'name', 'username', 'first_seen', 'join_date', 'last_seen',
+        'usage_count', 'download_count', 'search_count', 'failed_count', 'is_active', 'extra'
+    )
+    
+    FIELDS = __slots__[:-1]
+    TIME_FIELDS = frozenset(('first_seen', 'last_seen'))
+    
+    def __init__(self, values=()):
+        self.name = 'غير معروف'
+        self.username = 'بدون معرف'
+        self.first_seen = self.last_seen = self.join_date = None
+        self.usage_count = self.download_count = self.search_count = self.failed_count = 0
+        self.is_active = False
+        self.extra = None
+        for key, value in dict(values).items():
+            self[key] = value
+    
+    def __getitem__(self, key):
+        if key in self.TIME_FIELDS:
+            value = getattr(self, key)
+            return datetime.fromtimestamp(value).isoformat() if isinstance(value, float) else value
+        if key == 'join_date':
+            value = self.join_date
+            return date.fromordinal(value).isoformat() if isinstance(value, int) else value
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+    
+    def __setitem__(self, key, value):
+        if key in self.TIME_FIELDS:
+            value = self._to_epoch(value)
+        elif key == 'join_date':
+            value = self._to_ordinal(value)
+        elif key in ('name', 'username'):
+            value = sys.intern(value) if isinstance(value, str) else value
+        elif key not in self.FIELDS:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+            return
+        setattr(self, key, value)
+    
+    def __delitem__(self, key):
+        if self.extra and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+    
+    def __iter__(self):
+        yield from self.FIELDS
+        if self.extra:
+            yield from self.extra
+    
+    def __len__(self):
+        return len(self.FIELDS) + (len(self.extra) if self.extra else 0)
+    
+    def __repr__(self):
+        return f"UserRecord({dict(self)!r})"
+    
+    def copy(self):
+        """نسخة مستقلة من السجل (الحقول كما هي بدون تحويل)"""
+        clone = UserRecord.__new__(UserRecord)
+        for field in self.FIELDS:
+            setattr(clone, field, getattr(self, field))
+        clone.extra = dict(self.extra) if self.extra else None
+        return clone
+    
+    def to_dict(self):
+        """قاموس عادي بالقيم كما في ملف JSON (مثل dict(record) دون المرور بـ __getitem__ لكل حقل)"""
+        first_seen, last_seen, join_date = self.first_seen, self.last_seen, self.join_date
+        values = {
+            'name': self.name,
+            'username': self.username,
+            'first_seen': datetime.fromtimestamp(first_seen).isoformat() if isinstance(first_seen, float) else first_seen,
+            'join_date': date.fromordinal(join_date).isoformat() if isinstance(join_date, int) else join_date,
+            'last_seen': datetime.fromtimestamp(last_seen).isoformat() if isinstance(last_seen, float) else last_seen,
+            'usage_count': self.usage_count,
+            'download_count': self.download_count,
+            'search_count': self.search_count,
+            'failed_count': self.failed_count,
+            'is_active': self.is_active,
+        }
+        if self.extra:
+            values.update(self.extra)
+        return values
+    
+    @staticmethod
+    def _to_epoch(value):
+        if isinstance(value, str):
+            try:
+                return datetime.fromisoformat(value).timestamp()
+            except ValueError:
+                return value
+        if isinstance(value, datetime):
+            return value.timestamp()
+        if isinstance(value, int) and not isinstance(value, bool):
+            return float(value)
+        return value
+    
+    @staticmethod
+    def _to_ordinal(value):
+        if isinstance(value, str):
+            try:
+                return date.fromisoformat(value[:10]).toordinal()
+            except ValueError:
+                return value
+        if isinstance(value, date):
+            return value.toordinal()
+        return value
+    
+    def last_seen_day(self):
+        """رقم يوم آخر نشاط (ordinal) بدون المرور بالنص - None إذا كان الوقت غير صالح"""
+        if isinstance(self.last_seen, float):
+            return date.fromtimestamp(self.last_seen).toordinal()
+        try:
+            return datetime.fromisoformat(self.last_seen).date().toordinal()
+        except (TypeError, ValueError):
+            return None
+
+class FrozenUserTable(Mapping):
+    """عرض ثابت لسجلات المستخدمين يُنشر مع لقطة القراءة
+    
+    قاعدة (نسخة سطحية من الجدول) وطبقة بالسجلات التي تغيرت بعدها، ولا يتغير أي منهما بعد النشر.
+    السجلات نفسها لا تُعدل بعد نشرها: الكاتب يستبدلها بنسخة أولاً (UserTable.writable).
+    """
+    
+    __slots__ = ('_base', '_overlay', '_size')
+    
+    def __init__(self, base, overlay, size):
+        self._base = base
+        self._overlay = overlay
+        self._size = size
+    
+    def __getitem__(self, user_id):
+        key = UserTable._key(user_id)
+        record = self._overlay.get(key)
+        if record is None:
+            record = self._base[key]
+        return record
+    
+    def __contains__(self, user_id):
+        key = UserTable._key(user_id)
+        return key in self._overlay or key in self._base
+    
+    def __iter__(self):
+        overlay = self._overlay
+        for key in self._base:
+            if key not in overlay:
+                yield str(key)
+        for key in overlay:
+            yield str(key)
+    
+    def __len__(self):
+        return self._size
 
-# ============================================
-# 📊 نظام الإحصائيات المتقدم (Advanced Stats System)
-# ============================================
+class UserTable(MutableMapping):
+    """جدول المستخدمين: مفاتيح رقمية داخلياً وسجلات UserRecord، مع واجهة قاموس بمفاتيح نصية كما في ملف JSON
+    
+    بعد أول freeze() يصبح نسخاً عند الكتابة: السجل المنشور في لقطة قراءة يُستبدل بنسخة قبل تعديله.
+    """
+    
+    __slots__ = ('_records', '_fresh', '_frozen')
+    
+    def __init__(self, users=()):
+        self._records = {}
+        # مفاتيح السجلات التي أُنشئت أو نُسخت بعد آخر freeze (لم تُنشر بعد فيجوز تعديلها مباشرة)
+        self._fresh = set()
+        self._frozen = None
+        for user_id, record in dict(users).items():
+            self[user_id] = record
+    
+    @staticmethod
+    def _key(user_id):
+        if isinstance(user_id, int):
+            return user_id
+        if isinstance(user_id, str) and user_id.lstrip('-').isdigit() and str(int(user_id)) == user_id:
+            return int(user_id)
+        return user_id
+    
+    def __getitem__(self, user_id):
+        return self._records[self._key(user_id)]
+    
+    def __setitem__(self, user_id, record):
+        if not isinstance(record, UserRecord):
+            record = UserRecord(record)
+        key = self._key(user_id)
+        self._records[key] = record
+        if self._frozen is not None:
+            self._fresh.add(key)
+    
+    def __delitem__(self, user_id):
+        key = self._key(user_id)
+        del self._records[key]
+        if self._frozen is not None:
+            self._fresh.add(key)
+    
+    def __contains__(self, user_id):
+        return self._key(user_id) in self._records
+    
+    def __iter__(self):
+        for key in self._records:
+            yield str(key)
+    
+    def __len__(self):
+        return len(self._records)
+    
+    def values(self):
+        return self._records.values()
+    
+    def items(self):
+        """أزواج (المعرف النصي، السجل) بدون إعادة تحليل المفاتيح"""
+        for key, record in self._records.items():
+            yield str(key), record
+    
+    def ids(self):
+        """نسخة من المعرفات النصية دون قفل: list() تنسخ مفاتيح القاموس في خطوة واحدة فلا تتأثر بإضافة مستخدم من خيط آخر"""
+        return [str(key) for key in list(self._records)]
+    
+    def writable(self, user_id):
+        """سجل المستخدم للتعديل: إن كان منشوراً في لقطة قراءة يُستبدل بنسخة أولاً"""
+        key = self._key(user_id)
+        record = self._records[key]
+        if self._frozen is not None and key not in self._fresh:
+            record = self._records[key] = record.copy()
+            self._fresh.add(key)
+        return record
+    
+    def freeze(self):
+        """عرض ثابت للسجلات الحالية - تكلفته بعدد السجلات التي تغيرت منذ آخر عرض
+        
+        تُعاد القاعدة كاملة فقط عند حذف مستخدم أو عندما تكبر الطبقة (1/8 الجدول) فيبقى النسخ مُطفأً (amortized).
+        """
+        frozen = self._frozen
+        records = self._records
+        if frozen is None or not all(key in records for key in self._fresh) or (
+            len(frozen._overlay) + len(self._fresh) > len(frozen._base) // 8 + 1024
+        ):
+            frozen = FrozenUserTable(dict(records), {}, len(records))
+        elif self._fresh:
+            overlay = dict(frozen._overlay)
+            for key in self._fresh:
+                overlay[key] = records[key]
+            frozen = FrozenUserTable(frozen._base, overlay, len(records))
+        self._fresh = set()
+        self._frozen = frozen
+        return frozen
 
 class AdvancedBotStats:
     """نظام إحصائيات شامل ومتقدم للبوت"""
     
-    def __init__(self):
-        self.stats_file = STATS_FILE
-        self.load_stats()
+    # العدادات التي تُكتب في ملف الملخص الصغير لعرضها فوراً عند بدء التشغيل
+    SUMMARY_KEYS = (
+        'bot_version', 'start_date', 'last_update', 'total_users',
+        'active_users_today', 'active_users_week', 'active_users_month',
+        'total_downloads', 'successful_downloads', 'failed_downloads', 'downloads_by_type',
+        'total_searches', 'platforms', 'total_errors', 'average_download_time'
+    )
+    
+    def __init__(self, stats_file=None, flush_interval=STATS_FLUSH_INTERVAL, flush_threshold=STATS_FLUSH_THRESHOLD, backend=None,
+                 retention_days=STATS_DAILY_RETENTION_DAYS, retention_weeks=STATS_WEEKLY_RETENTION_WEEKS, lazy=False,
+                 snapshot_interval=STATS_SNAPSHOT_INTERVAL, shard_id=None, merge_interval=STATS_SHARD_MERGE_INTERVAL,
+                 read_only=False, render_min_interval=STATS_RENDER_MIN_INTERVAL, hll_precision=STATS_HLL_PRECISION):
+        # في وضع الأجزاء تكتب العملية ملفها الخاص فقط والمخزن الرئيسي يصبح للقراءة
+        self.shard_id = shard_id or None
+        self.base_stats_file = stats_file or STATS_FILE
+        self.stats_file = shard_path(self.base_stats_file, shard_id) if self.shard_id else self.base_stats_file
+        self.summary_file = f"{self.stats_file}.summary"
+        self.backend = backend or create_stats_backend(stats_file=self.base_stats_file, shard_id=self.shard_id)
+        self.read_only = read_only
+        self.merge_interval = merge_interval
+        self._merged_view = None
+        self._last_merge = 0.0
+        self.flush_interval = 0 if read_only else flush_interval
+        self.flush_threshold = flush_threshold
+        self.snapshot_interval = snapshot_interval
+        self.retention_days = retention_days
+        self.retention_weeks = retention_weeks
+        self._retention_day = None
+        
+        # ملخصات HyperLogLog لكل يوم (اختيارية) - تُحفظ فقط بعد دمجها في التجميعات الأسبوعية والشهرية
+        self.hll_precision = hll_precision
+        self._day_sketches = {}
+        
+        # حالة الحفظ المؤجل: التغييرات تُعلَّم فقط ويقوم خيط خلفي بالكتابة
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._dirty_count = 0
+        self._changes = StatsChanges()
+        self._flush_event = threading.Event()
+        
+        # خيط الإحصائيات: المعالجات تضع الأحداث في الطابور فقط، والقراءة من لقطة ثابتة تُستبدل كاملة
+        self._events = queue.SimpleQueue()
+        self._worker = None
+        self._version = 0
+        self._snapshot = None
+        self._published = threading.Event()
+        self._last_publish = 0.0
+        
+        # نصوص اللوحات الجاهزة: اللوحة -> (اللقطة، وقت البناء، النص)
+        self.render_min_interval = render_min_interval
+        self._render_cache = {}
+        self._render_lock = threading.Lock()
+        self.flush_metrics = {
+            'flushes': 0,
+            'last_flush_seconds': 0.0,
+            'max_flush_seconds': 0.0,
+            'total_flush_seconds': 0.0,
+            'last_bytes_written': 0,
+            'total_bytes_written': 0,
+            'pending_changes': 0,
+        }
+        
+        # حالة التحميل: الأحداث التي تصل قبل اكتماله تُؤجل ثم تُطبق بالترتيب
+        self._data = None
+        self._loaded = threading.Event()
+        self._loader_ident = None
+        self._queued_events = []
+        self.load_seconds = None
+        self._summary = self._read_summary()
+        
+        if lazy:
+            threading.Thread(target=self._load_in_background, args=(True,), name="stats-loader", daemon=True).start()
+        else:
+            self._load_in_background()
+        if self.flush_interval > 0:
+            self.start_worker()
+    
+    @property
+    def data(self):
+        """بيانات الإحصائيات - تنتظر اكتمال التحميل الخلفي عند الحاجة إليها"""
+        if not self._loaded.is_set() and threading.get_ident() != self._loader_ident:
+            self._loaded.wait()
+        return self._data
+    
+    @data.setter
+    def data(self, value):
+        self._data = value
+    
+    def is_loaded(self):
+        return self._loaded.is_set()
+    
+    def wait_until_loaded(self, timeout=None):
+        """انتظار اكتمال تحميل الإحصائيات (True إذا اكتمل)"""
+        return self._loaded.wait(timeout)
+    
+    def _load_in_background(self, background=False):
+        self._loader_ident = threading.get_ident()
+        started = time.perf_counter()
+        try:
+            self.load_stats()
+        except StatsRecoveryError as e:
+            # رفض العمل بدل الكتابة فوق الإحصائيات: الخطأ يوقف الاستيراد، وفي التحميل الخلفي
+            # تُنهى العملية (os._exit يتخطى حفظ atexit عمداً)
+            logger.critical(f"❌ {e}")
+            if not background:
+                raise
+            os._exit(1)
+        except Exception as e:
+            logger.error(f"❌ خطأ غير متوقع أثناء تحميل الإحصائيات: {e}")
+            self._backup_corrupt_store()
+            self.data = self.create_new_stats()
+            self._rebuild_indexes()
+        
+        with self._lock:
+            queued = self._queued_events
+            self._queued_events = []
+            for event in queued:
+                self._commit_event(event)
+            self.load_seconds = time.perf_counter() - started
+            self._loaded.set()
+        
+        (logger.debug if self.read_only else logger.info)(
+            f"✅ تم تحميل الإحصائيات في {self.load_seconds:.2f} ثانية "
+            f"({len(self._data['users'])} مستخدم"
+            + (f"، {len(queued)} حدث مؤجل" if queued else "") + ")"
+        )
+    
+    def _read_summary(self):
+        try:
+            with open(self.summary_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _write_summary(self, summary):
+        tmp_file = f"{self.summary_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+        os.replace(tmp_file, self.summary_file)
+    
+    def get_summary(self):
+        """العدادات الإجمالية - متاحة فوراً من ملف الملخص حتى قبل اكتمال التحميل"""
+        if not self._loaded.is_set():
+            return dict(self._summary)
+        with self._lock:
+            return {key: self._data[key] for key in self.SUMMARY_KEYS if key in self._data}
     
     def load_stats(self):
-        """تحميل الإحصائيات من الملف"""
-        if os.path.exists(self.stats_file):
+        """تحميل الإحصائيات من المخزن (مع ترحيل ملف JSON القديم عند الحاجة)"""
+        migrated = False
+        try:
+            data = self.backend.load()
+            if data is None and not self.read_only and self.backend.name != 'json' and os.path.exists(self.stats_file):
+                logger.info(f"🔄 ترحيل الإحصائيات من {self.stats_file} إلى {self.backend.name}...")
+                data = JsonStatsBackend(self.stats_file).load()
+                migrated = True
+        except StatsRecoveryError:
+            # سجل الأحداث وحده لا يكفي: إعادته على إحصائيات فارغة ثم حفظها يضيع كل ما قبله
+            raise
+        except Exception as e:
+            logger.error(f"❌ خطأ في تحميل الإحصائيات: {e}")
+            self._backup_corrupt_store()
             try:
-                with open(self.stats_file, 'r', encoding='utf-8') as f:
-                    self.data = json.load(f)
-                    # تحديث البنية إذا لزم الأمر
-                    self._ensure_structure()
-            except Exception as e:
-                logger.warning(f"خطأ في تحميل الإحصائيات: {e}")
-                self.data = self.create_new_stats()
-        else:
+                data = self.backend.load()
+            except Exception:
+                data = None
+        
+        if data is None:
             self.data = self.create_new_stats()
+        else:
+            self.data = data
+            # تحديث البنية إذا لزم الأمر
+            self._ensure_structure()
+        self._rebuild_indexes()
+        
+        # إعادة تطبيق الأحداث المسجلة بعد آخر لقطة
+        tail = self.backend.pending_events()
+        if tail:
+            for event in tail:
+                self._apply_event(event)
+            self.data['last_update'] = datetime.fromtimestamp(tail[-1]['t']).isoformat()
+            self._update_active_users()
+            logger.info(f"🔁 تمت إعادة تطبيق {len(tail)} حدث من سجل الأحداث")
+        
+        # التجميع القديم لا يُطبق هنا بل عند أول حدث (_ensure_daily_entry)، فلا يُعاد
+        # كتابة المخزن لمجرد تحميله
+        
+        if migrated:
+            self._changes.full = True
+            self._dirty_count += 1
+            self.flush()
+            logger.info(f"✅ تم ترحيل {len(self.data['users'])} مستخدم إلى {self.backend.name}")
+    
+    def _backup_corrupt_store(self):
+        """الاحتفاظ بنسخة من ملف الإحصائيات التالف بدل الكتابة فوقه بإحصائيات فارغة"""
+        path = getattr(self.backend, 'path', None)
+        if self.read_only or not path or not os.path.exists(path):
+            return
+        backup = f"{path}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        try:
+            if self.backend.name == 'sqlite':
+                # الاتصال بالقاعدة ما زال مفتوحاً على الملف نفسه
+                shutil.copy2(path, backup)
+            else:
+                os.replace(path, backup)
+            logger.error(f"⚠️ تم حفظ نسخة من ملف الإحصائيات التالف في: {backup}")
+        except Exception as e:
+            logger.error(f"❌ تعذر حفظ نسخة من ملف الإحصائيات التالف: {e}")
     
     def _ensure_structure(self):
         """التأكد من وجود جميع الحقول المطلوبة"""
@@ -233,8 +3367,8 @@ class AdvancedBotStats:
             'total_users', 'active_users_today', 'active_users_week', 'active_users_month', 'users',
             'total_downloads', 'successful_downloads', 'failed_downloads', 'downloads_by_type',
             'total_searches', 'search_terms', 'start_date', 'last_update', 'daily_stats',
-            'daily_stats_version', 'platforms', 'premium_features', 'bot_version',
-            'total_errors', 'average_download_time'
+            'daily_stats_version', 'weekly_stats', 'monthly_stats', 'platforms', 'premium_features', 'bot_version',
+            'total_errors', 'average_download_time', 'timed_downloads'
         ]
         for key in required_keys:
             if key not in self.data:
@@ -260,6 +3394,8 @@ class AdvancedBotStats:
                     self.data[key] = {}
                 elif key == 'daily_stats_version':
                     self.data[key] = 1
+                elif key in ('weekly_stats', 'monthly_stats'):
+                    self.data[key] = {}
                 elif key == 'platforms':
                     self.data[key] = {
                         'youtube': 0,
@@ -275,7 +3411,7 @@ class AdvancedBotStats:
                     self.data[key] = '2.5'
                 elif key == 'total_errors':
                     self.data[key] = 0
-                elif key == 'average_download_time':
+                elif key in ('average_download_time', 'timed_downloads'):
                     self.data[key] = 0
                 elif key not in self.data:
                     self.data[key] = 0 if key != 'start_date' else datetime.now().isoformat()
@@ -300,15 +3436,17 @@ class AdvancedBotStats:
             entry.setdefault('new_users', 0)
             entry.setdefault('active_users', 0)
             entry.setdefault('failed', 0)
-            if not isinstance(entry.get('active_user_ids'), list):
-                entry['active_user_ids'] = []
+            if not isinstance(entry.get('active_user_ids'), set):
+                entry['active_user_ids'] = decode_id_set(entry.get('active_user_ids'))
             if entry['active_users'] < len(entry['active_user_ids']):
                 entry['active_users'] = len(entry['active_user_ids'])
 
     def _normalize_user_records(self):
         users = self.data.get('users')
+        if isinstance(users, UserTable):
+            return
         if not isinstance(users, dict):
-            self.data['users'] = {}
+            self.data['users'] = UserTable()
             return
 
         now_iso = datetime.now().isoformat()
@@ -327,6 +3465,9 @@ class AdvancedBotStats:
             record.setdefault('search_count', 0)
             record.setdefault('failed_count', 0)
             record.setdefault('is_active', False)
+        
+        # تحويل القواميس إلى سجلات مضغوطة مرة واحدة عند التحميل
+        self.data['users'] = UserTable(users)
     
     def create_new_stats(self):
         """إنشاء إحصائيات جديدة بنية محسّنة"""
@@ -340,7 +3481,7 @@ class AdvancedBotStats:
             'active_users_today': 0,
             'active_users_week': 0,
             'active_users_month': 0,
-            'users': {},
+            'users': UserTable(),
             
             # إحصائيات التحميلات
             'total_downloads': 0,
@@ -362,6 +3503,10 @@ class AdvancedBotStats:
             'daily_stats': {},
             'daily_stats_version': 2,
             
+            # تجميعات الأيام الأقدم من فترة الاحتفاظ
+            'weekly_stats': {},
+            'monthly_stats': {},
+            
             # المنصات الأكثر استخداماً
             'platforms': {
                 'youtube': 0,
@@ -375,32 +3520,371 @@ class AdvancedBotStats:
             # ميزات متقدمة
             'premium_features': [],
             'total_errors': 0,
-            'average_download_time': 0
+            'average_download_time': 0,
+            'timed_downloads': 0
         }
     
     def save_stats(self):
-        """حفظ الإحصائيات إلى الملف"""
-        try:
+        """تعليم الإحصائيات كمعدّلة - الكتابة الفعلية تتم في الخيط الخلفي"""
+        with self._lock:
             self.data['last_update'] = datetime.now().isoformat()
-            with open(self.stats_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
-            logger.debug("✅ تم حفظ الإحصائيات")
-        except Exception as e:
-            logger.error(f"❌ خطأ في حفظ الإحصائيات: {e}")
+            self._dirty_count += 1
+            pending = self._dirty_count
+        
+        if self.flush_interval <= 0 or self._worker is None:
+            self.flush()
+        elif pending >= self.flush_threshold:
+            self._flush_event.set()
+    
+    def flush(self):
+        """كتابة الإحصائيات المعلقة إلى المخزن"""
+        if self.read_only:
+            return False
+        if not self._loaded.is_set() and threading.get_ident() != self._loader_ident:
+            # لا شيء للحفظ قبل اكتمال التحميل (الأحداث مؤجلة في الذاكرة)
+            return False
+        # خيط الإحصائيات هو الكاتب الوحيد للبيانات: لا يُطبق أي حدث أثناء حفظه لها، فيكفي
+        # التقاط التغييرات تحت القفل ثم التسلسل خارجه دون حجب القراء. في الوضع المتزامن
+        # (بدون خيط) قد يطبق خيط آخر حدثاً في أي لحظة فيبقى التسلسل تحت القفل.
+        single_writer = threading.current_thread() is self._worker
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty_count:
+                    return False
+                started = time.perf_counter()
+                changes = self._changes
+                self._changes = StatsChanges()
+                if not single_writer:
+                    payload = self.backend.prepare(self.data, changes)
+                summary = {
+                    key: dict(value) if isinstance(value, dict) else value
+                    for key, value in self.data.items() if key in self.SUMMARY_KEYS
+                }
+                self._dirty_count = 0
+            
+            try:
+                if single_writer:
+                    payload = self.backend.prepare(self._data, changes)
+                bytes_written = self.backend.commit(payload)
+                self._write_summary(summary)
+            except Exception as e:
+                with self._lock:
+                    changes.merge(self._changes)
+                    self._changes = changes
+                    self._dirty_count += 1
+                logger.error(f"❌ خطأ في حفظ الإحصائيات: {e}")
+                return False
+            
+            elapsed = time.perf_counter() - started
+            metrics = self.flush_metrics
+            metrics['flushes'] += 1
+            metrics['last_flush_seconds'] = elapsed
+            metrics['max_flush_seconds'] = max(metrics['max_flush_seconds'], elapsed)
+            metrics['total_flush_seconds'] += elapsed
+            metrics['last_bytes_written'] = bytes_written
+            metrics['total_bytes_written'] += bytes_written
+            logger.debug(f"✅ تم حفظ الإحصائيات ({bytes_written} بايت في {elapsed * 1000:.1f} ms)")
+            return True
+    
+    def start_worker(self):
+        """تشغيل خيط الإحصائيات الخلفي (تطبيق الأحداث + اللقطة + الحفظ)"""
+        if self._worker and self._worker.is_alive():
+            return
+        self._worker = threading.Thread(target=self._worker_loop, name="stats-worker", daemon=True)
+        self._worker.start()
+    
+    def _worker_loop(self):
+        self._loaded.wait()
+        self._publish_snapshot()
+        next_flush = time.monotonic() + self.flush_interval
+        running = True
+        
+        while running:
+            now = time.monotonic()
+            timeout = next_flush - now
+            if self._snapshot['version'] != self._version:
+                timeout = min(timeout, self._last_publish + self.snapshot_interval - now)
+            if self.shard_id:
+                timeout = min(timeout, self._last_merge + self.merge_interval - now)
+            
+            # أخذ دفعة من الأحداث تحت قفل واحد بدل قفل لكل حدث
+            batch = []
+            try:
+                batch.append(self._events.get(timeout=max(timeout, 0)))
+                while len(batch) < 1000:
+                    batch.append(self._events.get_nowait())
+            except queue.Empty:
+                pass
+            
+            barriers = []
+            with self._lock:
+                for item in batch:
+                    if item is None:
+                        running = False
+                    elif isinstance(item, threading.Event):
+                        barriers.append(item)
+                    else:
+                        try:
+                            self._commit_event(item)
+                        except Exception as e:
+                            logger.error(f"❌ خطأ في تطبيق حدث إحصائيات {item.get('e')}: {e}")
+            
+            # هذا الخيط وحده يعدل البيانات فيبني اللقطة خارج القفل دون أن يحجب القراء
+            now = time.monotonic()
+            snapshot = self._snapshot
+            if barriers or snapshot['day'] != date.today().isoformat() or (
+                snapshot['version'] != self._version and now - self._last_publish >= self.snapshot_interval
+            ):
+                self._publish_snapshot()
+            
+            if not running or self._flush_event.is_set() or now >= next_flush:
+                self._flush_event.clear()
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"❌ خطأ في خيط حفظ الإحصائيات: {e}")
+                next_flush = time.monotonic() + self.flush_interval
+            
+            if self.shard_id and time.monotonic() - self._last_merge >= self.merge_interval:
+                self.refresh_merged_view()
+            
+            for barrier in barriers:
+                barrier.set()
+    
+    def drain(self, timeout=5):
+        """انتظار تطبيق كل الأحداث المرسلة حتى الآن (True إذا اكتمل)"""
+        worker = self._worker
+        if worker is None or not worker.is_alive() or threading.current_thread() is worker:
+            return True
+        done = threading.Event()
+        self._events.put(done)
+        return done.wait(timeout)
+    
+    def shutdown(self):
+        """إيقاف الخيط الخلفي وحفظ أي تغييرات معلقة"""
+        worker = self._worker
+        if worker and worker.is_alive():
+            self._events.put(None)
+            worker.join(timeout=10)
+        self._worker = None
+        self.wait_until_loaded()
+        self.flush()
+        self.backend.close()
+    
+    def get_flush_metrics(self):
+        """مقاييس الحفظ: زمن الكتابة وعدد البايتات"""
+        with self._lock:
+            metrics = dict(self.flush_metrics)
+            metrics['pending_changes'] = self._dirty_count
+            metrics['queued_events'] = self._events.qsize()
+        return metrics
+    
+    def _publish_snapshot(self):
+        """بناء لقطة قراءة ثابتة واستبدالها دفعة واحدة
+        
+        يُستدعى من خيط الإحصائيات (الكاتب الوحيد) دون قفل، أو تحت القفل عند عدم وجوده.
+        سجلات المستخدمين من عرض ثابت للجدول (نسخ عند الكتابة) وترتيبهم من نسخة ثابتة لشجرة
+        الترتيب في نفس اللحظة، فلا تُنسخ كل السجلات مع كل لقطة.
+        """
+        self._update_active_users()
+        data = self._data
+        today = date.today()
+        
+        def day_entry(day):
+            entry = data['daily_stats'].get(day.isoformat(), {})
+            return MappingProxyType({key: value for key, value in entry.items() if key != 'active_user_ids'})
+        
+        snapshot = {
+            key: MappingProxyType(dict(value)) if isinstance(value, dict) else value
+            for key, value in data.items() if key in self.SUMMARY_KEYS
+        }
+        users = data['users'].freeze()
+        snapshot.update({
+            'version': self._version,
+            'day': today.isoformat(),
+            'total_usage': self._total_usage,
+            'today': day_entry(today),
+            'yesterday': day_entry(today - timedelta(days=1)),
+            'top_users': tuple(
+                (user_id, MappingProxyType(dict(users[user_id]))) for user_id in self._rank_index.top(10)
+            ),
+            'top_searches': tuple(self._search_sketch.top(10)),
+            'users': users,
+            'rank': self._rank_index.freeze(),
+            # المستخدمون الفريدون للوحة التحليل تُحسب هنا (خيط الإحصائيات) فلا تأخذ اللوحة القفل
+            'unique_users': MappingProxyType({
+                days: self._unique_users(today - timedelta(days=days - 1), today) for days in (7, 30, 365)
+            }),
+            'ranges': MappingProxyType({
+                'week': self._range_stats(today - timedelta(days=6), today),
+                'month': self._range_stats(today - timedelta(days=29), today),
+                'year': self._range_stats(today - timedelta(days=364), today),
+            }),
+        })
+        self._snapshot = MappingProxyType(snapshot)
+        self._last_publish = time.monotonic()
+        self._published.set()
+    
+    def get_snapshot(self):
+        """لقطة القراءة الحالية - لا تتغير أبداً بعد نشرها لذا لا تحتاج قفلاً"""
+        view = self._read_view()
+        if view is not self:
+            return view.get_snapshot()
+        return self._local_snapshot()
+    
+    def _local_snapshot(self):
+        """لقطة هذا الجزء نفسه (بدون العرض المدمج)"""
+        worker = self._worker
+        if self._snapshot is None and worker is not None and worker.is_alive():
+            # خيط الإحصائيات ينشر أول لقطة فور اكتمال التحميل
+            self._published.wait()
+        snapshot = self._snapshot
+        if snapshot is None or (self._worker is None and snapshot['version'] != self._version):
+            self.wait_until_loaded()
+            with self._lock:
+                self._publish_snapshot()
+                snapshot = self._snapshot
+        return snapshot
+    
+    def get_user_ids(self):
+        """نسخة من معرفات المستخدمين (آمنة للتكرار أثناء إضافة مستخدمين جدد)"""
+        self.wait_until_loaded()
+        user_ids = self._data['users'].ids()
+        view = self._read_view()
+        if view is not self:
+            # مستخدمو الأجزاء الأخرى + من انضم هنا بعد آخر دمج
+            merged_ids = view.get_user_ids()
+            known = set(merged_ids)
+            user_ids = merged_ids + [user_id for user_id in user_ids if user_id not in known]
+        return user_ids
+    
+    def _read_view(self):
+        """مصدر القراءة: العرض المدمج لكل الأجزاء في وضع الأجزاء، وإلا الكائن نفسه"""
+        if not self.shard_id:
+            return self
+        if self._worker is None and time.monotonic() - self._last_merge >= self.merge_interval:
+            self.refresh_merged_view()
+        return self._merged_view or self
+    
+    def _shard_store_paths(self):
+        """مسارات المخزن الرئيسي وأجزاء العمليات الأخرى"""
+        own = self.backend.path
+        root, ext = os.path.splitext(own)
+        base = root[:-len(f".shard-{self.shard_id}")] + ext
+        return [base] + [path for path in find_stats_shards(base) if path != own]
+    
+    def _load_shard(self, path):
+        """تحميل جزء آخر للقراءة فقط (قراءة الملفات مباشرة دون إنشاء مخزن يكتب فيها)"""
+        data, events = read_stats_store(self.backend.name, path)
+        shard = AdvancedBotStats(
+            stats_file=path, backend=MemoryStatsBackend(data, events), read_only=True,
+            retention_days=self.retention_days, retention_weeks=self.retention_weeks,
+            hll_precision=self.hll_precision
+        )
+        return shard.data
+    
+    def refresh_merged_view(self):
+        """إعادة بناء العرض المدمج من هذا الجزء وأجزاء العمليات الأخرى والمخزن الرئيسي"""
+        started = time.perf_counter()
+        datasets = []
+        for path in self._shard_store_paths():
+            if not stats_store_exists(path):
+                continue
+            try:
+                datasets.append(self._load_shard(path))
+            except Exception as e:
+                logger.error(f"❌ تعذر قراءة جزء الإحصائيات {path}: {e}")
+        
+        self.wait_until_loaded()
+        if threading.current_thread() is self._worker:
+            # خيط الإحصائيات هو الوحيد الذي يعدل البيانات فيدمجها دون حجز القفل عن القراء
+            merged = merge_stats_data([self._data] + datasets)
+        else:
+            with self._lock:
+                merged = merge_stats_data([self._data] + datasets)
+        self._merged_view = AdvancedBotStats(
+            stats_file=self.stats_file, backend=MemoryStatsBackend(merged), read_only=True,
+            retention_days=self.retention_days, retention_weeks=self.retention_weeks,
+            hll_precision=self.hll_precision
+        )
+        self._last_merge = time.monotonic()
+        logger.debug(
+            f"🔀 تم دمج {len(datasets) + 1} جزء إحصائيات في {time.perf_counter() - started:.2f} ثانية"
+        )
+        return self._merged_view
     
     def add_user(self, user_id, name, username):
         """إضافة أو تحديث بيانات المستخدم"""
-        user_id_str = str(user_id)
-        now = datetime.now().isoformat()
-        today = datetime.now().date().isoformat()
+        return self._record_event({'e': 'user', 'u': str(user_id), 'n': name, 'un': username})
+    
+    def add_usage(self, user_id):
+        """تسجيل استخدام للمستخدم"""
+        self._record_event({'e': 'usage', 'u': str(user_id)})
+    
+    def add_download(self, download_type, user_id=None, platform=None, duration=None):
+        """تسجيل تحميل ناجح (duration: الزمن الكلي للطلب بالثواني إن كان مقاساً)"""
+        event = {
+            'e': 'download', 'k': download_type,
+            'u': str(user_id) if user_id else None, 'p': platform
+        }
+        if duration is not None:
+            event['d'] = round(duration, 3)
+        self._record_event(event)
+    
+    def add_search(self, user_id=None, search_term=None):
+        """تسجيل بحث"""
+        self._record_event({
+            'e': 'search', 'u': str(user_id) if user_id else None,
+            'q': SearchTermSketch.normalize(search_term)
+        })
+    
+    def add_failed_download(self, user_id=None):
+        """تسجيل تحميل فاشل"""
+        self._record_event({'e': 'failed', 'u': str(user_id) if user_id else None})
+    
+    def _record_event(self, event):
+        """تطبيق حدث على الإحصائيات وتمريره للمخزن (سجل الأحداث يلحقه كسطر واحد)"""
+        event['t'] = round(time.time(), 3)
+        if self._worker is not None:
+            # وضع الحدث في الطابور فقط - خيط الإحصائيات يطبقه ويحفظه
+            self._events.put(event)
+            return None
+        with self._lock:
+            if not self._loaded.is_set() and threading.get_ident() != self._loader_ident:
+                # التحميل الخلفي لم يكتمل: تأجيل الحدث بدل حجب المعالج
+                self._queued_events.append(event)
+                return None
+            return self._commit_event(event)
+    
+    def _commit_event(self, event):
+        self._version += 1
+        result = self._apply_event(event)
+        if event['e'] in ('user', 'usage'):
+            # تحديث إحصائيات المستخدمين النشطين اليوم
+            self._update_active_users()
+        self.backend.record(event)
+        self.save_stats()
+        return result
+    
+    def _apply_event(self, event):
+        handler = getattr(self, f"_apply_{event['e']}", None)
+        if handler is None:
+            logger.warning(f"⚠️ حدث إحصائيات غير معروف: {event.get('e')}")
+            return None
+        return handler(event, datetime.fromtimestamp(event['t']))
+    
+    def _apply_user(self, event, when):
+        user_id_str = event['u']
+        now = when.isoformat()
+        today = when.date().isoformat()
         
         is_new_user = user_id_str not in self.data['users']
         
         if is_new_user:
             self.data['total_users'] += 1
             self.data['users'][user_id_str] = {
-                'name': name,
-                'username': username or 'بدون معرف',
+                'name': event['n'],
+                'username': event['un'] or 'بدون معرف',
                 'first_seen': now,
                 'join_date': today,
                 'last_seen': now,
@@ -411,182 +3895,402 @@ class AdvancedBotStats:
                 'is_active': True
             }
         else:
-            self.data['users'][user_id_str]['last_seen'] = now
-            self.data['users'][user_id_str]['is_active'] = True
-
+            record = self.data['users'].writable(user_id_str)
+            record['last_seen'] = now
+            record['is_active'] = True
+        self._changes.users.add(user_id_str)
+        self._touch_activity(user_id_str, when.date().toordinal())
+        if is_new_user:
+            self._rank_index.set(user_id_str, 0)
+        
         daily_entry = self._ensure_daily_entry(today)
         if is_new_user:
             daily_entry['new_users'] += 1
-        self._track_daily_active_user(user_id, daily_entry)
-        
-        # تحديث إحصائيات المستخدمين النشطين اليوم
-        self._update_active_users()
-        self.save_stats()
+        self._track_daily_active_user(user_id_str, daily_entry, today)
         
         return is_new_user
     
-    def add_usage(self, user_id):
-        """تسجيل استخدام للمستخدم"""
-        user_id_str = str(user_id)
-        now = datetime.now().isoformat()
+    def _apply_usage(self, event, when):
+        user_id_str = event['u']
         
         if user_id_str in self.data['users']:
-            self.data['users'][user_id_str]['usage_count'] += 1
-            self.data['users'][user_id_str]['last_seen'] = now
-
-        self._track_daily_active_user(user_id)
+            record = self.data['users'].writable(user_id_str)
+            record['usage_count'] += 1
+            self._total_usage += 1
+            record['last_seen'] = when.isoformat()
+            self._changes.users.add(user_id_str)
+            self._touch_activity(user_id_str, when.date().toordinal())
+            self._rank_index.set(user_id_str, record['usage_count'])
         
-        self._update_active_users()
-        self.save_stats()
+        self._track_daily_active_user(user_id_str, date_str=when.date().isoformat())
     
-    def add_download(self, download_type, user_id=None, platform=None):
-        """تسجيل تحميل ناجح"""
+    def _apply_download(self, event, when):
+        download_type = event.get('k')
+        platform = event.get('p')
+        
         self.data['total_downloads'] += 1
         self.data['successful_downloads'] += 1
         
         if download_type in self.data['downloads_by_type']:
             self.data['downloads_by_type'][download_type] += 1
         
-        if user_id:
-            user_id_str = str(user_id)
-            if user_id_str in self.data['users']:
-                self.data['users'][user_id_str]['download_count'] += 1
+        self._increment_user_counter(event.get('u'), 'download_count')
         
         if platform and platform in self.data['platforms']:
             self.data['platforms'][platform] += 1
         elif platform:
             self.data['platforms']['other'] += 1
         
-        daily_entry = self._ensure_daily_entry()
+        duration = event.get('d')
+        if duration is not None:
+            # متوسط تراكمي على التحميلات المقاسة فقط
+            self.data['timed_downloads'] += 1
+            average = self.data['average_download_time']
+            self.data['average_download_time'] = average + (duration - average) / self.data['timed_downloads']
+        
+        daily_entry = self._ensure_daily_entry(when.date().isoformat())
         daily_entry['downloads'] += 1
-        self.save_stats()
     
-    def add_search(self, user_id=None, search_term=None):
-        """تسجيل بحث"""
+    def _apply_search(self, event, when):
+        search_term = event.get('q')
+        
         self.data['total_searches'] += 1
         
         if search_term:
-            if search_term not in self.data['search_terms']:
-                self.data['search_terms'][search_term] = 0
-            self.data['search_terms'][search_term] += 1
+            evicted = self._search_sketch.add(search_term)
+            self._changes.terms.add(search_term)
+            if evicted:
+                self._changes.terms.add(evicted)
         
-        if user_id:
-            user_id_str = str(user_id)
-            if user_id_str in self.data['users']:
-                self.data['users'][user_id_str]['search_count'] += 1
+        self._increment_user_counter(event.get('u'), 'search_count')
         
-        daily_entry = self._ensure_daily_entry()
+        daily_entry = self._ensure_daily_entry(when.date().isoformat())
         daily_entry['searches'] += 1
-        self.save_stats()
     
-    def add_failed_download(self, user_id=None):
-        """تسجيل تحميل فاشل"""
+    def _apply_failed(self, event, when):
         self.data['total_errors'] += 1
         self.data['failed_downloads'] += 1
         
-        if user_id:
-            user_id_str = str(user_id)
-            if user_id_str in self.data['users']:
-                self.data['users'][user_id_str]['failed_count'] += 1
-
-        daily_entry = self._ensure_daily_entry()
-        daily_entry['failed'] += 1
+        self._increment_user_counter(event.get('u'), 'failed_count')
         
-        self.save_stats()
+        daily_entry = self._ensure_daily_entry(when.date().isoformat())
+        daily_entry['failed'] += 1
     
-    def _update_active_users(self):
-        """تحديث إحصائيات المستخدمين النشطين"""
-        from datetime import datetime, timedelta
+    def _increment_user_counter(self, user_id_str, field):
+        if user_id_str and user_id_str in self.data['users']:
+            self.data['users'].writable(user_id_str)[field] += 1
+            self._changes.users.add(user_id_str)
+    
+    def _rebuild_indexes(self):
+        """بناء الفهارس الداخلية مرة واحدة بعد التحميل"""
+        self._rebuild_activity_index()
+        self._rank_index = UsageRankIndex()
+        self._total_usage = 0
+        for user_id_str, user_data in self.data['users'].items():
+            self._rank_index.set(user_id_str, user_data.get('usage_count', 0))
+            self._total_usage += user_data.get('usage_count', 0)
         
-        now = datetime.now()
-        today = now.date()
-        week_ago = today - timedelta(days=7)
-        month_ago = today - timedelta(days=30)
+        # مصطلحات البحث تُحفظ في ملخص محدود الحجم يشارك القاموس نفسه مع data
+        saved_terms = self.data['search_terms'] or {}
+        self._search_sketch, dropped = SearchTermSketch.from_counts(saved_terms)
+        self.data['search_terms'] = self._search_sketch.counts
+        # المصطلحات التي غيّرها التوحيد (مفتاح جديد أو عداد مدموج) تُكتب مع حذف القديمة
+        changed = [term for term, count in self._search_sketch.counts.items() if saved_terms.get(term) != count]
+        if dropped or changed:
+            self._changes.terms.update(dropped)
+            self._changes.terms.update(changed)
+            self._dirty_count += 1
         
-        active_today = 0
-        active_week = 0
-        active_month = 0
+        # ملخصات الأيام المحفوظة تُبنى من معرفاتها (لا حاجة لتخزينها)
+        self._day_sketches = {}
+        if self.hll_precision:
+            for day_key, entry in self.data['daily_stats'].items():
+                self._day_sketches[day_key] = HyperLogLog(self.hll_precision).update(entry.get('active_user_ids', ()))
+    
+    def _rebuild_activity_index(self):
+        """بناء فهرس النشاط اليومي مرة واحدة عند التحميل: آخر يوم نشاط لكل مستخدم وعدد المستخدمين لكل يوم"""
+        self._last_seen_day = {}
+        self._activity_by_day = {}
+        for user_id_str, user_data in self.data['users'].items():
+            day = user_data.last_seen_day()
+            if day is None:
+                continue
+            self._last_seen_day[user_id_str] = day
+            self._activity_by_day[day] = self._activity_by_day.get(day, 0) + 1
+    
+    def _touch_activity(self, user_id_str, day):
+        """نقل المستخدم إلى دلو يوم نشاطه الجديد - O(1) لكل حدث"""
+        previous = self._last_seen_day.get(user_id_str)
+        if previous == day:
+            return
+        if previous is not None:
+            self._activity_by_day[previous] -= 1
+            if not self._activity_by_day[previous]:
+                del self._activity_by_day[previous]
+        self._last_seen_day[user_id_str] = day
+        self._activity_by_day[day] = self._activity_by_day.get(day, 0) + 1
+    
+    def _update_active_users(self):
+        """تحديث إحصائيات المستخدمين النشطين من دلاء الأيام (31 عملية بحث بدل مسح كل المستخدمين)"""
+        today = datetime.now().date().toordinal()
+        by_day = self._activity_by_day
         
-        for user_data in self.data['users'].values():
-            last_seen = datetime.fromisoformat(user_data['last_seen']).date()
-            
-            if last_seen == today:
-                active_today += 1
-            if last_seen >= week_ago:
-                active_week += 1
-            if last_seen >= month_ago:
-                active_month += 1
+        active_today = by_day.get(today, 0)
+        active_week = active_today + sum(by_day.get(today - offset, 0) for offset in range(1, 8))
+        active_month = active_week + sum(by_day.get(today - offset, 0) for offset in range(8, 31))
         
         self.data['active_users_today'] = active_today
         self.data['active_users_week'] = active_week
         self.data['active_users_month'] = active_month
 
     def _ensure_daily_entry(self, date_str=None):
+        """إرجاع مدخل اليوم - البيانات المحملة مطبّعة مسبقاً في _ensure_structure لذا يكفي بحث مباشر"""
         today = date_str or datetime.now().date().isoformat()
-        if today not in self.data['daily_stats']:
-            self.data['daily_stats'][today] = {
+        if self._retention_day is None or today > self._retention_day:
+            # أول حدث بعد التحميل أو يوم جديد: تجميع الأيام التي خرجت من فترة الاحتفاظ
+            self._apply_retention(date.fromisoformat(today))
+        entry = self.data['daily_stats'].get(today)
+        if entry is None:
+            entry = {
                 'downloads': 0,
                 'searches': 0,
                 'new_users': 0,
                 'active_users': 0,
                 'failed': 0,
-                'active_user_ids': []
+                'active_user_ids': set()
             }
-        else:
-            self._normalize_daily_stats()
-        return self.data['daily_stats'][today]
-
-    def _track_daily_active_user(self, user_id, daily_entry=None):
-        entry = daily_entry or self._ensure_daily_entry()
+            self.data['daily_stats'][today] = entry
+        self._changes.days.add(today)
+        return entry
+
+    def _apply_retention(self, today=None):
+        """نقل الأيام الأقدم من فترة الاحتفاظ إلى تجميعات أسبوعية، والأسابيع القديمة إلى تجميعات شهرية"""
+        today = today or datetime.now().date()
+        self._retention_day = today.isoformat()
+        if self.retention_days <= 0:
+            return 0
+        
+        daily_stats = self.data['daily_stats']
+        weekly_stats = self.data['weekly_stats']
+        monthly_stats = self.data['monthly_stats']
+        rolled = 0
+        
+        day_cutoff = (today - timedelta(days=self.retention_days - 1)).isoformat()
+        for day_key in [key for key in daily_stats if key < day_cutoff]:
+            try:
+                day = date.fromisoformat(day_key)
+            except ValueError:
+                continue
+            entry = daily_stats.pop(day_key)
+            week = merge_rollup(weekly_stats.setdefault(week_key(day), {}), entry)
+            sketch = self._day_sketches.pop(day_key, None)
+            if self.hll_precision:
+                if sketch is None:
+                    sketch = HyperLogLog(self.hll_precision).update(entry.get('active_user_ids', ()))
+                merge_active_sketch(week, sketch, 1)
+            self._changes.days.add(day_key)
+            rolled += 1
+        
+        if self.retention_weeks > 0:
+            week_cutoff = today - timedelta(days=today.weekday(), weeks=self.retention_weeks)
+            for key in list(weekly_stats):
+                try:
+                    week_start, _ = week_bounds(key)
+                except ValueError:
+                    continue
+                if week_start < week_cutoff:
+                    # الأسبوع الذي يعبر حد شهرين يُوزع عليهما بنسبة أيامه في كل منهما،
+                    # وملخص المستخدمين (لا يتجزأ) يُضاف إلى الشهرين كليهما
+                    entry = weekly_stats.pop(key)
+                    for month_key, part, sketch_days in split_week_by_month(week_start, entry):
+                        month = merge_rollup(monthly_stats.setdefault(month_key, {}), part)
+                        if 'active_sketch' in entry:
+                            merge_active_sketch(month, entry['active_sketch'], sketch_days)
+                    rolled += 1
+        
+        if rolled:
+            self._dirty_count += 1
+            logger.info(f"📦 تم تجميع {rolled} مدخل قديم من الإحصائيات اليومية/الأسبوعية")
+        return rolled
+    
+    def get_range_stats(self, start, end):
+        """مجموع الإحصائيات بين تاريخين (شاملين) بدمج المستويات اليومية والأسبوعية والشهرية
+        
+        التجميع الذي يتقاطع جزئياً مع الفترة يُحسب بنسبة أيامه التقويمية داخلها (بافتراض
+        توزيع منتظم على أيامه) ثم تُقرب المجاميع لأعداد صحيحة؛ ذروة المستخدمين تبقى ذروة
+        التجميع كله. الحقل granularity يوضح أخشن مستوى استُخدم.
+        """
+        self.wait_until_loaded()
+        with self._lock:
+            return self._range_stats(start, end)
+    
+    def _range_stats(self, start, end):
+        if isinstance(start, str):
+            start = date.fromisoformat(start)
+        if isinstance(end, str):
+            end = date.fromisoformat(end)
+        
+        totals = {field: 0 for field in ROLLUP_FIELDS}
+        totals.update({'active_user_days': 0, 'peak_active_users': 0, 'days': 0, 'granularity': 'day'})
+        
+        start_key, end_key = start.isoformat(), end.isoformat()
+        for day_key, entry in self._data['daily_stats'].items():
+            if start_key <= day_key <= end_key:
+                merge_rollup(totals, entry)
+        
+        tiers = (
+            ('week', self._data['weekly_stats'], week_bounds),
+            ('month', self._data['monthly_stats'], month_bounds),
+        )
+        for granularity, buckets, bounds in tiers:
+            for key, entry in buckets.items():
+                try:
+                    bucket_start, bucket_end = bounds(key)
+                except ValueError:
+                    continue
+                overlap = (min(bucket_end, end) - max(bucket_start, start)).days + 1
+                if overlap <= 0:
+                    continue
+                span = (bucket_end - bucket_start).days + 1
+                merge_rollup(totals, entry if overlap >= span else prorate_rollup(entry, overlap / span))
+                totals['granularity'] = granularity
+        for field in ROLLUP_FIELDS + ('active_user_days', 'days'):
+            totals[field] = round(totals[field])
+        return totals
+    
+    def get_unique_users(self, start, end):
+        """عدد المستخدمين الفريدين بين تاريخين (شاملين)
+        
+        داخل فترة الاحتفاظ اليومية يكون العدد دقيقاً من معرفات الأيام. الفترات التي تشمل تجميعات
+        أسبوعية/شهرية تحتاج STATS_HLL_PRECISION وتُعيد تقديراً (exact=False)، و complete=False يعني
+        أن بعض الأيام جُمّعت قبل تفعيل الملخصات فالعدد حد أدنى. users=None إذا تعذر الحساب.
+        التجميعات التي تتقاطع جزئياً مع الفترة تُحسب كاملة لأن الملخص لا يتجزأ (بخلاف
+        get_range_stats التي توزعها بنسبة أيامها)، فقد يزيد العدد عن الفترة نفسها.
+        """
+        view = self._read_view()
+        if view is not self:
+            return view.get_unique_users(start, end)
+        if isinstance(start, str):
+            start = date.fromisoformat(start)
+        if isinstance(end, str):
+            end = date.fromisoformat(end)
+        
+        self.wait_until_loaded()
+        return self._unique_users(start, end)
+    
+    def _unique_users(self, start, end):
+        """حساب get_unique_users لهذا الجزء نفسه (بعد اكتمال التحميل)"""
+        with self._lock:
+            start_key, end_key = start.isoformat(), end.isoformat()
+            days = [day_key for day_key in self.data['daily_stats'] if start_key <= day_key <= end_key]
+            
+            rollup_sketches = []
+            complete = True
+            tiers = ((self.data['weekly_stats'], week_bounds), (self.data['monthly_stats'], month_bounds))
+            for buckets, bounds in tiers:
+                for key, entry in buckets.items():
+                    try:
+                        bucket_start, bucket_end = bounds(key)
+                    except ValueError:
+                        continue
+                    if bucket_start <= end and bucket_end >= start:
+                        rollup_sketches.append(entry.get('active_sketch'))
+                        complete = complete and entry.get('sketch_days', 0) >= entry.get('days', 0)
+            
+            if not rollup_sketches:
+                daily_stats = self.data['daily_stats']
+                unique = set().union(*(daily_stats[day_key]['active_user_ids'] for day_key in days))
+                return {'users': len(unique), 'exact': True, 'complete': True}
+            if not self.hll_precision:
+                return {'users': None, 'exact': False, 'complete': False}
+            day_sketches = [self._day_sketches[day_key].copy() for day_key in days if day_key in self._day_sketches]
+        
+        # الدمج خارج القفل (نسخ الملخصات اليومية ونصوص التجميعات ثابتة)
+        merged = merge_sketches(day_sketches + rollup_sketches)
+        return {'users': merged.count() if merged else 0, 'exact': False, 'complete': complete}
+    
+    def _track_daily_active_user(self, user_id, daily_entry=None, date_str=None):
+        today = date_str or datetime.now().date().isoformat()
+        entry = daily_entry or self._ensure_daily_entry(today)
         user_id_str = str(user_id)
-        if user_id_str not in entry['active_user_ids']:
-            entry['active_user_ids'].append(user_id_str)
+        try:
+            user_id_int = int(user_id)
+        except (TypeError, ValueError):
+            return
+        if user_id_int not in entry['active_user_ids']:
+            entry['active_user_ids'].add(user_id_int)
             entry['active_users'] = len(entry['active_user_ids'])
+            self._changes.active.add((today, user_id_str))
+            if self.hll_precision:
+                sketch = self._day_sketches.get(today)
+                if sketch is None:
+                    sketch = self._day_sketches[today] = HyperLogLog(self.hll_precision)
+                sketch.add(user_id_int)
     
     def _update_daily_stats(self):
         """تحديث الإحصائيات اليومية"""
         today = datetime.now().date().isoformat()
         
-        if today not in self.data['daily_stats']:
-            self.data['daily_stats'][today] = {
-                'downloads': 0,
-                'searches': 0,
-                'new_users': 0,
-                'active_users': 0,
-                'failed': 0
-            }
-        
         entry = self._ensure_daily_entry(today)
         entry['active_users'] = max(entry['active_users'], self.data.get('active_users_today', 0))
     
     def get_user_rank(self, user_id):
         """الحصول على ترتيب المستخدم من حيث النشاط"""
-        user_id_str = str(user_id)
-        
-        sorted_users = sorted(
-            self.data['users'].items(),
-            key=lambda x: x[1]['usage_count'],
-            reverse=True
-        )
+        view = self._read_view()
+        if view is not self:
+            return view.get_user_rank(user_id)
+        snapshot = self._local_snapshot()
+        record = snapshot['users'].get(str(user_id))
+        if record is None:
+            return None
+        return snapshot['rank'].rank(record['usage_count'])
+    
+    def get_top_users(self, limit=5):
+        """أكثر المستخدمين نشاطاً كقائمة (المعرف، بيانات المستخدم)"""
+        view = self._read_view()
+        if view is not self:
+            return view.get_top_users(limit)
+        self.wait_until_loaded()
+        with self._lock:
+            users = self.data['users']
+            return [(user_id, users[user_id]) for user_id in self._rank_index.top(limit)]
+    
+    RENDER_CACHE_SIZE = 1024
+    
+    def _render_cached(self, key, render):
+        """نص لوحة من الذاكرة المؤقتة - يُعاد بناؤه فقط إذا تغيرت اللقطة ومرّ أقل فاصل منذ آخر بناء"""
+        snapshot = self.get_snapshot()
         
-        for rank, (uid, _) in enumerate(sorted_users, 1):
-            if uid == user_id_str:
-                return rank
+        def fresh(entry):
+            return entry is not None and (
+                entry[0] is snapshot or time.monotonic() - entry[1] < self.render_min_interval
+            )
         
-        return None
+        entry = self._render_cache.get(key)
+        if fresh(entry):
+            return entry[2]
+        with self._render_lock:
+            # طلب متزامن آخر ربما بنى النص أثناء الانتظار
+            entry = self._render_cache.get(key)
+            if fresh(entry):
+                return entry[2]
+            text = render(snapshot)
+            if text is not None:
+                if key not in self._render_cache and len(self._render_cache) >= self.RENDER_CACHE_SIZE:
+                    self._render_cache.pop(next(iter(self._render_cache)))
+                self._render_cache[key] = (snapshot, time.monotonic(), text)
+        return text
     
     def get_stats_text(self):
-        """الحصول على نص الإحصائيات المفصل"""
+        """الحصول على نص الإحصائيات المفصل (يُبنى مرة واحدة لكل لقطة مهما تكرر الطلب)"""
+        return self._render_cached('general', self._render_stats_text)
+    
+    def _render_stats_text(self, snapshot):
+        """بناء نص الإحصائيات المفصل من لقطة القراءة"""
         from datetime import datetime
         
-        self._update_active_users()
-        
         # أكثر المستخدمين نشاطاً
-        top_users = sorted(
-            self.data['users'].items(),
-            key=lambda x: x[1]['usage_count'],
-            reverse=True
-        )[:5]
+        top_users = snapshot['top_users'][:5]
         
         top_users_text = "\n".join([
             f"  {i+1}. {user[1]['name']} (@{user[1]['username']}) - {user[1]['usage_count']} استخدام"
@@ -594,11 +4298,7 @@ class AdvancedBotStats:
         ]) if top_users else "  لا يوجد مستخدمين بعد"
         
         # أكثر الأغاني بحثاً
-        top_searches = sorted(
-            self.data['search_terms'].items(),
-            key=lambda x: x[1],
-            reverse=True
-        )[:3]
+        top_searches = snapshot['top_searches'][:3]
         
         top_searches_text = "\n".join([
             f"  {i+1}. {term} ({count} مرات)"
@@ -607,7 +4307,7 @@ class AdvancedBotStats:
         
         # المنصات الأكثر استخداماً
         platforms_sorted = sorted(
-            self.data['platforms'].items(),
+            snapshot['platforms'].items(),
             key=lambda x: x[1],
             reverse=True
         )
@@ -618,88 +4318,230 @@ class AdvancedBotStats:
         ]) if any(count > 0 for _, count in platforms_sorted) else "  لا توجد تحميلات بعد"
         
         # حساب معدل النجاح
-        success_rate = 100 if self.data['total_downloads'] == 0 else (
-            (self.data['successful_downloads'] / self.data['total_downloads']) * 100
+        success_rate = 100 if snapshot['total_downloads'] == 0 else (
+            (snapshot['successful_downloads'] / snapshot['total_downloads']) * 100
         )
         
         # حساب أيام التشغيل
-        start_date = datetime.fromisoformat(self.data['start_date'])
+        start_date = datetime.fromisoformat(snapshot['start_date'])
         days_running = (datetime.now() - start_date).days + 1
         
         stats_text = f"""
 ╔════════════════════════════════════════════════════════════════╗
-║              📊 إحصائيات البوت الشاملة (v{self.data['bot_version']})          ║
+║              📊 إحصائيات البوت الشاملة (v{snapshot['bot_version']})          ║
 ╚════════════════════════════════════════════════════════════════╝
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 👥 **إحصائيات المستخدمين**
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-  👨‍💼 إجمالي المستخدمين: {self.data['total_users']}
-  🟢 النشطين اليوم: {self.data['active_users_today']}
-  🟠 النشطين هذا الأسبوع: {self.data['active_users_week']}
-  🟡 النشطين هذا الشهر: {self.data['active_users_month']}
+  👨‍💼 إجمالي المستخدمين: {snapshot['total_users']}
+  🟢 النشطين اليوم: {snapshot['active_users_today']}
+  🟠 النشطين هذا الأسبوع: {snapshot['active_users_week']}
+  🟡 النشطين هذا الشهر: {snapshot['active_users_month']}
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 📥 **إحصائيات التحميلات**
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-  📊 إجمالي التحميلات: {self.data['total_downloads']}
-  ✅ التحميلات الناجحة: {self.data['successful_downloads']}
-  ❌ التحميلات الفاشلة: {self.data['failed_downloads']}
+  📊 إجمالي التحميلات: {snapshot['total_downloads']}
+  ✅ التحميلات الناجحة: {snapshot['successful_downloads']}
+  ❌ التحميلات الفاشلة: {snapshot['failed_downloads']}
   
   **التفصيل:**
-    🎬 فيديوهات: {self.data['downloads_by_type']['video']}
-    🎵 موسيقى: {self.data['downloads_by_type']['audio']}
-    📸 صور: {self.data['downloads_by_type']['image']}
-    🎶 أغاني (بحث): {self.data['downloads_by_type']['search']}
-    📹 قصص: {self.data['downloads_by_type']['story']}
+    🎬 فيديوهات: {snapshot['downloads_by_type']['video']}
+    🎵 موسيقى: {snapshot['downloads_by_type']['audio']}
+    📸 صور: {snapshot['downloads_by_type']['image']}
+    🎶 أغاني (بحث): {snapshot['downloads_by_type']['search']}
+    📹 قصص: {snapshot['downloads_by_type']['story']}
   
   📈 معدل النجاح: {success_rate:.1f}%
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-🔍 **إحصائيات البحث**
+🔍 **إحصائيات البحث**
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+  🔎 إجمالي عمليات البحث: {snapshot['total_searches']}
+  
+  **أكثر الأغاني بحثاً:**
+{top_searches_text}
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+🌐 **المنصات الأكثر استخداماً**
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+{platforms_text}
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+🏆 **أكثر المستخدمين نشاطاً**
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+{top_users_text}
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+⚙️ **معلومات عامة**
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+  📅 تاريخ البدء: {snapshot['start_date'][:10]}
+  ⏰ أيام التشغيل: {days_running} يوم
+  🔧 آخر تحديث: {snapshot['last_update'][11:19]}
+
+╚════════════════════════════════════════════════════════════════╝
+        """
+        
+        return stats_text
+    
+    def get_charts_text(self):
+        """نص لوحة التحليل المتقدم (مخزن مؤقتاً مثل باقي اللوحات)"""
+        return self._render_cached('charts', self._render_charts_text)
+    
+    def _render_charts_text(self, snapshot):
+        """بناء نص لوحة التحليل المتقدم من لقطة القراءة"""
+        from datetime import datetime
+        
+        # حساب الإحصائيات المتقدمة (من لقطة القراءة الثابتة)
+        total_users = snapshot['total_users']
+        total_downloads = snapshot['total_downloads']
+        total_searches = snapshot['total_searches']
+        
+        # معدل النجاح
+        success_rate = 100 if total_downloads == 0 else (
+            (snapshot['successful_downloads'] / total_downloads) * 100
+        )
+        
+        # متوسط الاستخدام لكل مستخدم
+        total_usage = snapshot['total_usage']
+        avg_usage = total_usage / total_users if total_users > 0 else 0
+        
+        # حساب النمو اليومي
+        today_downloads = snapshot['today'].get('downloads', 0)
+        yesterday_downloads = snapshot['yesterday'].get('downloads', 0)
+        
+        growth = 0
+        if yesterday_downloads > 0:
+            growth = ((today_downloads - yesterday_downloads) / yesterday_downloads) * 100
+        
+        # أيام التشغيل
+        start_date = datetime.fromisoformat(snapshot['start_date'])
+        days_running = (datetime.now() - start_date).days + 1
+        
+        # مجاميع الفترات (تدمج الأيام الخام مع التجميعات الأسبوعية والشهرية)
+        last_week = snapshot['ranges']['week']
+        last_month = snapshot['ranges']['month']
+        last_year = snapshot['ranges']['year']
+        
+        # المستخدمون الفريدون: دقيق داخل فترة الاحتفاظ، وتقديري (~) من ملخصات HyperLogLog بعدها
+        def unique_text(days):
+            result = snapshot['unique_users'][days]
+            if result['users'] is None:
+                return "غير متاح"
+            prefix = "" if result['exact'] else ("~" if result['complete'] else "≥~")
+            return f"{prefix}{result['users']:,}"
+        
+        uniques_text = f"7 أيام {unique_text(7)} | 30 يوم {unique_text(30)} | سنة {unique_text(365)}"
+        
+        # متوسط التحميلات اليومية
+        avg_daily_downloads = total_downloads / days_running if days_running > 0 else 0
+        
+        # أكثر أنواع التحميلات
+        downloads_by_type = snapshot['downloads_by_type']
+        top_type = max(downloads_by_type, key=downloads_by_type.get) if downloads_by_type else "لا يوجد"
+        
+        # أكثر المنصات استخداماً
+        platforms = snapshot['platforms']
+        top_platform = max(platforms, key=platforms.get) if platforms else "لا يوجد"
+        
+        # أداء حفظ الإحصائيات
+        flush_metrics = self.get_flush_metrics()
+        avg_flush_ms = (
+            flush_metrics['total_flush_seconds'] / flush_metrics['flushes'] * 1000
+            if flush_metrics['flushes'] else 0
+        )
+        
+        charts_msg = f"""
+╔════════════════════════════════════════════════════════════════╗
+║           📈 التحليل المتقدم والرسوم البيانية           ║
+╚════════════════════════════════════════════════════════════════╝
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+📊 **الإحصائيات الأساسية**
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+  إجمالي المستخدمين: {total_users:,}
+  إجمالي التحميلات: {total_downloads:,}
+  إجمالي عمليات البحث: {total_searches:,}
+  أيام التشغيل: {days_running}
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+📈 **معدلات الأداء**
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+  معدل النجاح: {success_rate:.1f}%
+  متوسط التحميلات اليومية: {avg_daily_downloads:.1f}
+  متوسط الاستخدام للمستخدم: {avg_usage:.1f}
+  متوسط زمن التحميل: {snapshot['average_download_time']:.1f} ث
+  نمو التحميلات (اليوم): {growth:+.1f}%
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+🗓️ **الفترات**
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-  🔎 إجمالي عمليات البحث: {self.data['total_searches']}
-  
-  **أكثر الأغاني بحثاً:**
-{top_searches_text}
+  آخر 7 أيام: {last_week['downloads']:,} تحميل | {last_week['searches']:,} بحث | ذروة {last_week['peak_active_users']:,} نشط
+  آخر 30 يوم: {last_month['downloads']:,} تحميل | {last_month['searches']:,} بحث | ذروة {last_month['peak_active_users']:,} نشط
+  آخر سنة: {last_year['downloads']:,} تحميل | {last_year['searches']:,} بحث | ذروة {last_year['peak_active_users']:,} نشط
+  مستخدمون فريدون: {uniques_text}
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-🌐 **المنصات الأكثر استخداماً**
+🎯 **التصنيفات الأكثر شيوعاً**
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-{platforms_text}
+  أكثر نوع تحميل: {top_type.upper() if top_type != 'لا يوجد' else top_type}
+  أكثر منصة: {top_platform.upper() if top_platform != 'لا يوجد' else top_platform}
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-🏆 **أكثر المستخدمين نشاطاً**
+📅 **معلومات التاريخ**
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-{top_users_text}
+  تاريخ البدء: {snapshot['start_date'][:10]}
+  آخر تحديث: {snapshot['last_update']}
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-⚙️ **معلومات عامة**
+💾 **حفظ الإحصائيات**
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-  📅 تاريخ البدء: {self.data['start_date'][:10]}
-  ⏰ أيام التشغيل: {days_running} يوم
-  🔧 آخر تحديث: {self.data['last_update'][11:19]}
+  عمليات الحفظ: {flush_metrics['flushes']:,}
+  متوسط زمن الحفظ: {avg_flush_ms:.1f} ms (الأقصى {flush_metrics['max_flush_seconds'] * 1000:.1f} ms)
+  آخر حجم مكتوب: {flush_metrics['last_bytes_written']:,} بايت
+  إجمالي المكتوب: {flush_metrics['total_bytes_written']:,} بايت
+  تغييرات معلقة: {flush_metrics['pending_changes']}
 
 ╚════════════════════════════════════════════════════════════════╝
         """
         
-        return stats_text
+        return charts_msg
     
     def get_user_stats(self, user_id):
         """الحصول على إحصائيات المستخدم الفردي"""
+        return self._render_cached(('user', str(user_id)), lambda snapshot: self._render_user_stats(user_id))
+    
+    def _render_user_stats(self, user_id):
         user_id_str = str(user_id)
         
-        if user_id_str not in self.data['users']:
-            return None
+        view = self._read_view()
+        if view is not self:
+            # المستخدم الذي انضم بعد آخر دمج موجود في هذا الجزء فقط
+            user_stats = view.get_user_stats(user_id)
+            if user_stats:
+                return user_stats
         
-        user = self.data['users'][user_id_str]
-        rank = self.get_user_rank(user_id)
+        snapshot = self._local_snapshot()
+        record = snapshot['users'].get(user_id_str)
+        if record is None:
+            return None
+        # نسخة من سجل المستخدم حتى لا يتغير أثناء بناء النص
+        user = dict(record)
+        rank = snapshot['rank'].rank(user['usage_count'])
+        total_users = snapshot['total_users']
         
         user_stats = f"""
 ╔════════════════════════════════════════════════════════════════╗
@@ -715,7 +4557,7 @@ class AdvancedBotStats:
     • عمليات البحث: {user['search_count']}
     • الأخطاء: {user['failed_count']}
   
-  📊 الترتيب: #{rank if rank else 'غير محدد'} من بين {self.data['total_users']} مستخدم
+  📊 الترتيب: #{rank if rank else 'غير محدد'} من بين {total_users} مستخدم
   📅 الانضمام: {user['join_date']}
   ⏰ آخر نشاط: {user['last_seen'][11:19]}
 
@@ -724,8 +4566,150 @@ class AdvancedBotStats:
         
         return user_stats
 
-# إنشاء كائن الإحصائيات المتقدم
-stats = AdvancedBotStats()
+def merge_stats_data(datasets):
+    """دمج بيانات عدة أجزاء إحصائيات (مطبّعة) في بيانات واحدة
+    
+    - العدادات الإجمالية وعدادات الأنواع والمنصات ومصطلحات البحث: جمع
+    - المستخدمون: جمع العدادات، أقدم first_seen/join_date، وأحدث last_seen مع الاسم والمعرف المرافقين له
+    - الأيام: جمع العدادات واتحاد معرفات النشطين (active_users = حجم الاتحاد)
+    - التجميعات الأسبوعية والشهرية: جمع العدادات وأعلى ذروة واتحاد ملخصات المستخدمين الفريدين
+    - total_users = عدد المستخدمين المختلفين (new_users اليومي قد يعد المستخدم في أكثر من جزء)
+    """
+    counters = ('total_downloads', 'successful_downloads', 'failed_downloads', 'total_searches', 'total_errors',
+                'timed_downloads')
+    merged = {
+        'users': UserTable(), 'daily_stats': {}, 'weekly_stats': {}, 'monthly_stats': {},
+        'daily_stats_version': 2, 'premium_features': [],
+    }
+    total_download_time = 0.0
+    sketch_coverage = {}
+    
+    for data in datasets:
+        for key in counters:
+            merged[key] = merged.get(key, 0) + data.get(key, 0)
+        for key in ('downloads_by_type', 'platforms', 'search_terms'):
+            target = merged.setdefault(key, {})
+            for name, count in data.get(key, {}).items():
+                target[name] = target.get(name, 0) + count
+        if data.get('start_date') and ('start_date' not in merged or data['start_date'] < merged['start_date']):
+            merged['start_date'] = data['start_date']
+        if data.get('last_update') and data['last_update'] > merged.get('last_update', ''):
+            merged['last_update'] = data['last_update']
+        merged.setdefault('bot_version', data.get('bot_version', '2.5'))
+        for feature in data.get('premium_features', []):
+            if feature not in merged['premium_features']:
+                merged['premium_features'].append(feature)
+        total_download_time += data.get('average_download_time', 0) * data.get('timed_downloads', 0)
+        
+        users = merged['users']
+        for user_id, record in data.get('users', {}).items():
+            target = users.get(user_id)
+            if target is None:
+                users[user_id] = UserRecord(record)
+                continue
+            for field in ('usage_count', 'download_count', 'search_count', 'failed_count'):
+                target[field] += record.get(field, 0)
+            if record['last_seen'] > target['last_seen']:
+                target['last_seen'] = record['last_seen']
+                target['name'] = record['name']
+                target['username'] = record['username']
+            target['first_seen'] = min(target['first_seen'], record['first_seen'])
+            target['join_date'] = min(target['join_date'], record['join_date'])
+            target['is_active'] = target['is_active'] or record['is_active']
+        
+        for day_key, entry in data.get('daily_stats', {}).items():
+            target = merged['daily_stats'].setdefault(day_key, {
+                'downloads': 0, 'searches': 0, 'new_users': 0, 'active_users': 0, 'failed': 0,
+                'active_user_ids': set()
+            })
+            for field in ROLLUP_FIELDS:
+                target[field] += entry.get(field, 0)
+            target['active_user_ids'] |= entry.get('active_user_ids', set())
+            target['active_users'] = max(len(target['active_user_ids']), target['active_users'], entry.get('active_users', 0))
+        
+        for tier in ('weekly_stats', 'monthly_stats'):
+            for key, entry in data.get(tier, {}).items():
+                target = merged[tier].setdefault(key, {})
+                for field in ROLLUP_FIELDS + ('active_user_days',):
+                    target[field] = target.get(field, 0) + entry.get(field, 0)
+                target['peak_active_users'] = max(target.get('peak_active_users', 0), entry.get('peak_active_users', 0))
+                target['days'] = max(target.get('days', 0), entry.get('days', 0))
+                # نفس الفترة في كل جزء: اتحاد الملخصات، والتغطية هي أقل تغطية بين الأجزاء
+                covered = entry.get('sketch_days', 0) if 'active_sketch' in entry else 0
+                sketch_coverage[tier, key] = min(sketch_coverage.get((tier, key), covered), covered)
+                if 'active_sketch' in entry:
+                    merge_active_sketch(target, entry['active_sketch'], 0)
+    
+    for (tier, key), covered in sketch_coverage.items():
+        if 'active_sketch' in merged[tier][key]:
+            merged[tier][key]['sketch_days'] = covered
+    
+    merged['total_users'] = len(merged['users'])
+    timed = merged.get('timed_downloads', 0)
+    merged['average_download_time'] = total_download_time / timed if timed else 0
+    return merged
+
+def consolidate_stats_shards(stats_file=None, kind=None):
+    """دمج كل الأجزاء في المخزن الرئيسي (يُشغَّل بعد إيقاف كل العمليات) مع الاحتفاظ بالأجزاء كنسخ"""
+    stats_file = stats_file or STATS_FILE
+    backend = create_stats_backend(kind, stats_file)
+    shard_files = find_stats_shards(backend.path)
+    if not shard_files:
+        backend.close()
+        logger.info("ℹ️ لا توجد أجزاء إحصائيات للدمج")
+        return 0
+    
+    base = AdvancedBotStats(stats_file=stats_file, flush_interval=0, backend=backend)
+    datasets = [base._load_shard(path) for path in shard_files]
+    with base._lock:
+        base.data = merge_stats_data([base.data] + datasets)
+        base._ensure_structure()
+        base._rebuild_indexes()
+        base._changes.full = True
+        base._dirty_count += 1
+    base.shutdown()
+    
+    # نقل ملفات كل جزء (مع سجل أحداثه وملخصه) حتى لا يُعاد احتسابها عند تشغيله مجدداً
+    suffix = datetime.now().strftime('%Y%m%d%H%M%S')
+    for path in shard_files:
+        for extra in ('', '.journal', '.journal.1', '.summary', '-wal', '-shm'):
+            if os.path.exists(path + extra):
+                os.replace(path + extra, f"{path}{extra}.merged-{suffix}")
+    logger.info(f"✅ تم دمج {len(shard_files)} جزء في {backend.path}")
+    return len(shard_files)
+
+# إنشاء كائن الإحصائيات المتقدم (التحميل الكامل يتم في الخلفية)
+stats = AdvancedBotStats(lazy=STATS_LAZY_LOAD, shard_id=STATS_SHARD_ID)
+atexit.register(stats.shutdown)
+
+def collect_stats_metrics():
+    """عدادات الإحصائيات من لقطة القراءة - تُحسب عند القراءة فقط ولا تكلف مسار الأحداث شيئاً"""
+    snapshot = stats.get_snapshot() if stats.is_loaded() else stats.get_summary()
+    families = [
+        ('bot_users_total', 'gauge', 'Registered users', (), [((), snapshot.get('total_users', 0))]),
+        ('bot_active_users', 'gauge', 'Active users per window', ('window',), [
+            (('day',), snapshot.get('active_users_today', 0)),
+            (('week',), snapshot.get('active_users_week', 0)),
+            (('month',), snapshot.get('active_users_month', 0)),
+        ]),
+        ('bot_downloads_total', 'counter', 'Download attempts', (), [((), snapshot.get('total_downloads', 0))]),
+        ('bot_downloads_successful_total', 'counter', 'Successful downloads', (),
+         [((), snapshot.get('successful_downloads', 0))]),
+        ('bot_downloads_failed_total', 'counter', 'Failed downloads', (), [((), snapshot.get('failed_downloads', 0))]),
+        ('bot_searches_total', 'counter', 'Searches', (), [((), snapshot.get('total_searches', 0))]),
+        ('bot_errors_total', 'counter', 'Errors', (), [((), snapshot.get('total_errors', 0))]),
+        ('bot_downloads_by_type_total', 'counter', 'Successful downloads per content type', ('type',),
+         [((name,), count) for name, count in snapshot.get('downloads_by_type', {}).items()]),
+        ('bot_downloads_by_platform_total', 'counter', 'Successful downloads per platform', ('platform',),
+         [((name,), count) for name, count in snapshot.get('platforms', {}).items()]),
+        ('bot_active_actions', 'gauge', 'Download actions currently in flight', (),
+         [((), len(active_user_actions))]),
+        ('bot_stats_queued_events', 'gauge', 'Stats events waiting for the stats worker', (),
+         [((), stats.get_flush_metrics()['queued_events'])]),
+    ]
+    return families
+
+METRICS.add_collector(collect_stats_metrics)
 
 class SocialMediaDownloader:
     """فئة لتحميل المحتوى من مواقع التواصل الاجتماعي"""
@@ -852,6 +4836,15 @@ class SocialMediaDownloader:
                 'outtmpl': f'{DOWNLOAD_FOLDER}/%(title)s.%(ext)s',
             }
 
+    def quality_key(self, kind):
+        """وصف الجودة/الصيغة المستخدمة لكل نوع (جزء من مفتاح دمج التحميلات)"""
+        if kind == 'video':
+            return self.ydl_opts_video['format']
+        if kind == 'audio':
+            codecs = [p.get('preferredcodec', '') for p in self.ydl_opts_audio.get('postprocessors', [])]
+            return '+'.join([self.ydl_opts_audio['format']] + codecs)
+        return 'original'
+
     def _write_debug(self, context_name, exc):
         try:
             import traceback
@@ -863,26 +4856,26 @@ class SocialMediaDownloader:
         except Exception:
             pass
     
-    def download_image(self, url):
+    def download_image(self, url, timer=None):
         """تحميل صورة من الرابط - مع طرق متعددة"""
         logger.info(f"محاولة تحميل صورة من: {url}")
         
         try:
             logger.info("استخدام Web Scraping...")
-            return self._download_with_scraping(url)
+            return self._download_with_scraping(url, timer)
         except Exception as e:
             logger.warning(f"فشل Web Scraping: {e}")
         
         try:
             logger.info("محاولة التحميل المباشر...")
-            return self._download_direct(url)
+            return self._download_direct(url, timer)
         except Exception as e:
             logger.warning(f"فشل التحميل المباشر: {e}")
         
         logger.error("فشلت جميع الطرق")
         raise Exception("فشل تحميل الصورة. تأكد من أن الرابط يحتوي على صورة عامة")
     
-    def _download_with_scraping(self, url):
+    def _download_with_scraping(self, url, timer=None):
         """تحميل صورة باستخدام Web Scraping"""
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -918,6 +4911,8 @@ class SocialMediaDownloader:
             
             logger.info(f"تم العثور على رابط الصورة: {image_url[:100]}...")
             
+            if timer:
+                timer.enter('download')
             img_response = requests.get(image_url, headers=headers, timeout=30)
             img_response.raise_for_status()
             
@@ -941,12 +4936,14 @@ class SocialMediaDownloader:
         except Exception as e:
             raise Exception(f"فشل Web Scraping: {str(e)}")
     
-    def _download_direct(self, url):
+    def _download_direct(self, url, timer=None):
         """تحميل مباشر للروابط المباشرة"""
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
         
+        if timer:
+            timer.enter('download')
         response = requests.get(url, headers=headers, timeout=30)
         response.raise_for_status()
         
@@ -1129,7 +5126,7 @@ class SocialMediaDownloader:
             logger.error(f"خطأ في تحميل قصص Instagram: {e}")
             raise Exception(f"❌ خطأ في تحميل القصص: {str(e)}")
     
-    def download_video(self, url, max_retries=3):
+    def download_video(self, url, max_retries=3, timer=None):
         """تحميل فيديو من الرابط مع آلية إعادة المحاولة"""
         last_error = None
         
@@ -1145,8 +5142,13 @@ class SocialMediaDownloader:
                 opts['user_agent'] = random.choice(user_agents)
                 opts['http_headers']['User-Agent'] = opts['user_agent']
                 
+                if timer:
+                    timer.enter('metadata')
+                    opts = timer.attach(opts)
+                
                 with yt_dlp.YoutubeDL(opts) as ydl:
                     info = ydl.extract_info(url, download=True)
+                    METADATA_CACHE.put(url, summarize_info(info))
                     filename = ydl.prepare_filename(info)
                     
                     if not filename.endswith('.mp4'):
@@ -1175,6 +5177,10 @@ class SocialMediaDownloader:
                     opts.setdefault('ignore_no_formats_error', True)
                     opts['http_headers']['User-Agent'] = opts['user_agent']
                     try:
+                        if timer:
+                            timer.enter('metadata')
+                            opts = timer.attach(opts)
+                        
                         with yt_dlp.YoutubeDL(opts) as ydl:
                             info = ydl.extract_info(url, download=True)
                             filename = ydl.prepare_filename(info)
@@ -1204,7 +5210,7 @@ class SocialMediaDownloader:
         
         raise Exception(f"فشل تحميل الفيديو بعد {max_retries} محاولات: {last_error}")
     
-    def download_audio(self, url, max_retries=3):
+    def download_audio(self, url, max_retries=3, timer=None):
         """تحميل الصوت من الرابط مع آلية إعادة المحاولة"""
         last_error = None
         
@@ -1220,8 +5226,13 @@ class SocialMediaDownloader:
                 opts['user_agent'] = random.choice(user_agents)
                 opts['http_headers']['User-Agent'] = opts['user_agent']
                 
+                if timer:
+                    timer.enter('metadata')
+                    opts = timer.attach(opts)
+                
                 with yt_dlp.YoutubeDL(opts) as ydl:
                     info = ydl.extract_info(url, download=True)
+                    METADATA_CACHE.put(url, summarize_info(info))
                     filename = ydl.prepare_filename(info)
                     
                     # إذا كان ffmpeg متاحاً، ابحث عن ملف mp3
@@ -1265,6 +5276,10 @@ class SocialMediaDownloader:
                     opts.setdefault('ignore_no_formats_error', True)
                     opts['http_headers']['User-Agent'] = opts['user_agent']
                     try:
+                        if timer:
+                            timer.enter('metadata')
+                            opts = timer.attach(opts)
+                        
                         with yt_dlp.YoutubeDL(opts) as ydl:
                             info = ydl.extract_info(url, download=True)
                             filename = ydl.prepare_filename(info)
@@ -1374,6 +5389,14 @@ class SocialMediaDownloader:
             logger.error(f"خطأ عام في get_info: {e}")
             raise Exception(f"خطأ في جلب المعلومات: {str(e)}")
     
+    def get_metadata(self, url):
+        """ملخص معلومات الرابط (summarize_info) من الذاكرة أو عبر get_info ثم تخزينه"""
+        summary = METADATA_CACHE.get(url, record=False)
+        if summary is None:
+            summary = summarize_info(self.get_info(url))
+            METADATA_CACHE.put(url, summary)
+        return summary
+    
     def search_youtube(self, query, max_results=5):
         """البحث في YouTube عن أغنية"""
         try:
@@ -1814,6 +5837,9 @@ async def stats_view_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
                 InlineKeyboardButton("🏆 أكثر المستخدمين", callback_data="stats_top_users"),
                 InlineKeyboardButton("📈 الرسوم البيانية", callback_data="stats_charts")
             ],
+            [
+                InlineKeyboardButton("⏱️ أزمنة التحميل", callback_data="stats_latency")
+            ],
             [
                 InlineKeyboardButton("↩️ عودة للقائمة", callback_data="back_to_menu")
             ]
@@ -1845,16 +5871,34 @@ async def stats_view_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         intro_text += """
 🏆 **أكثر المستخدمين** - ترتيب المستخدمين النشطين
 📈 **الرسوم البيانية** - تحليل تفصيلي وإحصائيات متقدمة
+⏱️ **أزمنة التحميل** - p50/p95/p99 لكل مرحلة ومنصة
 """
     
     await query.message.edit_text(intro_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
+# رسالة تُعرض في اللوحات التي تحتاج بيانات المستخدمين قبل انتهاء التحميل في الخلفية
+STATS_LOADING_TEXT = "⏳ الإحصائيات التفصيلية ما زالت تُحمَّل، حاول مرة أخرى بعد قليل"
+
 async def stats_general_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """عرض الإحصائيات العامة للبوت"""
     query = update.callback_query
     await query.answer()
     
-    stats_text = stats.get_stats_text()
+    if stats.is_loaded():
+        stats_text = stats.get_stats_text()
+    else:
+        # الإحصائيات التفصيلية ما زالت تُحمَّل في الخلفية - عرض العدادات من ملف الملخص
+        summary = stats.get_summary()
+        stats_text = f"""
+⏳ **جاري تحميل الإحصائيات التفصيلية...**
+
+👥 إجمالي المستخدمين: {summary.get('total_users', 0):,}
+📥 إجمالي التحميلات: {summary.get('total_downloads', 0):,}
+✅ الناجحة: {summary.get('successful_downloads', 0):,}
+❌ الفاشلة: {summary.get('failed_downloads', 0):,}
+🔍 عمليات البحث: {summary.get('total_searches', 0):,}
+🕐 آخر تحديث: {summary.get('last_update', 'غير معروف')}
+        """
     parts = split_message(stats_text)
     
     keyboard = [
@@ -1873,11 +5917,23 @@ async def stats_personal_callback(update: Update, context: ContextTypes.DEFAULT_
     
     await query.answer()
     
+    keyboard = [
+        [InlineKeyboardButton("📊 القائمة الرئيسية", callback_data="stats_view")],
+        [InlineKeyboardButton("↩️ عودة للقائمة", callback_data="back_to_menu")]
+    ]
+    
+    # قراءة سجل المستخدم تنتظر اكتمال التحميل - لا نحجب حلقة الأحداث بذلك
+    if not stats.is_loaded():
+        await query.message.edit_text(STATS_LOADING_TEXT, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    
     user_stats = stats.get_user_stats(user.id)
     
     if not user_stats:
         stats.add_user(user.id, user.full_name, user.username or "بدون معرف")
         stats.add_usage(user.id)
+        # انتظار تطبيق الحدثين في خيط الإحصائيات دون حجب حلقة الأحداث
+        await run_blocking(stats.drain)
         user_stats = stats.get_user_stats(user.id)
 
     if not user_stats:
@@ -1890,11 +5946,6 @@ async def stats_personal_callback(update: Update, context: ContextTypes.DEFAULT_
   ابدأ الآن واستكشف جميع الميزات الرائعة 🚀
 """
     
-    keyboard = [
-        [InlineKeyboardButton("📊 القائمة الرئيسية", callback_data="stats_view")],
-        [InlineKeyboardButton("↩️ عودة للقائمة", callback_data="back_to_menu")]
-    ]
-    
     await query.message.edit_text(user_stats, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
 async def stats_top_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1909,12 +5960,13 @@ async def stats_top_users_callback(update: Update, context: ContextTypes.DEFAULT
     
     await query.answer()
     
+    if not stats.is_loaded():
+        keyboard = [[InlineKeyboardButton("📊 القائمة الرئيسية", callback_data="stats_view")]]
+        await query.message.edit_text(STATS_LOADING_TEXT, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    
     # الحصول على أكثر المستخدمين نشاطاً
-    top_users = sorted(
-        stats.data['users'].items(),
-        key=lambda x: x[1]['usage_count'],
-        reverse=True
-    )[:10]
+    top_users = stats.get_snapshot()['top_users'][:10]
     
     top_users_text = "\n".join([
         f"{i+1}. {user[1]['name']} (@{user[1]['username']})\n   • الاستخدامات: {user[1]['usage_count']}\n   • التحميلات: {user[1]['download_count']}\n   • البحث: {user[1]['search_count']}"
@@ -1948,95 +6000,33 @@ async def stats_charts_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     await query.answer()
     
-    from datetime import datetime, timedelta
-    
-    # حساب الإحصائيات المتقدمة
-    total_users = stats.data['total_users']
-    total_downloads = stats.data['total_downloads']
-    total_searches = stats.data['total_searches']
+    charts_msg = stats.get_charts_text() if stats.is_loaded() else STATS_LOADING_TEXT
     
-    # معدل النجاح
-    success_rate = 100 if total_downloads == 0 else (
-        (stats.data['successful_downloads'] / total_downloads) * 100
-    )
-    
-    # متوسط الاستخدام لكل مستخدم
-    total_usage = sum(u.get('usage_count', 0) for u in stats.data['users'].values())
-    avg_usage = total_usage / total_users if total_users > 0 else 0
-    
-    # حساب النمو اليومي
-    now = datetime.now()
-    today = now.date().isoformat()
-    yesterday = (now - timedelta(days=1)).date().isoformat()
-    
-    today_downloads = stats.data['daily_stats'].get(today, {}).get('downloads', 0)
-    yesterday_downloads = stats.data['daily_stats'].get(yesterday, {}).get('downloads', 0)
-    
-    growth = 0
-    if yesterday_downloads > 0:
-        growth = ((today_downloads - yesterday_downloads) / yesterday_downloads) * 100
-    
-    # أيام التشغيل
-    start_date = datetime.fromisoformat(stats.data['start_date'])
-    days_running = (datetime.now() - start_date).days + 1
-    
-    # متوسط التحميلات اليومية
-    avg_daily_downloads = total_downloads / days_running if days_running > 0 else 0
+    keyboard = [
+        [InlineKeyboardButton("📊 القائمة الرئيسية", callback_data="stats_view")],
+        [InlineKeyboardButton("↩️ عودة للقائمة", callback_data="back_to_menu")]
+    ]
     
-    # أكثر أنواع التحميلات
-    downloads_by_type = stats.data['downloads_by_type']
-    top_type = max(downloads_by_type, key=downloads_by_type.get) if downloads_by_type else "لا يوجد"
+    await query.message.edit_text(charts_msg, reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def stats_latency_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض أزمنة مراحل التحميل لكل منصة - خاص بالمطور"""
+    query = update.callback_query
+    user = update.effective_user
     
-    # أكثر المنصات استخداماً
-    platforms = stats.data['platforms']
-    top_platform = max(platforms, key=platforms.get) if platforms else "لا يوجد"
+    # التحقق من المطور
+    if not is_developer(user.id, user.username):
+        await query.answer("⛔ هذا الخيار متاح للمطور فقط", show_alert=True)
+        return
     
-    charts_msg = f"""
-╔════════════════════════════════════════════════════════════════╗
-║           📈 التحليل المتقدم والرسوم البيانية           ║
-╚════════════════════════════════════════════════════════════════╝
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-📊 **الإحصائيات الأساسية**
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-  إجمالي المستخدمين: {total_users:,}
-  إجمالي التحميلات: {total_downloads:,}
-  إجمالي عمليات البحث: {total_searches:,}
-  أيام التشغيل: {days_running}
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-📈 **معدلات الأداء**
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-  معدل النجاح: {success_rate:.1f}%
-  متوسط التحميلات اليومية: {avg_daily_downloads:.1f}
-  متوسط الاستخدام للمستخدم: {avg_usage:.1f}
-  نمو التحميلات (اليوم): {growth:+.1f}%
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-🎯 **التصنيفات الأكثر شيوعاً**
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-  أكثر نوع تحميل: {top_type.upper() if top_type != 'لا يوجد' else top_type}
-  أكثر منصة: {top_platform.upper() if top_platform != 'لا يوجد' else top_platform}
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-📅 **معلومات التاريخ**
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-  تاريخ البدء: {stats.data['start_date'][:10]}
-  آخر تحديث: {stats.data['last_update']}
-
-╚════════════════════════════════════════════════════════════════╝
-    """
+    await query.answer()
     
     keyboard = [
         [InlineKeyboardButton("📊 القائمة الرئيسية", callback_data="stats_view")],
         [InlineKeyboardButton("↩️ عودة للقائمة", callback_data="back_to_menu")]
     ]
     
-    await query.message.edit_text(charts_msg, reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.message.edit_text(get_download_latency_text(), reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def broadcast_view_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إظهار واجهة الإرسال للمطور من الزر"""
@@ -2173,29 +6163,42 @@ async def audio_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⏳ يوجد طلب مماثل قيد المعالجة. يرجى الانتظار.")
         return
     message = await update.message.reply_text("🎵 جاري تحميل الموسيقى...")
+    if await send_cached_file('audio', url, update.message, lambda title: f"🎵 {title}"):
+        stats.add_download('audio', user.id, 'youtube')
+        await message.delete()
+        end_action(user.id, action_key)
+        return
+    job = DownloadJob('audio', url, user.id, update.effective_chat.id, message)
     
+    timer = DownloadPhaseTimer('youtube')
     try:
-        loop = asyncio.get_running_loop()
-        filename, title = await loop.run_in_executor(None, downloader.download_audio, url)
+        await DOWNLOAD_SCHEDULER.acquire(job)
+        timer.restart()
+        filename, title = await DOWNLOADS_IN_FLIGHT.fetch('audio', downloader.download_audio, url, pool='audio', timer=timer)
+        timer.pause()
 
         await message.edit_text("📤 جاري إرسال الملف...")
 
-        with open(filename, 'rb') as audio_file:
-            await update.message.reply_audio(
+        timer.enter('upload')
+        with open(filename, 'rb') as audio_file, METRIC_UPLOAD_SECONDS.time('audio'):
+            sent = await update.message.reply_audio(
                 audio=audio_file,
                 title=title,
                 caption=f"🎵 {title}"
             )
+        TELEGRAM_FILE_CACHE.remember('audio', url, sent, title)
 
-        stats.add_download('audio', user.id, 'youtube')
+        stats.add_download('audio', user.id, 'youtube', timer.finish())
         os.remove(filename)
         await message.delete()
 
     except Exception as e:
-        stats.add_failed_download()
+        timer.finish()
+        stats.add_failed_download(user.id)
         await message.edit_text(f"❌ خطأ: {str(e)}")
 
     finally:
+        DOWNLOAD_SCHEDULER.release(job)
         end_action(user.id, action_key)
 
 async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2212,10 +6215,14 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     url = context.args[0]
     message = await update.message.reply_text("🔍 جاري جلب المعلومات...")
+    job = DownloadJob('info', url, update.effective_user.id, update.effective_chat.id, message)
+    # المعلومات المخزنة تُعرض فوراً دون انتظار دور في الطابور
+    info = METADATA_CACHE.get(url)
     
     try:
-        loop = asyncio.get_running_loop()
-        info = await loop.run_in_executor(None, downloader.get_info, url)
+        if info is None:
+            await DOWNLOAD_SCHEDULER.acquire(job)
+            info = await run_blocking(downloader.get_metadata, url, pool='search')
         
         if not info:
             await message.edit_text("❌ لم يتم العثور على معلومات")
@@ -2226,6 +6233,7 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         duration = info.get('duration', 0)
         view_count = info.get('view_count', 0)
         like_count = info.get('like_count', 0)
+        max_height = info.get('formats', {}).get('max_height')
         
         if duration and duration > 0:
             hours = duration // 3600
@@ -2240,6 +6248,7 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         view_str = f"{view_count:,}" if view_count else "غير متوفر"
         like_str = f"{like_count:,}" if like_count else "غير متوفر"
+        quality_str = f"{max_height}p" if max_height else "غير متوفر"
         
         info_text = f"""
 📊 معلومات المحتوى:
@@ -2252,12 +6261,16 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 👁️ المشاهدات: {view_str}
 ❤️ الإعجابات: {like_str}
+
+🎞️ أعلى جودة: {quality_str}
         """
         
         await message.edit_text(info_text)
         
     except Exception as e:
         await message.edit_text(f"❌ خطأ: {str(e)}")
+    finally:
+        DOWNLOAD_SCHEDULER.release(job)
 
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """البحث عن أغنية في YouTube"""
@@ -2277,11 +6290,10 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = ' '.join(context.args)
     message = await update.message.reply_text(f"🔍 جاري البحث عن: {query}...")
     
-    stats.add_search()
+    stats.add_search(update.effective_user.id, query)
     
     try:
-        loop = asyncio.get_running_loop()
-        results = await loop.run_in_executor(None, downloader.search_youtube, query, 5)
+        results = await run_blocking(downloader.search_youtube, query, 5, pool='search')
         
         if not results:
             await message.edit_text("❌ لم يتم العثور على نتائج")
@@ -2318,53 +6330,6 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await message.edit_text(f"❌ خطأ في البحث: {str(e)}")
         logger.error(f"خطأ في search_command: {e}")
 
-async def download_song_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """تحميل الأغنية المختارة"""
-    query = update.callback_query
-    await query.answer()
-    
-    user_id = update.effective_user.id
-    
-    if user_id not in search_results:
-        await query.message.edit_text("❌ انتهت صلاحية البحث. الرجاء البحث مرة أخرى")
-        return
-    
-    try:
-        song_index = int(query.data.split('_')[-1])
-        video = search_results[user_id][song_index]
-    except (IndexError, ValueError):
-        await query.message.edit_text("❌ خطأ في اختيار الأغنية")
-        return
-    
-    await query.message.edit_text(f"🎵 جاري تحميل: {video['title'][:50]}...")
-    
-    try:
-        loop = asyncio.get_running_loop()
-        filename, title = await loop.run_in_executor(None, downloader.download_audio, video['url'])
-        
-        stats.add_download('search', user_id, 'youtube')
-        
-        await query.message.edit_text("📤 جاري إرسال الأغنية...")
-        
-        with open(filename, 'rb') as audio_file:
-            await query.message.reply_audio(
-                audio=audio_file,
-                title=title,
-                performer=video['channel'],
-                caption=f"🎵 {title}\n👤 {video['channel']}"
-            )
-        
-        os.remove(filename)
-        await query.message.delete()
-        
-        if user_id in search_results:
-            del search_results[user_id]
-        
-    except Exception as e:
-        stats.add_failed_download()
-        await query.message.edit_text(f"❌ خطأ في التحميل: {str(e)}")
-        logger.error(f"خطأ في download_song_callback: {e}")
-
 async def download_song_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """تحميل نتيجة محددة من البحث وإرسالها كموسيقى"""
     query = update.callback_query
@@ -2388,23 +6353,37 @@ async def download_song_callback(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer("⏳ الطلب قيد المعالجة.", show_alert=True)
         return
 
-    await query.message.edit_text(f"🎵 جاري تحميل: {video['title'][:50]}...")
+    status = await query.message.edit_text(f"🎵 جاري تحميل: {video['title'][:50]}...")
+    if await send_cached_file('audio', video['url'], query.message,
+                              lambda title: f"🎵 {title}\n🎤 {video.get('channel', '')}",
+                              performer=video.get('channel', '')):
+        stats.add_download('search', user_id, 'youtube')
+        await query.message.delete()
+        search_results.pop(user_id, None)
+        end_action(user_id, action_key)
+        return
+    job = DownloadJob('audio', video['url'], user_id, update.effective_chat.id, status)
 
+    timer = DownloadPhaseTimer('youtube')
     try:
-        loop = asyncio.get_running_loop()
-        filename, title = await loop.run_in_executor(None, downloader.download_audio, video['url'])
-
-        stats.add_download('search', user_id, 'youtube')
+        await DOWNLOAD_SCHEDULER.acquire(job)
+        timer.restart()
+        filename, title = await DOWNLOADS_IN_FLIGHT.fetch('audio', downloader.download_audio, video['url'], pool='audio', timer=timer)
+        timer.pause()
 
         await query.message.edit_text("جار ارسال الاغنية ....")
 
-        with open(filename, 'rb') as audio_file:
-            await query.message.reply_audio(
+        timer.enter('upload')
+        with open(filename, 'rb') as audio_file, METRIC_UPLOAD_SECONDS.time('audio'):
+            sent = await query.message.reply_audio(
                 audio=audio_file,
                 title=title,
                 performer=video.get('channel', ''),
                 caption=f"🎵 {title}\n🎤 {video.get('channel', '')}"
             )
+        TELEGRAM_FILE_CACHE.remember('audio', video['url'], sent, title)
+
+        stats.add_download('search', user_id, 'youtube', timer.finish())
 
         os.remove(filename)
         await query.message.delete()
@@ -2413,10 +6392,12 @@ async def download_song_callback(update: Update, context: ContextTypes.DEFAULT_T
             del search_results[user_id]
 
     except Exception as e:
+        timer.finish()
         stats.add_failed_download(user_id)
         await query.message.edit_text(f"❌ خطأ في تحميل الصوت: {str(e)}")
         logger.error(f"خطأ في download_song_callback: {e}")
     finally:
+        DOWNLOAD_SCHEDULER.release(job)
         end_action(user_id, action_key)
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2442,6 +6423,9 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [
                 InlineKeyboardButton("🏆 أكثر المستخدمين", callback_data="stats_top_users"),
                 InlineKeyboardButton("📈 الرسوم البيانية", callback_data="stats_charts")
+            ],
+            [
+                InlineKeyboardButton("⏱️ أزمنة التحميل", callback_data="stats_latency")
             ]
         ]
     else:
@@ -2467,6 +6451,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         intro_text += """
 🏆 **أكثر المستخدمين** - ترتيب المستخدمين النشطين
 📈 **الرسوم البيانية** - تحليل تفصيلي وإحصائيات متقدمة
+⏱️ **أزمنة التحميل** - p50/p95/p99 لكل مرحلة ومنصة
 """
     
     await update.message.reply_text(intro_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
@@ -2496,7 +6481,8 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     success_count = 0
     fail_count = 0
     
-    for user_id_str in stats.data['users'].keys():
+    # قائمة المستخدمين تنتظر اكتمال التحميل - ننتظره خارج حلقة الأحداث
+    for user_id_str in await run_blocking(stats.get_user_ids):
         try:
             await context.bot.send_message(
                 chat_id=int(user_id_str),
@@ -2557,29 +6543,43 @@ async def download_image_handler(update: Update, context: ContextTypes.DEFAULT_T
     user_id = update.effective_user.id
     # تحديد المنصة من الرابط
     platform = 'instagram' if 'instagram' in url.lower() else 'other'
+    if await send_cached_file('image', url, update.message, lambda title: f"📸 {title[:200]}"):
+        stats.add_download('image', user_id, platform)
+        await message.delete()
+        return
+    job = DownloadJob('image', url, user_id, update.effective_chat.id, message)
     
     filename = None
+    timer = DownloadPhaseTimer(platform)
     try:
+        await DOWNLOAD_SCHEDULER.acquire(job)
+        timer.restart()
         logger.info(f"تحميل صورة من: {url[:50]}...")
         
-        loop = asyncio.get_running_loop()
         filename, title = await asyncio.wait_for(
-            loop.run_in_executor(None, downloader.download_image, url),
+            DOWNLOADS_IN_FLIGHT.fetch('image', downloader.download_image, url, pool='image', timer=timer),
             timeout=DEFAULT_TIMEOUT
         )
+        timer.pause()
         
         if not os.path.exists(filename):
+            timer.finish()
+            stats.add_failed_download(user_id)
             await message.edit_text("❌ الملف غير موجود")
             return
         
         file_size = os.path.getsize(filename)
         
         if file_size == 0:
+            timer.finish()
+            stats.add_failed_download(user_id)
             await message.edit_text("❌ الملف فارغ")
             os.remove(filename)
             return
         
         if file_size > MAX_FILE_SIZE_IMAGE:
+            timer.finish()
+            stats.add_failed_download(user_id)
             await message.edit_text(
                 f"⚠️ كبير ({file_size // (1024*1024)} MB)\n"
                 f"الحد الأقصى: {MAX_FILE_SIZE_IMAGE // (1024*1024)} MB"
@@ -2589,19 +6589,23 @@ async def download_image_handler(update: Update, context: ContextTypes.DEFAULT_T
         
         await message.edit_text("📤 جاري الإرسال...")
         
-        with open(filename, 'rb') as photo:
-            await update.message.reply_photo(
+        timer.enter('upload')
+        with open(filename, 'rb') as photo, METRIC_UPLOAD_SECONDS.time('photo'):
+            sent = await update.message.reply_photo(
                 photo=photo,
                 caption=f"📸 {title[:200]}"
             )
-        stats.add_download('image', user_id, platform)
+        TELEGRAM_FILE_CACHE.remember('image', url, sent, title)
+        stats.add_download('image', user_id, platform, timer.finish())
         await message.delete()
         
     except asyncio.TimeoutError:
+        timer.finish()
         stats.add_failed_download(user_id)
         await message.edit_text("⏱️ انتهت المهلة")
     except Exception as e:
-        stats.add_failed_download()
+        timer.finish()
+        stats.add_failed_download(user_id)
         await message.edit_text(f"❌ خطأ: {str(e)[:100]}")
         logger.error(f"فشل تحميل الصورة: {e}")
     finally:
@@ -2610,7 +6614,7 @@ async def download_image_handler(update: Update, context: ContextTypes.DEFAULT_T
                 os.remove(filename)
             except:
                 pass
-        end_action(user_id, action_key)
+        DOWNLOAD_SCHEDULER.release(job)
 
 async def download_video_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
     """معالج تحميل الفيديوهات مع معالجة أخطاء محسّنة"""
@@ -2630,20 +6634,40 @@ async def download_video_handler(update: Update, context: ContextTypes.DEFAULT_T
         platform = 'facebook'
     else:
         platform = 'other'
+    if await send_cached_file('video', url, update.message, lambda title: f"🎬 {title[:200]}",
+                              supports_streaming=True):
+        stats.add_download('video', user_id, platform)
+        await message.delete()
+        return
+    # فحص مسبق بالمعلومات المخزنة: رفض الفيديو الكبير قبل تحميله
+    metadata = METADATA_CACHE.get(url, record=False) or {}
+    estimated_size = metadata.get('formats', {}).get('mp4_filesize') or 0
+    if estimated_size > MAX_FILE_SIZE_VIDEO:
+        stats.add_failed_download(user_id)
+        await message.edit_text(
+            f"⚠️ الملف كبير جداً ({estimated_size // (1024*1024)} MB)\n"
+            f"الحد الأقصى: {MAX_FILE_SIZE_VIDEO // (1024*1024)} MB\n\n"
+            f"💡 جرب: /audio {url}"
+        )
+        return
+    job = DownloadJob('video', url, user_id, update.effective_chat.id, message)
     
     filename = None
+    timer = DownloadPhaseTimer(platform)
     try:
-        loop = asyncio.get_running_loop()
-        
+        await DOWNLOAD_SCHEDULER.acquire(job)
+        timer.restart()
         # تحديد مهلة زمنية لتجنب التعليق
         filename, title = await asyncio.wait_for(
-            loop.run_in_executor(None, downloader.download_video, url),
+            DOWNLOADS_IN_FLIGHT.fetch('video', downloader.download_video, url, pool='video', timer=timer),
             timeout=DEFAULT_TIMEOUT + 30  # 60 ثانية
         )
+        timer.pause()
         
         file_size = os.path.getsize(filename)
         
         if file_size > MAX_FILE_SIZE_VIDEO:
+            timer.finish()
             stats.add_failed_download(user_id)
             await message.edit_text(
                 f"⚠️ الملف كبير جداً ({file_size // (1024*1024)} MB)\n"
@@ -2655,25 +6679,30 @@ async def download_video_handler(update: Update, context: ContextTypes.DEFAULT_T
         
         await message.edit_text("📤 جاري الإرسال...")
         
-        with open(filename, 'rb') as video:
-            await update.message.reply_video(
+        timer.enter('upload')
+        with open(filename, 'rb') as video, METRIC_UPLOAD_SECONDS.time('video'):
+            sent = await update.message.reply_video(
                 video=video,
                 caption=f"🎬 {title[:200]}",
                 supports_streaming=True
             )
+        TELEGRAM_FILE_CACHE.remember('video', url, sent, title)
         
-        stats.add_download('video', user_id, platform)
+        stats.add_download('video', user_id, platform, timer.finish())
         os.remove(filename)
         await message.delete()
         
     except asyncio.TimeoutError:
+        timer.finish()
         stats.add_failed_download(user_id)
         await message.edit_text("⏱️ انتهت المهلة - الملف قد يكون كبير جداً")
     except FileNotFoundError:
+        timer.finish()
         stats.add_failed_download(user_id)
         await message.edit_text("❌ الملف غير موجود")
     except Exception as e:
-        stats.add_failed_download()
+        timer.finish()
+        stats.add_failed_download(user_id)
         error_msg = str(e)[:150]
         await message.edit_text(f"❌ خطأ: {error_msg}")
         logger.error(f"فشل تحميل الفيديو: {e}")
@@ -2683,23 +6712,26 @@ async def download_video_handler(update: Update, context: ContextTypes.DEFAULT_T
                 os.remove(filename)
             except:
                 pass
-        end_action(user_id, action_key)
+        DOWNLOAD_SCHEDULER.release(job)
 
 async def download_story_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
     """معالج تحميل قصص Instagram"""
     message = await update.message.reply_text("📸 جاري تحميل قصة Instagram...")
+    job = DownloadJob('story', url, update.effective_user.id, update.effective_chat.id, message)
     
     filename = None
     try:
-        loop = asyncio.get_running_loop()
-        filename, title = await loop.run_in_executor(None, downloader.download_instagram_story, url)
+        await DOWNLOAD_SCHEDULER.acquire(job)
+        filename, title = await DOWNLOADS_IN_FLIGHT.fetch('story', downloader.download_instagram_story, url, pool='stories')
         
         if not os.path.exists(filename):
+            stats.add_failed_download(job.user_id)
             await message.edit_text("❌ الملف غير موجود")
             return
         
         file_size = os.path.getsize(filename)
         if file_size == 0:
+            stats.add_failed_download(job.user_id)
             await message.edit_text("❌ الملف فارغ")
             if os.path.exists(filename):
                 os.remove(filename)
@@ -2714,6 +6746,7 @@ async def download_story_handler(update: Update, context: ContextTypes.DEFAULT_T
             # فيديو
             max_size = 50 * 1024 * 1024
             if file_size > max_size:
+                stats.add_failed_download(job.user_id)
                 await message.edit_text(
                     f"⚠️ الفيديو كبير جداً ({file_size // (1024*1024)} MB)\n"
                     f"الحد الأقصى: 50 MB"
@@ -2721,7 +6754,7 @@ async def download_story_handler(update: Update, context: ContextTypes.DEFAULT_T
                 os.remove(filename)
                 return
             
-            with open(filename, 'rb') as video:
+            with open(filename, 'rb') as video, METRIC_UPLOAD_SECONDS.time('video'):
                 await update.message.reply_video(
                     video=video,
                     caption=f"📸 {title}",
@@ -2732,6 +6765,7 @@ async def download_story_handler(update: Update, context: ContextTypes.DEFAULT_T
             # صورة
             max_size = 10 * 1024 * 1024
             if file_size > max_size:
+                stats.add_failed_download(job.user_id)
                 await message.edit_text(
                     f"⚠️ الصورة كبيرة جداً ({file_size // (1024*1024)} MB)\n"
                     f"الحد الأقصى: 10 MB"
@@ -2739,7 +6773,7 @@ async def download_story_handler(update: Update, context: ContextTypes.DEFAULT_T
                 os.remove(filename)
                 return
             
-            with open(filename, 'rb') as photo:
+            with open(filename, 'rb') as photo, METRIC_UPLOAD_SECONDS.time('photo'):
                 await update.message.reply_photo(
                     photo=photo,
                     caption=f"📸 {title}"
@@ -2750,7 +6784,7 @@ async def download_story_handler(update: Update, context: ContextTypes.DEFAULT_T
         await message.delete()
         
     except Exception as e:
-        stats.add_failed_download()
+        stats.add_failed_download(job.user_id)
         error_msg = f"❌ خطأ: {str(e)[:200]}"
         await message.edit_text(error_msg)
         logger.error(f"خطأ في download_story_handler: {e}")
@@ -2760,14 +6794,17 @@ async def download_story_handler(update: Update, context: ContextTypes.DEFAULT_T
                 os.remove(filename)
             except:
                 pass
+    finally:
+        DOWNLOAD_SCHEDULER.release(job)
 
 async def download_stories_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, username: str):
     """معالج تحميل قصص Instagram للمستخدم"""
     message = await update.message.reply_text(f"📸 جاري تحميل قصص Instagram للمستخدم: {username}...")
+    job = DownloadJob('story', username, update.effective_user.id, update.effective_chat.id, message)
     
     try:
-        loop = asyncio.get_running_loop()
-        stories = await loop.run_in_executor(None, downloader.download_instagram_stories, username)
+        await DOWNLOAD_SCHEDULER.acquire(job)
+        stories = await run_blocking(downloader.download_instagram_stories, username, pool='stories')
         
         if not stories:
             await message.edit_text("❌ لم يتم العثور على قصص متاحة")
@@ -2785,6 +6822,7 @@ async def download_stories_handler(update: Update, context: ContextTypes.DEFAULT
                 file_size = os.path.getsize(filename)
                 if file_size == 0:
                     logger.warning(f"الملف فارغ: {filename}")
+                    stats.add_failed_download(job.user_id)
                     os.remove(filename)
                     continue
                 
@@ -2796,10 +6834,11 @@ async def download_stories_handler(update: Update, context: ContextTypes.DEFAULT
                     max_size = 50 * 1024 * 1024
                     if file_size > max_size:
                         logger.warning(f"الفيديو كبير جداً: {filename}")
+                        stats.add_failed_download(job.user_id)
                         os.remove(filename)
                         continue
                     
-                    with open(filename, 'rb') as video:
+                    with open(filename, 'rb') as video, METRIC_UPLOAD_SECONDS.time('video'):
                         await update.message.reply_video(
                             video=video,
                             caption=f"📸 {title} ({sent_count + 1}/{len(stories)})",
@@ -2811,10 +6850,11 @@ async def download_stories_handler(update: Update, context: ContextTypes.DEFAULT
                     max_size = 10 * 1024 * 1024
                     if file_size > max_size:
                         logger.warning(f"الصورة كبيرة جداً: {filename}")
+                        stats.add_failed_download(job.user_id)
                         os.remove(filename)
                         continue
                     
-                    with open(filename, 'rb') as photo:
+                    with open(filename, 'rb') as photo, METRIC_UPLOAD_SECONDS.time('photo'):
                         await update.message.reply_photo(
                             photo=photo,
                             caption=f"📸 {title} ({sent_count + 1}/{len(stories)})"
@@ -2829,7 +6869,9 @@ async def download_stories_handler(update: Update, context: ContextTypes.DEFAULT
                     await asyncio.sleep(1)
                     
             except Exception as e:
+                # التحميل نجح لكن الإرسال فشل: يُحتسب تحميلاً فاشلاً
                 logger.error(f"فشل إرسال القصة {filename}: {e}")
+                stats.add_failed_download(job.user_id)
                 if os.path.exists(filename):
                     os.remove(filename)
                 continue
@@ -2842,10 +6884,12 @@ async def download_stories_handler(update: Update, context: ContextTypes.DEFAULT
             await update.message.reply_text(f"✅ تم إرسال {sent_count} قصة بنجاح")
         
     except Exception as e:
-        stats.add_failed_download()
+        stats.add_failed_download(job.user_id)
         error_msg = f"❌ خطأ: {str(e)[:200]}"
         await message.edit_text(error_msg)
         logger.error(f"خطأ في download_stories_handler: {e}")
+    finally:
+        DOWNLOAD_SCHEDULER.release(job)
 
 async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة الروابط أو البحث حسب اختيار المستخدم"""
@@ -2870,7 +6914,7 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 success_count = 0
                 fail_count = 0
                 
-                for user_id_str in stats.data['users'].keys():
+                for user_id_str in await run_blocking(stats.get_user_ids):
                     try:
                         await context.bot.send_message(
                             chat_id=int(user_id_str),
@@ -2900,11 +6944,10 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user_id in user_states and user_states[user_id] == 'search':
             message = await update.message.reply_text(f"🔍 جاري البحث...")
             
-            stats.add_search()
+            stats.add_search(user_id, text)
             
             try:
-                loop = asyncio.get_running_loop()
-                results = await loop.run_in_executor(None, downloader.search_youtube, text, MAX_SEARCH_RESULTS)
+                results = await run_blocking(downloader.search_youtube, text, MAX_SEARCH_RESULTS, pool='search')
                 
                 if not results:
                     await message.edit_text("❌ لا توجد نتائج")
@@ -2977,32 +7020,47 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 platform = 'other'
             
+            if await send_cached_file('audio', text, update.message, lambda title: f"🎵 {title}"):
+                stats.add_download('audio', user_id, platform)
+                await message.delete()
+                end_action(user_id, action_key)
+                return
+            job = DownloadJob('audio', text, user_id, update.effective_chat.id, message)
+            
+            timer = DownloadPhaseTimer(platform)
             try:
-                loop = asyncio.get_running_loop()
+                await DOWNLOAD_SCHEDULER.acquire(job)
+                timer.restart()
                 filename, title = await asyncio.wait_for(
-                    loop.run_in_executor(None, downloader.download_audio, text),
+                    DOWNLOADS_IN_FLIGHT.fetch('audio', downloader.download_audio, text, pool='audio', timer=timer),
                     timeout=DEFAULT_TIMEOUT
                 )
+                timer.pause()
                 
                 await message.edit_text("📤 جاري الإرسال...")
                 
-                with open(filename, 'rb') as audio_file:
-                    await update.message.reply_audio(
+                timer.enter('upload')
+                with open(filename, 'rb') as audio_file, METRIC_UPLOAD_SECONDS.time('audio'):
+                    sent = await update.message.reply_audio(
                         audio=audio_file,
                         title=title,
                         caption=f"🎵 {title}"
                     )
+                TELEGRAM_FILE_CACHE.remember('audio', text, sent, title)
                 
-                stats.add_download('audio', user_id, platform)
+                stats.add_download('audio', user_id, platform, timer.finish())
                 os.remove(filename)
                 await message.delete()
             except asyncio.TimeoutError:
+                timer.finish()
                 stats.add_failed_download(user_id)
                 await message.edit_text("⏱️ انتهت المهلة")
             except Exception as e:
+                timer.finish()
                 stats.add_failed_download(user_id)
                 await message.edit_text(f"❌ خطأ: {str(e)[:100]}")
             finally:
+                DOWNLOAD_SCHEDULER.release(job)
                 end_action(user_id, action_key)
         elif download_type == 'story':
             username = text.strip('@')
@@ -3017,124 +7075,6 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ خطأ: {str(e)[:100]}")
         except:
             pass
-        return
-        if False:
-            success_count = 0
-            fail_count = 0
-            
-            for user_id_str in stats.data['users'].keys():
-                try:
-                    await context.bot.send_message(
-                        chat_id=int(user_id_str),
-                        text=f"رسالة من المطور 👨‍💻\n\n{broadcast_text}"
-                    )
-                    success_count += 1
-                except Exception as e:
-                    fail_count += 1
-                    logger.error(f"فشل إرسال رسالة إلى {user_id_str}: {e}")
-            
-            del user_states[user_id]
-            
-            keyboard = get_developer_keyboard()
-            
-            await message.edit_text(
-                f"✅ تم إرسال الرسالة\n\n"
-                f"✅ نجح: {success_count}\n"
-                f"❌ فشل: {fail_count}",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ عودة", callback_data="back_to_menu")]])
-            )
-            return
-    
-    # عد الاستخدام عند إرسال أي رسالة
-    stats.add_usage(user_id)
-    
-    if user_id in user_states and user_states[user_id] == 'search':
-        message = await update.message.reply_text(f"🔍 جاري البحث عن: {text}...")
-        
-        stats.add_search()
-        
-        try:
-            results = downloader.search_youtube(text, max_results=5)
-            
-            if not results:
-                await message.edit_text("❌ لم يتم العثور على نتائج")
-                return
-            
-            search_results[user_id] = results
-            
-            keyboard = []
-            for i, video in enumerate(results):
-                duration = video['duration']
-                if duration and duration > 0:
-                    minutes = int(duration) // 60
-                    seconds = int(duration) % 60
-                    duration_str = f"{minutes}:{seconds:02d}"
-                else:
-                    duration_str = "?"
-                
-                button_text = f"🎵 {video['title'][:45]}... ({duration_str})"
-                keyboard.append([InlineKeyboardButton(
-                    button_text, 
-                    callback_data=f"download_song_{i}"
-                )])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await message.edit_text(
-                f"🎵 نتائج البحث عن: {text}\n\n"
-                f"اختر الأغنية التي تريد تحميلها:",
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            await message.edit_text(f"❌ خطأ في البحث: {str(e)}")
-            logger.error(f"خطأ في البحث: {e}")
-        
-        return
-    
-    if not text.startswith(('http://', 'https://')):
-        return
-    
-    if user_id not in user_states:
-        await update.message.reply_text(
-            "⚠️ الرجاء اختيار نوع المحتوى أولاً:\n\n"
-            "استخدم /start لعرض الخيارات",
-            reply_markup=get_type_selection_keyboard()
-        )
-        return
-    
-    download_type = user_states[user_id]
-    
-    if download_type == 'image':
-        await download_image_handler(update, context, text)
-    elif download_type == 'video':
-        await download_video_handler(update, context, text)
-    elif download_type == 'audio':
-        message = await update.message.reply_text("🎵 جاري تحميل الموسيقى...")
-        try:
-            filename, title = downloader.download_audio(text)
-            await message.edit_text("📤 جاري إرسال الملف...")
-            
-            with open(filename, 'rb') as audio_file:
-                await update.message.reply_audio(
-                    audio=audio_file,
-                    title=title,
-                    caption=f"🎵 {title}"
-                )
-            
-            stats.add_download('audio')
-            os.remove(filename)
-            await message.delete()
-        except Exception as e:
-            stats.add_failed_download()
-            await message.edit_text(f"❌ خطأ: {str(e)}")
-    elif download_type == 'story':
-        username = text.strip('@')  # إزالة @ إذا كان موجوداً
-        await download_stories_handler(update, context, username)
-    elif download_type == 'info':
-        # إنشاء context.args مؤقت للاستخدام مع info_command
-        context.args = [text]
-        await info_command(update, context)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """رسالة المساعدة احترافية وشاملة"""
@@ -3241,6 +7181,19 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
+async def log_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تسجيل الزمن من بدء العملية حتى أول تحديث (يعمل في المجموعة -1 قبل باقي المعالجات)"""
+    METRIC_UPDATES.inc()
+    if context.bot_data.get('first_update_logged'):
+        return
+    context.bot_data['first_update_logged'] = True
+    elapsed = time.monotonic() - PROCESS_STARTED_AT
+    load_state = (
+        f"تحميل الإحصائيات: {stats.load_seconds:.2f} ثانية"
+        if stats.is_loaded() else "الإحصائيات ما زالت تُحمَّل"
+    )
+    logger.info(f"⏱️ أول تحديث بعد {elapsed:.2f} ثانية من البدء ({load_state})")
+
 def main():
     """تشغيل البوت مع تحسينات"""
     # طباعة معلومات البدء
@@ -3256,7 +7209,26 @@ def main():
     logger.info(f"✅ قناة الاشتراك: {REQUIRED_CHANNEL}")
     logger.info(f"✅ معرف المطور: {DEVELOPER_ID}")
     
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # concurrent_updates: معالجة التحديثات معاً حتى ينتظر كل طلب دوره في DOWNLOAD_SCHEDULER
+    # بدل أن يوقف التحميل الجاري بقية المستخدمين
+    # post_init: إبلاغ أصحاب الطلبات التي قطعتها إعادة التشغيل السابقة
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(notify_interrupted_downloads)
+        .build()
+    )
+    
+    # قياس الزمن حتى أول تحديث
+    application.add_handler(TypeHandler(Update, log_first_update), group=-1)
+    
+    # نقطة /metrics
+    if METRICS_PORT:
+        try:
+            start_metrics_server()
+        except OSError as e:
+            logger.error(f"❌ تعذر تشغيل خادم المقاييس على المنفذ {METRICS_PORT}: {e}")
     
     # تسجيل معالجات Callback
     callback_handlers = [
@@ -3268,6 +7240,7 @@ def main():
         ("stats_personal", stats_personal_callback),
         ("stats_top_users", stats_top_users_callback),
         ("stats_charts", stats_charts_callback),
+        ("stats_latency", stats_latency_callback),
         ("broadcast_view", broadcast_view_callback),
         ("cancel_broadcast", cancel_broadcast_callback),
         ("back_to_menu", back_to_menu_callback),
@@ -3305,6 +7278,9 @@ def main():
     logger.info("=" * 50)
     
     application.run_polling(allowed_updates=Update.ALL_TYPES)
+    
+    # حفظ أي إحصائيات معلقة قبل الخروج
+    stats.shutdown()
 
 if __name__ == '__main__':
     try:
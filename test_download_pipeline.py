@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+اختبار مسار التحميل - Download Pipeline Test
+
+يختبر طابور التحميل ودمج التحميلات المتطابقة والذاكرات المؤقتة
+دون الاتصال بـ Telegram. يُستورد البوت داخل مجلد مؤقت حتى لا يمس
+ملفات المشروع (bot.log و bot_stats.json ومجلد التحميل).
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test-token")
+os.environ["SCHEDULER_QUEUE_FILE"] = ""
+os.environ["FILE_ID_CACHE_FILE"] = ""
+os.environ["METADATA_CACHE_FILE"] = ""
+os.environ["MEDIA_CACHE_DIR"] = ""
+os.environ["METRICS_PORT"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="bot-test-"))
+try:
+    import bot
+    bot.stats.shutdown()
+finally:
+    os.chdir(_cwd)
+
+
+def make_scheduler(**kwargs):
+    options = {'max_concurrent': 3, 'max_per_user': 2, 'queue_file': '', 'status_interval': 0}
+    options.update(kwargs)
+    return bot.DownloadScheduler(**options)
+
+
+def test_scheduler_holds_several_jobs_within_caps():
+    """عدة طلبات تعمل معاً حتى الحد العام، ولا يتجاوز مستخدم حده الخاص"""
+    async def scenario():
+        scheduler = make_scheduler()
+        jobs = [bot.DownloadJob('video', f'https://a/{i}', 1, 1) for i in range(4)]
+        jobs.append(bot.DownloadJob('video', 'https://b/0', 2, 2))
+        tasks = [asyncio.create_task(scheduler.acquire(job)) for job in jobs]
+        await asyncio.sleep(0)
+
+        assert scheduler.running_count() == 3
+        assert scheduler.queued_count() == 2
+        assert all(tasks[i].done() for i in (0, 1, 4))
+        assert not tasks[2].done() and not tasks[3].done()
+
+        scheduler.release(jobs[0])
+        await asyncio.sleep(0)
+        assert tasks[2].done() and not tasks[3].done()
+        assert scheduler.running_count() == 3
+
+        for job in jobs:
+            scheduler.release(job)
+        await asyncio.gather(*tasks)
+        assert scheduler.running_count() == 0 and scheduler.queued_count() == 0
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_fairness_order():
+    """الأولوية أولاً، ثم صاحب أقل طلبات عاملة، ثم الدور بين المستخدمين"""
+    async def scenario():
+        scheduler = make_scheduler(max_concurrent=1)
+        blocker = bot.DownloadJob('video', 'https://x/0', 9, 9)
+        await scheduler.acquire(blocker)
+
+        flood = [bot.DownloadJob('video', f'https://a/{i}', 1, 1) for i in range(3)]
+        other = bot.DownloadJob('video', 'https://b/0', 2, 2)
+        image = bot.DownloadJob('image', 'https://c/0', 3, 3)
+        waiting = flood + [other, image]
+        tasks = [asyncio.create_task(scheduler.acquire(job)) for job in waiting]
+        await asyncio.sleep(0)
+
+        assert scheduler.queue_order() == [image, flood[0], other, flood[1], flood[2]]
+
+        started = []
+        current = blocker
+        for _ in waiting:
+            scheduler.release(current)
+            await asyncio.sleep(0)
+            current = next(job for job, task in zip(waiting, tasks) if task.done() and job not in started)
+            started.append(current)
+        assert started == [image, flood[0], other, flood[1], flood[2]]
+        scheduler.release(current)
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_cancelled_wait_leaves_queue():
+    """إلغاء الانتظار يزيل الطلب من الطابور دون أن يحجز مكاناً"""
+    async def scenario():
+        scheduler = make_scheduler(max_concurrent=1)
+        first = bot.DownloadJob('audio', 'https://a/0', 1, 1)
+        await scheduler.acquire(first)
+        second = bot.DownloadJob('audio', 'https://b/0', 2, 2)
+        task = asyncio.create_task(scheduler.acquire(second))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert scheduler.queued_count() == 0
+        scheduler.release(first)
+        assert scheduler.running_count() == 0
+
+    asyncio.run(scenario())
+
+
+class FakeMessage:
+    """رسالة حالة تسجل التعديلات بدل إرسالها"""
+
+    def __init__(self, text='⏳ جاري التحميل...'):
+        self.text = text
+        self.message_id = 1
+        self.edits = []
+
+    async def edit_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+def test_scheduler_batches_status_edits_and_saves():
+    """التغييرات تُجمع في تحديث واحد: تعديل من تغير ترتيبهم فقط بحد max_edits، وحفظ الطابور في ملف"""
+    async def scenario(queue_file):
+        scheduler = make_scheduler(max_concurrent=1, max_edits=2, queue_file=queue_file, status_interval=0.05)
+        blocker = bot.DownloadJob('video', 'https://x/0', 9, 9)
+        await scheduler.acquire(blocker)
+        jobs = [bot.DownloadJob('video', f'https://u/{i}', i, i, FakeMessage()) for i in range(4)]
+        tasks = [asyncio.create_task(scheduler.acquire(job)) for job in jobs]
+        for _ in range(5):
+            await asyncio.sleep(0)
+        # تحديث أول: أقرب رسالتين فقط، والباقي في التحديث التالي
+        assert [len(job.message.edits) for job in jobs] == [1, 1, 0, 0]
+        await asyncio.sleep(0.1)
+        assert [len(job.message.edits) for job in jobs] == [1, 1, 1, 1]
+        await scheduler._save_task
+        with open(queue_file, encoding='utf-8') as f:
+            assert [job['url'] for job in json.load(f)] == ['https://x/0'] + [job.url for job in jobs]
+
+        scheduler.release(blocker)
+        await tasks[0]
+        await asyncio.sleep(0.2)
+        # الأول استعاد نصه الأصلي، والبقية تقدموا مكاناً واحداً
+        assert jobs[0].message.edits[-1] == jobs[0].message.text
+        assert [job.message.edits[-1].rsplit(' ', 1)[-1] for job in jobs[1:]] == ['1', '2', '3']
+        for job in jobs:
+            scheduler.release(job)
+        await asyncio.gather(*tasks)
+
+    folder = tempfile.mkdtemp(prefix="bot-test-")
+    asyncio.run(scenario(os.path.join(folder, 'queue.json')))
+
+
+def write_file(folder, name, content=b'data'):
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def test_coalescer_single_flight_and_handover():
+    """طلبان متطابقان يشتركان في تحميل واحد، ولكل منهما مسار خاص، والأخير يأخذ الملف الأصلي"""
+    folder = tempfile.mkdtemp(prefix="bot-test-")
+    calls = []
+
+    def download(url, timer=None):
+        calls.append(url)
+        timer.enter('download')
+        time.sleep(0.05)
+        return write_file(folder, 'song.mp3'), 'Song'
+
+    async def scenario():
+        coalescer = bot.DownloadCoalescer(make_scheduler())
+        timers = [bot.DownloadPhaseTimer('youtube'), bot.DownloadPhaseTimer('youtube')]
+        results = await asyncio.gather(
+            coalescer.fetch('audio', download, 'https://youtu.be/abc?si=x', timer=timers[0]),
+            coalescer.fetch('audio', download, 'https://www.youtube.com/watch?v=abc', timer=timers[1]),
+        )
+        return coalescer, timers, results
+
+    coalescer, timers, results = asyncio.run(scenario())
+    assert calls == ['https://youtu.be/abc?si=x']
+    paths = [path for path, _ in results]
+    assert paths[1] == os.path.join(folder, 'song.mp3') and paths[0] != paths[1]
+    assert all(os.path.exists(path) for path in paths)
+    assert coalescer.in_flight() == 0
+    # كل طالب يُحتسب له زمن التحميل المشترك في مرحلة download
+    assert all(timer.durations.get('download', 0) >= 0.04 for timer in timers)
+
+
+def test_coalescer_orphaned_flight_keeps_scheduler_slot():
+    """مهلة آخر المنتظرين لا تحرر مكان التحميل الذي ما زال يعمل في المجمع"""
+    folder = tempfile.mkdtemp(prefix="bot-test-")
+    started = threading.Event()
+    finish = threading.Event()
+
+    def download(url):
+        started.set()
+        finish.wait(5)
+        return write_file(folder, 'clip.mp4'), 'Clip'
+
+    async def scenario():
+        scheduler = make_scheduler(max_concurrent=1)
+        coalescer = bot.DownloadCoalescer(scheduler)
+        first = bot.DownloadJob('video', 'https://a/1', 1, 1)
+        await scheduler.acquire(first)
+        try:
+            await asyncio.wait_for(coalescer.fetch('video', download, 'https://a/1'), timeout=0.05)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            scheduler.release(first)
+        assert started.is_set()
+        assert scheduler.running_count() == 0 and scheduler.orphaned_count() == 1
+
+        second = bot.DownloadJob('video', 'https://b/2', 2, 2)
+        waiting = asyncio.create_task(scheduler.acquire(second))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+
+        finish.set()
+        await asyncio.wait_for(waiting, timeout=5)
+        assert scheduler.orphaned_count() == 0
+        scheduler.release(second)
+        await asyncio.sleep(0)
+        # لم يبق من يستلم الملف فيُحذف
+        assert not os.path.exists(os.path.join(folder, 'clip.mp4'))
+
+    asyncio.run(scenario())
+
+
+class FakeFile:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class FakeSent:
+    """رسالة Telegram مرسلة تحمل ملفاً من نوع واحد"""
+
+    def __init__(self, media, file_id):
+        setattr(self, media, [FakeFile(file_id)] if media == 'photo' else FakeFile(file_id))
+
+
+def test_file_id_cache_round_trip_and_eviction():
+    """الحفظ مؤجل إلى flush، وإعادة التحميل تحفظ ترتيب الاستخدام، والأقدم استخداماً يُحذف"""
+    folder = tempfile.mkdtemp(prefix="bot-test-")
+    path = os.path.join(folder, 'file_ids.json')
+    cache = bot.TelegramFileCache(path, max_entries=2, save_interval=60)
+    cache.remember('video', 'https://a/1', FakeSent('video', 'v1'), 'One')
+    cache.remember('image', 'https://a/2', FakeSent('photo', 'p2'), 'Two')
+    assert not os.path.exists(path)
+    assert cache.get('video', 'https://a/1')['file_id'] == 'v1'
+    cache.remember('audio', 'https://a/3', FakeSent('document', 'd3'), 'Three')
+    assert cache.get('image', 'https://a/2') is None
+    cache.flush()
+
+    reloaded = bot.TelegramFileCache(path, max_entries=2)
+    assert len(reloaded) == 2
+    assert reloaded.get('audio', 'https://a/3')['media'] == 'document'
+    assert reloaded.get('video', 'https://a/1')['media'] == 'video'
+
+
+def test_file_id_cache_ignores_unexpected_file():
+    """ملف JSON صالح لكنه ليس كائناً لا يوقف الاستيراد"""
+    folder = tempfile.mkdtemp(prefix="bot-test-")
+    path = os.path.join(folder, 'file_ids.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([1, 2, 3], f)
+    assert len(bot.TelegramFileCache(path)) == 0
+
+
+class FakeReplies:
+    """رسالة يُرد عليها: تسجل دالة الرد ووسائطها، وترفع خطأ إن طُلب"""
+
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+
+    def __getattr__(self, name):
+        async def reply(**kwargs):
+            self.calls.append((name, kwargs))
+            if self.error is not None:
+                raise self.error
+        return reply
+
+
+def test_send_cached_file_dispatches_on_media_and_invalidates_only_bad_ids(monkeypatch):
+    """المستند يُعاد كمستند، ولا يبطل المدخل إلا رفض المعرف نفسه"""
+    folder = tempfile.mkdtemp(prefix="bot-test-")
+    cache = bot.TelegramFileCache(os.path.join(folder, 'file_ids.json'), save_interval=60)
+    monkeypatch.setattr(bot, 'TELEGRAM_FILE_CACHE', cache)
+    cache.remember('video', 'https://a/1', FakeSent('document', 'd1'), 'Big')
+
+    message = FakeReplies()
+    caption = lambda title: f"🎬 {title}"
+    assert asyncio.run(bot.send_cached_file('video', 'https://a/1', message, caption, supports_streaming=True))
+    assert message.calls == [('reply_document', {'document': 'd1', 'caption': '🎬 Big'})]
+
+    gone = FakeReplies(bot.BadRequest("Message to be replied not found"))
+    assert asyncio.run(bot.send_cached_file('video', 'https://a/1', gone, caption)) is None
+    assert cache.get('video', 'https://a/1') is not None
+
+    rejected = FakeReplies(bot.BadRequest("Wrong file identifier/http url specified"))
+    assert asyncio.run(bot.send_cached_file('video', 'https://a/1', rejected, caption)) is None
+    assert cache.get('video', 'https://a/1') is None
+
+
+def test_metadata_cache_round_trip_ttl_and_eviction():
+    """العمر حسب المنصة، والأقدم استخداماً يُحذف، والملف يُكتب عند flush"""
+    folder = tempfile.mkdtemp(prefix="bot-test-")
+    path = os.path.join(folder, 'metadata.json')
+    cache = bot.MetadataCache(path, ttls={'youtube': 100, 'tiktok': -1}, default_ttl=50,
+                              max_entries=2, save_interval=60)
+    cache.put('https://a/1', {'title': 'One', 'extractor': 'youtube'})
+    cache.put('https://a/2', {'title': 'Two', 'extractor': 'tiktok'})
+    assert cache.get('https://a/2') is None
+    cache.put('https://a/3', {'title': 'Three', 'extractor': 'generic'})
+    cache.put('https://a/4', {'title': 'Four', 'extractor': 'youtube'})
+    assert cache.get('https://a/1') is None
+    assert not os.path.exists(path)
+    cache.flush()
+
+    reloaded = bot.MetadataCache(path, max_entries=2)
+    assert reloaded.get('https://a/3')['title'] == 'Three'
+    assert reloaded.get('https://a/4')['title'] == 'Four'
+
+
+def test_platform_ttls_skip_malformed_items():
+    """عنصر بلا رقم صالح يُتجاهل بدل إيقاف الاستيراد"""
+    assert bot.parse_platform_ttls("youtube:abc, tiktok:1800,,twitter") == {'tiktok': 1800.0}
+
+
+def test_media_cache_round_trip_eviction_and_cleanup():
+    """نسخة خاصة لكل طالب، والأقدم استخداماً يُحذف، ولا يُحذف عند التحميل إلا ما أنشأته الذاكرة"""
+    directory = tempfile.mkdtemp(prefix="bot-test-")
+    downloads = tempfile.mkdtemp(prefix="bot-test-")
+    cache = bot.MediaCache(directory, max_bytes=10, save_interval=60)
+    cache.publish('video:https://a/1', write_file(downloads, 'one.mp4', b'1111'), 'One')
+    cache.publish('video:https://a/2', write_file(downloads, 'two.mp4', b'2222'), 'Two')
+
+    path, title = cache.checkout('video:https://a/1', folder=downloads)
+    assert title == 'One' and path.startswith(downloads) and os.path.exists(path)
+    os.remove(path)
+    assert cache.checkout('video:https://a/1', folder=downloads) is not None
+
+    cache.publish('video:https://a/3', write_file(downloads, 'three.mp4', b'3333'), 'Three')
+    assert cache.checkout('video:https://a/2', folder=downloads) is None
+    assert cache.stats()['evictions'] == 1
+    # استخدام a/1 بعد نشر a/3 يُحفظ في الفهرس
+    time.sleep(0.01)
+    assert cache.checkout('video:https://a/1', folder=downloads) is not None
+    cache.flush()
+
+    keep = write_file(directory, 'notes.txt')
+    stray = write_file(directory, 'a' * 40 + '.mp4')
+    partial = write_file(directory, '.' + 'b' * 40 + '.mp4.tmp')
+    reloaded = bot.MediaCache(directory, max_bytes=10)
+    assert reloaded.stats()['entries'] == 2
+    assert os.path.exists(keep) and not os.path.exists(stray) and not os.path.exists(partial)
+    # ترتيب الاستخدام استُعيد من الفهرس: a/3 هو الأقدم استخداماً فيُحذف أولاً
+    reloaded.max_bytes = 5
+    reloaded.publish('video:https://a/4', write_file(downloads, 'four.mp4', b'4'), 'Four')
+    assert reloaded.checkout('video:https://a/3', folder=downloads) is None
+    assert reloaded.checkout('video:https://a/1', folder=downloads) is not None
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+اختبار بنى الإحصائيات - Stats Structures Test
+
+يختبر التجميعات الزمنية وبنى الإحصائيات المضغوطة ومخازنها دون الاتصال
+بـ Telegram. يُستورد البوت داخل مجلد مؤقت حتى لا يمس ملفات المشروع.
+"""
+
+import json
+import os
+import sys
+import tempfile
+from datetime import date
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test-token")
+os.environ["SCHEDULER_QUEUE_FILE"] = ""
+os.environ["FILE_ID_CACHE_FILE"] = ""
+os.environ["METADATA_CACHE_FILE"] = ""
+os.environ["MEDIA_CACHE_DIR"] = ""
+os.environ["METRICS_PORT"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="bot-test-"))
+try:
+    import bot
+    bot.stats.shutdown()
+finally:
+    os.chdir(_cwd)
+
+
+def make_stats(data=None, **kwargs):
+    """إحصائيات للقراءة فقط فوق مخزن في الذاكرة"""
+    options = {'read_only': True, 'hll_precision': 0}
+    options.update(kwargs)
+    return bot.AdvancedBotStats(backend=bot.MemoryStatsBackend(data), **options)
+
+
+def test_range_stats_prorates_partial_rollups():
+    """التجميع الذي يتقاطع جزئياً مع الفترة يُحسب بنسبة أيامه داخلها"""
+    stats = make_stats()
+    stats.data['weekly_stats']['2025-W10'] = {  # 3 - 9 مارس
+        'downloads': 70, 'searches': 7, 'new_users': 0, 'failed': 14,
+        'active_user_days': 21, 'peak_active_users': 5, 'days': 7,
+    }
+    stats.data['monthly_stats']['2025-01'] = {
+        'downloads': 310, 'searches': 0, 'new_users': 31, 'failed': 0,
+        'active_user_days': 62, 'peak_active_users': 4, 'days': 31,
+    }
+
+    week = stats.get_range_stats('2025-03-07', '2025-03-20')
+    assert (week['downloads'], week['failed'], week['days']) == (30, 6, 3)
+    assert week['peak_active_users'] == 5 and week['granularity'] == 'week'
+
+    month = stats.get_range_stats(date(2025, 1, 21), date(2025, 2, 10))
+    assert (month['downloads'], month['new_users'], month['days']) == (110, 11, 11)
+    assert month['granularity'] == 'month'
+
+    whole = stats.get_range_stats('2025-01-01', '2025-03-31')
+    assert whole['downloads'] == 380 and whole['days'] == 38
+
+
+def test_week_across_months_is_split_by_days():
+    """أسبوع يعبر حد شهرين يُوزع عليهما بنسبة أيامه ومجموع الجزأين يساوي الأصل"""
+    week = {'downloads': 10, 'searches': 3, 'new_users': 1, 'failed': 0,
+            'active_user_days': 14, 'peak_active_users': 4, 'days': 7, 'sketch_days': 7}
+    parts = bot.split_week_by_month(date(2025, 3, 31), week)  # الاثنين 31 مارس
+    assert [(month, sketch_days) for month, _, sketch_days in parts] == [('2025-03', 1), ('2025-04', 6)]
+    assert [part['downloads'] for _, part, _ in parts] == [1, 9]
+    assert sum(part['searches'] for _, part, _ in parts) == 3
+    assert all(part['peak_active_users'] == 4 for _, part, _ in parts)
+
+    (month, part, _), = bot.split_week_by_month(date(2025, 3, 3), week)
+    assert month == '2025-03' and part['downloads'] == 10
+
+
+def test_retention_is_lazy_and_splits_weeks():
+    """التحميل لا يجمّع الأيام القديمة؛ أول حدث يجمّعها والأسابيع القديمة تُوزع على شهورها"""
+    data = make_stats().data
+    for day in ('2025-03-30', '2025-03-31', '2025-04-01'):
+        data['daily_stats'][day] = {'downloads': 2, 'searches': 0, 'new_users': 0, 'active_users': 0,
+                                    'failed': 0, 'active_user_ids': []}
+    stats = make_stats(data, retention_days=2, retention_weeks=1)
+    assert len(stats.data['daily_stats']) == 3 and not stats._dirty_count
+
+    stats._ensure_daily_entry('2025-06-02')
+    assert list(stats.data['daily_stats']) == ['2025-06-02']
+    assert stats.data['weekly_stats'] == {}
+    monthly = stats.data['monthly_stats']
+    # W13 كله في مارس (2)، و W14 (من 31 مارس) يُوزع بنسبة أيامه: 1 لمارس و 3 لأبريل
+    assert (monthly['2025-03']['downloads'], monthly['2025-04']['downloads']) == (3, 3)
+    assert stats.get_range_stats('2025-03-01', '2025-04-30')['downloads'] == 6
+
+
+def test_user_record_keeps_microseconds_and_plain_json():
+    """أوقات السجل تبقى بأجزاء الثانية عبر JSON واللقطة الثنائية، وto_dict يطابق dict(record)"""
+    values = {
+        'name': 'Ali', 'username': 'ali', 'first_seen': '2024-01-20T10:30:45.123456',
+        'join_date': '2024-01-20', 'last_seen': '2024-03-01T08:00:00.000001',
+        'usage_count': 3, 'download_count': 2, 'search_count': 1, 'failed_count': 0, 'is_active': True,
+    }
+    record = bot.UserRecord(values)
+    assert dict(record) == values == record.to_dict()
+
+    users = bot.UserTable({'42': values, 'legacy': dict(values, note='x')})
+    as_json = json.loads(json.dumps({'users': users}, default=bot.stats_json_default))
+    assert as_json['users']['42'] == values
+    assert as_json['users']['legacy']['note'] == 'x'
+
+    decoded = bot.decode_stats_snapshot(bot.encode_stats_snapshot({'users': users}, 'none'))
+    assert dict(decoded['users']['42']) == values
+    assert decoded['users']['legacy']['last_seen'] == values['last_seen']
+
+
+def make_journal_stats(folder):
+    path = os.path.join(folder, 'stats.json')
+    backend = bot.JournalStatsBackend(os.path.join(folder, 'stats.snapshot.json'), compact_events=2)
+    return bot.AdvancedBotStats(path, backend=backend, flush_interval=0, hll_precision=0)
+
+
+def test_journal_recovers_from_previous_snapshot():
+    """لقطة تالفة تُستعاد من السابقة مع كل الأحداث بعدها، ولا تبدأ الإحصائيات فارغة"""
+    folder = tempfile.mkdtemp(prefix="bot-test-")
+    stats = make_journal_stats(folder)
+    for i in range(5):
+        stats.add_user(i, f'user{i}', None)
+    stats.add_download('video', 1, 'youtube')
+    stats.shutdown()
+    snapshot = os.path.join(folder, 'stats.snapshot.json')
+    assert os.path.exists(snapshot + '.prev')
+
+    with open(snapshot, 'w', encoding='utf-8') as f:
+        f.write('{"users": ')
+    recovered = make_journal_stats(folder)
+    assert recovered.data['total_users'] == 5 and recovered.data['total_downloads'] == 1
+    assert any(name.startswith('stats.snapshot.json.corrupt-') for name in os.listdir(folder))
+    recovered.shutdown()
+
+    for name in ('stats.snapshot.json', 'stats.snapshot.json.prev'):
+        with open(os.path.join(folder, name), 'w', encoding='utf-8') as f:
+            f.write('[]')
+    try:
+        make_journal_stats(folder)
+    except bot.StatsRecoveryError:
+        pass
+    else:
+        raise AssertionError("يجب رفض البدء دون لقطة سليمة")
+
+
+def test_journal_chain_survives_compaction_after_recovery():
+    """أول لقطة بعد الاستعادة تُبقي سلسلة السابقة كاملة فتُستعاد كل الأحداث إن تلفت هي أيضاً"""
+    folder = tempfile.mkdtemp(prefix="bot-test-")
+    snapshot = os.path.join(folder, 'stats.snapshot.json')
+
+    def corrupt_snapshot():
+        with open(snapshot, 'w', encoding='utf-8') as f:
+            f.write('{"users": ')
+
+    stats = make_journal_stats(folder)
+    for i in range(5):
+        stats.add_user(i, f'user{i}', None)
+    stats.add_download('video', 1, 'youtube')
+    stats.shutdown()
+
+    corrupt_snapshot()
+    recovered = make_journal_stats(folder)
+    recovered.add_user(5, 'user5', None)  # لقطة واحدة فقط بعد الاستعادة
+    recovered.shutdown()
+
+    corrupt_snapshot()
+    reloaded = make_journal_stats(folder)
+    assert reloaded.data['total_users'] == 6 and len(reloaded.data['users']) == 6
+    assert reloaded.data['total_downloads'] == 1
+    reloaded.shutdown()
+
+
+def test_search_terms_are_normalized_on_load():
+    """المفاتيح القديمة غير الموحدة تُدمج عند التحميل وتُعلّم للكتابة والحذف"""
+    sketch, dropped = bot.SearchTermSketch.from_counts({'Hello  World': 2, 'hello world': 3, 'Other': 1, '': 4})
+    assert sketch.counts == {'hello world': 5, 'other': 1}
+    assert sorted(dropped) == ['', 'Hello  World', 'Other']
+
+    data = make_stats().data
+    data['search_terms'] = {'Hello  World': 2, 'hello world': 3, 'fine': 1}
+    stats = make_stats(data)
+    assert stats.data['search_terms'] == {'hello world': 5, 'fine': 1}
+    assert stats._changes.terms == {'Hello  World', 'hello world'}
+
+
+def test_usage_rank_index_matches_sorting():
+    """الترتيب والأعلى استخداماً يطابقان الفرز الكامل بعد تغييرات متتالية، والمتساوون يتشاركون الترتيب"""
+    index = bot.UsageRankIndex()
+    counts = {}
+    for step in range(400):
+        user_id = str(step * 7 % 53)
+        counts[user_id] = (step * 31) % 150  # يتجاوز الحجم الأولي للشجرة فيختبر التوسع
+        index.set(user_id, counts[user_id])
+    assert len(index) == len(counts)
+
+    for user_id, count in counts.items():
+        assert index.rank(user_id) == 1 + sum(1 for other in counts.values() if other > count)
+    assert index.rank('missing') is None
+
+    top = index.top(10)
+    assert [counts[user_id] for user_id in top] == sorted(counts.values(), reverse=True)[:10]
+
+    leader = top[0]
+    index.set(leader, 0)
+    counts[leader] = 0
+    assert counts[index.top(1)[0]] == max(counts.values())
+
+    snapshot = index.freeze()
+    index.set(leader, 10 ** 4)
+    assert snapshot.users == len(counts)
+    assert snapshot.rank(0) == 1 + sum(1 for count in counts.values() if count > 0)
+
+
+def test_frozen_user_table_is_copy_on_write():
+    """العرض المنشور لا يتغير بتعديل الجدول أو إضافة مستخدمين أو حذفهم بعده"""
+    users = bot.UserTable({str(i): {'usage_count': i} for i in range(3)})
+    first = users.freeze()
+    users.writable('1')['usage_count'] += 10
+    users['7'] = {'usage_count': 7}
+    assert first['1']['usage_count'] == 1 and '7' not in first and len(first) == 3
+
+    second = users.freeze()
+    del users['0']
+    users.writable('7')['usage_count'] += 1
+    assert second['1']['usage_count'] == 11 and second['7']['usage_count'] == 7
+    assert sorted(second) == ['0', '1', '2', '7'] and len(second) == 4
+
+    third = users.freeze()
+    assert sorted(third) == ['1', '2', '7'] and third['7']['usage_count'] == 8
+    assert first['1']['usage_count'] == 1
+
+
+def test_id_set_round_trip():
+    """ترميز الفروق المتتالية يستعيد المجموعة نفسها، ويقبل القوائم القديمة"""
+    ids = {0, 1, 127, 128, 300, 16383, 16384, 2 ** 40, 7_000_000_123}
+    encoded = bot.encode_id_set(ids)
+    assert encoded.startswith(bot.ID_SET_PREFIX)
+    assert bot.decode_id_set(encoded) == ids
+    assert bot.decode_id_set(bot.encode_id_set(set())) == set()
+    # الفروق الصغيرة تأخذ بايتاً واحداً لكل معرف
+    assert len(bot.encode_id_set(range(1000, 1300))) < len(bot.ID_SET_PREFIX) + 410
+    assert bot.decode_id_set([5, '7', 'x', None]) == {5, 7}
+    assert bot.decode_id_set('not-encoded') == set()
+
+
+def test_binary_backend_round_trip():
+    """اللقطة الثنائية تعيد الإحصائيات كما حُفظت بكل ضغط متاح، وتُقرأ بالتوقيع"""
+    compressions = ['none', 'gzip'] + (['zstd'] if bot.zstandard is not None else [])
+    for compression in compressions:
+        folder = tempfile.mkdtemp(prefix="bot-test-")
+        path = os.path.join(folder, 'stats.bin')
+        stats = bot.AdvancedBotStats(os.path.join(folder, 'stats.json'), flush_interval=0, hll_precision=0,
+                                     backend=bot.BinaryStatsBackend(path, compression))
+        for i in range(1, 6):
+            stats.add_user(i, f'مستخدم {i}', f'user{i}' if i % 2 else None)
+            stats.add_usage(i)
+        stats.add_download('video', 2, 'youtube')
+        stats.add_search(3, 'Some  Song')
+        stats.add_failed_download(4)
+        stats.shutdown()
+
+        with open(path, 'rb') as f:
+            payload = f.read()
+        assert bot.is_stats_snapshot(payload)
+        assert bot.SNAPSHOT_HEADER.unpack_from(payload)[1] == bot.STATS_SNAPSHOT_VERSION
+
+        reloaded = bot.AdvancedBotStats(os.path.join(folder, 'stats.json'), flush_interval=0, hll_precision=0,
+                                        backend=bot.BinaryStatsBackend(path, compression))
+        for key in ('total_users', 'total_downloads', 'failed_downloads', 'total_searches', 'platforms'):
+            assert reloaded.data[key] == stats.data[key], key
+        assert dict(reloaded.data['search_terms']) == {'some song': 1}
+        assert {user_id: dict(record) for user_id, record in reloaded.data['users'].items()} == \
+            {user_id: dict(record) for user_id, record in stats.data['users'].items()}
+        today = max(stats.data['daily_stats'])
+        assert reloaded.data['daily_stats'][today]['active_user_ids'] == {1, 2, 3, 4, 5}
+        reloaded.shutdown()
+
+
+def test_hyperloglog_estimates_merges_and_encodes():
+    """التقدير قريب من العدد الحقيقي، والدمج يساوي الاتحاد، والترميز يستعيد السجلات نفسها"""
+    first = bot.HyperLogLog(12).update(range(0, 30000))
+    second = bot.HyperLogLog(12).update(range(20000, 50000))
+    assert abs(first.count() - 30000) < 30000 * 0.05
+    assert bot.HyperLogLog(12).update(range(100)).count() in range(95, 106)
+
+    union = first.copy().merge(second)
+    assert abs(union.count() - 50000) < 50000 * 0.05
+    assert union.registers == bot.HyperLogLog(12).update(range(50000)).registers
+
+    decoded = bot.HyperLogLog.decode(union.encode())
+    assert decoded.precision == 12 and decoded.registers == union.registers
+    assert bot.merge_sketches([None, first.encode(), second, 'hll-broken']).registers == union.registers
+
+    try:
+        first.merge(bot.HyperLogLog(10))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("دمج ملخصين بدقتين مختلفتين يجب أن يُرفض")